@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+# async catalog and cart views in front of the regular urls
+os.environ.setdefault('ROOT_URLCONF', 'app.asgi_urls')
 
 application = get_asgi_application()
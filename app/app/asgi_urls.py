@@ -0,0 +1,12 @@
+"""
+URLs of the ASGI deployment (app/asgi.py): the async catalog and cart views
+first, then everything in app.urls for the paths they don't cover.
+"""
+from django.urls import include, path
+
+from . import urls
+
+urlpatterns = [
+    path('store/', include('store.async_urls')),
+    *urls.urlpatterns,
+]
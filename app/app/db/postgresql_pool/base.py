@@ -0,0 +1,127 @@
+"""
+PostgreSQL backend that keeps a pool of connections per worker process.
+
+Use with ENGINE 'app.db.postgresql_pool' (DB_POOL=1). Django still "closes"
+its connection at the end of every request (CONN_MAX_AGE = 0), but close
+hands the psycopg2 connection back to the pool instead of hanging up, so the
+next request skips the TCP/TLS/auth handshake.
+
+    DB_POOL_SIZE        connections per worker (threads block beyond it)
+    DB_POOL_TIMEOUT     seconds to wait for a free connection
+    DB_POOL_PING_AFTER  connections idle longer than this are checked with
+                        SELECT 1 on checkout; dead ones (db restart,
+                        failover) are dropped and replaced transparently
+"""
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+from django.conf import settings
+from django.db import OperationalError
+from django.db.backends.postgresql import base
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+
+    def __init__(self, conn_params, size, timeout, ping_after):
+        self.size = size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._pool = psycopg2.pool.ThreadedConnectionPool(0, size, **conn_params)
+        self._slots = threading.BoundedSemaphore(size)
+        self._returned_at = {}
+
+    def checkout(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise OperationalError(
+                f'no database connection free within {self.timeout}s (DB_POOL_SIZE={self.size})')
+        try:
+            # at most `size` pooled connections can be stale, then a fresh
+            # connect either works or raises
+            for _ in range(self.size + 1):
+                connection = self._pool.getconn()
+                if self.healthy(connection):
+                    return connection
+                self._discard(connection)
+            raise OperationalError('could not get a healthy database connection')
+        except Exception:
+            self._slots.release()
+            raise
+
+    def healthy(self, connection):
+        if connection.closed:
+            return False
+        returned_at = self._returned_at.pop(id(connection), None)
+        if returned_at is None or time.monotonic() - returned_at < self.ping_after:
+            # just connected or recently used
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def checkin(self, connection, broken=False):
+        try:
+            if not broken and not connection.closed and \
+                    connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # never hand the next request an open transaction
+                connection.rollback()
+        except psycopg2.Error:
+            broken = True
+        close = broken or bool(connection.closed)
+        if not close:
+            self._returned_at[id(connection)] = time.monotonic()
+        try:
+            self._pool.putconn(connection, close=close)
+        finally:
+            self._slots.release()
+
+    def _discard(self, connection):
+        self._returned_at.pop(id(connection), None)
+        self._pool.putconn(connection, close=True)
+
+    def close(self):
+        self._pool.closeall()
+
+
+def get_pool(alias, conn_params):
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = ConnectionPool(
+                conn_params, size=settings.DB_POOL_SIZE,
+                timeout=settings.DB_POOL_TIMEOUT, ping_after=settings.DB_POOL_PING_AFTER)
+        return pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        connection = get_pool(self.alias, conn_params).checkout()
+
+        # same as the stock backend after psycopg2.connect()
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        psycopg2.extras.register_default_jsonb(conn_or_curs=connection, loads=lambda x: x)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            # errors during the request: only keep it if it still answers
+            broken = self.errors_occurred and not self.is_usable()
+            with self.wrap_database_errors:
+                get_pool(self.alias, None).checkin(self.connection, broken=broken)
@@ -0,0 +1,151 @@
+"""
+Read replicas with read-your-writes stickiness.
+
+settings.DATABASE_REPLICAS lists the replica aliases (DB_REPLICAS).
+ReplicaRouter only sends reads to one of them inside read_from(alias).
+That happens in views that opt in with ReplicaReadMixin: catalog
+list/retrieve and the staff order export. Every other read, and every
+write, goes to `default`. One replica is picked per request, so all reads
+of a request see the same snapshot.
+
+A client that just wrote stays on the primary for REPLICA_PIN_SECONDS, so
+replication lag never hides its own cart change or order.
+ReplicaPinMiddleware pins it after every successful unsafe request, in two
+ways:
+
+    - a cookie holding the pin's expiry, for anonymous carts and browsers
+    - a key in the shared cache, for JWT users (API clients that drop
+      cookies)
+"""
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.permissions import SAFE_METHODS
+
+from app.middleware import HybridMiddleware
+from app.ratelimit import jwt_user_id
+
+_read_alias = contextvars.ContextVar('read_alias', default=None)
+
+
+def choose_replica():
+    replicas = settings.DATABASE_REPLICAS
+    return random.choice(replicas) if replicas else None
+
+
+@contextmanager
+def read_from(alias):
+    """Route the reads in the block to `alias`, None for the primary"""
+    token = _read_alias.set(alias)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        # related objects come from wherever their instance was loaded
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {'default', *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def pin_key(user_id):
+    return f'db:pin:user:{user_id}'
+
+
+def pinned_by_cookie(request):
+    try:
+        return float(request.COOKIES[settings.REPLICA_PIN_COOKIE]) > time.time()
+    except (KeyError, ValueError):
+        return False
+
+
+def pin(request, response):
+    """Keep the client that made this write on the primary for a while"""
+    seconds = settings.REPLICA_PIN_SECONDS
+    # the expiry is in the value too, clients don't always honour max_age
+    response.set_cookie(settings.REPLICA_PIN_COOKIE, str(int(time.time()) + seconds),
+                        max_age=seconds, httponly=True, samesite='Lax',
+                        secure=request.is_secure())
+    user_id = jwt_user_id(request)
+    if user_id is not None:
+        cache.set(pin_key(user_id), 1, timeout=seconds)
+
+
+def is_write(request, response):
+    return (settings.DATABASE_REPLICAS and request.method not in SAFE_METHODS
+            and response.status_code < 400)
+
+
+class ReplicaPinMiddleware(HybridMiddleware):
+
+    def handle(self, request):
+        response = self.get_response(request)
+        if is_write(request, response):
+            pin(request, response)
+        return response
+
+    async def ahandle(self, request):
+        response = await self.get_response(request)
+        if is_write(request, response):
+            await sync_to_async(pin)(request, response)
+        return response
+
+
+class ReplicaReadMixin:
+    """
+    Viewset mixin: safe requests to `replica_actions` read from a replica,
+    unless the client is pinned to the primary.
+    """
+    replica_actions = ('list', 'retrieve')
+
+    def wants_replica(self, request):
+        return bool(settings.DATABASE_REPLICAS and request.method in SAFE_METHODS
+                    and self.action in self.replica_actions
+                    and not pinned_by_cookie(request))
+
+    def read_replica(self, request):
+        """Replica alias for this request's reads, None for the primary"""
+        if not self.wants_replica(request):
+            return None
+        if request.user.is_authenticated and cache.get(pin_key(request.user.pk)) is not None:
+            return None
+        return choose_replica()
+
+    async def aread_replica(self, request):
+        if not self.wants_replica(request):
+            return None
+        if request.user.is_authenticated and await cache.aget(pin_key(request.user.pk)) is not None:
+            return None
+        return choose_replica()
+
+    def initial(self, request, *args, **kwargs):
+        # after authentication and permissions, those read from the primary
+        super().initial(request, *args, **kwargs)
+        self._read_alias_token = _read_alias.set(self.read_replica(request))
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            token = self.__dict__.pop('_read_alias_token', None)
+            if token is not None:
+                _read_alias.reset(token)
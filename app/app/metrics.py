@@ -0,0 +1,373 @@
+"""
+Per-route request metrics, aggregated across uwsgi workers.
+
+MetricsMiddleware records, for every resolved route (url name such as
+`products-list` or `orders-detail`) and method:
+
+    - a latency histogram
+    - requests by status code
+    - SQL query count and SQL time
+    - time spent in DRF serializers (.data)
+    - response bytes
+
+Each worker keeps its numbers in memory and every METRICS_FLUSH_SECONDS
+writes them to METRICS_DIR/<host>/<pid>-<random id>.json, one file per
+process (a counter per request, no IPC); the id keeps a worker that reuses
+a dead one's pid from overwriting its file. The staff-only /metrics view
+adds up the files of every host and renders them in the Prometheus text
+format.
+
+Files of workers that are gone are folded into <host>/archive.json, so
+counters never go backwards and the directory doesn't grow with every
+restart. Liveness is checked by pid, so only a process of the same host
+(settings.METRICS_HOST) folds them: the scrape for its own host, and every
+worker for its host when it writes its first file. That is what lets the
+uwsgi and asgi containers share one METRICS_DIR volume, with a stable
+METRICS_HOST each.
+
+Serializer time is recorded by viewsets that mix in SerializerTimingMixin.
+"""
+import atexit
+import contextvars
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+
+from .middleware import HybridMiddleware, aexecute_wrapper, execute_wrapper
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SUMS = ('sql_queries', 'sql_seconds', 'serializer_seconds', 'response_bytes')
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """What one request accumulates while it runs"""
+    __slots__ = ('sql_queries', 'sql_seconds', 'serializer_seconds')
+
+    def __init__(self):
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.serializer_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_queries += 1
+            self.sql_seconds += time.perf_counter() - start
+
+
+class SerializerTimingMixin:
+    """
+    Viewset mixin: time the to_representation() of the serializers it hands
+    out (nested serializers included) into the request's metrics
+    """
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        metrics = _current.get()
+        if metrics is not None:
+            to_representation = serializer.to_representation
+
+            def timed(instance):
+                start = time.perf_counter()
+                try:
+                    return to_representation(instance)
+                finally:
+                    metrics.serializer_seconds += time.perf_counter() - start
+            # on this instance only
+            serializer.to_representation = timed
+        return serializer
+
+
+class Registry:
+    """This process's totals, keyed by 'route|method'"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = defaultdict(self._empty)
+        self.last_flush = time.monotonic()
+        self._pid = self._filename = None
+
+    def filename(self):
+        # a forked worker starts its own file
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._filename = f'{self._pid}-{uuid.uuid4().hex[:12]}.json'
+        return self._filename
+
+    @staticmethod
+    def _empty():
+        return {'count': 0, 'duration_sum': 0.0, 'buckets': [0] * len(BUCKETS),
+                'status': defaultdict(int), **{name: 0 for name in SUMS}}
+
+    def record(self, route, method, status, duration, metrics, size):
+        with self._lock:
+            stats = self.routes[f'{route}|{method}']
+            stats['count'] += 1
+            stats['duration_sum'] += duration
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    stats['buckets'][i] += 1
+                    break
+            stats['status'][str(status)] += 1
+            stats['sql_queries'] += metrics.sql_queries
+            stats['sql_seconds'] += metrics.sql_seconds
+            stats['serializer_seconds'] += metrics.serializer_seconds
+            stats['response_bytes'] += size
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'routes': json.loads(json.dumps(self.routes)),
+                'counters': process_counters(),
+            }
+
+    def flush(self):
+        directory = host_directory()
+        os.makedirs(directory, exist_ok=True)
+        started = self._pid != os.getpid()
+        write_json(os.path.join(directory, self.filename()), self.snapshot())
+        self.last_flush = time.monotonic()
+        if started:
+            # hosts without a /metrics of their own fold their dead workers here
+            fold_dead_workers(directory)
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush >= settings.METRICS_FLUSH_SECONDS:
+            self.flush()
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
+
+
+registry = Registry()
+
+ARCHIVE = 'archive.json'
+
+
+def host_directory():
+    return os.path.join(settings.METRICS_DIR, settings.METRICS_HOST)
+
+
+def write_json(path, data):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def worker_pid(filename):
+    """pid of a worker file (<pid>-<id>.json), None for other files"""
+    pid = filename.split('-', 1)[0].removesuffix('.json')
+    return int(pid) if filename.endswith('.json') and pid.isdigit() else None
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def process_counters():
+    """Cache counters kept by other modules, summed across workers as well"""
+    from store.cache import stats as catalog_stats
+    from user.authentication import user_cache
+
+    counters = {}
+    for name, source in (('catalog_cache', catalog_stats), ('auth_user_cache', user_cache)):
+        data = source.as_dict()
+        counters[f'{name}_hits'] = data['hits']
+        counters[f'{name}_misses'] = data['misses']
+    return counters
+
+
+class MetricsMiddleware(HybridMiddleware):
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        atexit.register(self.flush_at_exit)
+
+    def handle(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            with execute_wrapper(metrics):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.record(request, response, metrics, time.perf_counter() - start)
+        return response
+
+    async def ahandle(self, request):
+        if not settings.METRICS_ENABLED:
+            return await self.get_response(request)
+
+        # the contextvar is copied into sync_to_async threads, serializers
+        # running there are timed too
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            async with aexecute_wrapper(metrics):
+                response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.record(request, response, metrics, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    def record(request, response, metrics, duration):
+        match = request.resolver_match
+        route = match.url_name if match is not None and match.url_name else 'unresolved'
+        size = 0 if response.streaming else len(response.content)
+        registry.record(route, request.method, response.status_code, duration, metrics, size)
+        registry.maybe_flush()
+
+    @staticmethod
+    def flush_at_exit():
+        try:
+            registry.flush()
+        except OSError:
+            pass
+
+
+def add_snapshot(routes, counters, snapshot):
+    for key, stats in snapshot['routes'].items():
+        total = routes[key]
+        total['count'] += stats['count']
+        total['duration_sum'] += stats['duration_sum']
+        total['buckets'] = [a + b for a, b in zip(total['buckets'], stats['buckets'])]
+        for status, count in stats['status'].items():
+            total['status'][status] += count
+        for name in SUMS:
+            total[name] += stats[name]
+    for name, value in snapshot['counters'].items():
+        counters[name] += value
+
+
+def fold_dead_workers(directory):
+    """Add the files of workers that are gone to the archive and delete them"""
+    with open(os.path.join(directory, 'archive.lock'), 'a') as lock:
+        # one scrape at a time, or two could fold the same file
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead = [filename for filename in os.listdir(directory)
+                if (pid := worker_pid(filename)) is not None and not is_running(pid)]
+        if not dead:
+            return
+        routes, counters = defaultdict(Registry._empty), defaultdict(int)
+        archive = os.path.join(directory, ARCHIVE)
+        for path in [archive, *(os.path.join(directory, name) for name in dead)]:
+            snapshot = read_json(path)
+            if snapshot is not None:
+                add_snapshot(routes, counters, snapshot)
+        write_json(archive, {'routes': routes, 'counters': counters})
+        for filename in dead:
+            os.remove(os.path.join(directory, filename))
+
+
+def merged_snapshots():
+    """
+    All hosts' worker files and archives added up (this process is flushed
+    first)
+    """
+    registry.flush()
+    fold_dead_workers(host_directory())
+    routes = defaultdict(Registry._empty)
+    counters = defaultdict(int)
+    for host in sorted(os.listdir(settings.METRICS_DIR)):
+        directory = os.path.join(settings.METRICS_DIR, host)
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            if filename != ARCHIVE and worker_pid(filename) is None:
+                continue
+            snapshot = read_json(os.path.join(directory, filename))
+            if snapshot is not None:
+                add_snapshot(routes, counters, snapshot)
+    return routes, counters
+
+
+def _labels(**labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels.items())
+
+
+def render_prometheus(routes, counters):
+    prefix = 'ebuy'
+    lines = [
+        f'# HELP {prefix}_http_request_duration_seconds Request latency by route.',
+        f'# TYPE {prefix}_http_request_duration_seconds histogram',
+    ]
+    for key, stats in sorted(routes.items()):
+        route, method = key.split('|')
+        cumulative = 0
+        for bound, count in zip(BUCKETS, stats['buckets']):
+            cumulative += count
+            labels = _labels(route=route, method=method, le=bound)
+            lines.append(f'{prefix}_http_request_duration_seconds_bucket{{{labels}}} {cumulative}')
+        labels = _labels(route=route, method=method)
+        lines.append(f'{prefix}_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} '
+                     f'{stats["count"]}')
+        lines.append(f'{prefix}_http_request_duration_seconds_sum{{{labels}}} {stats["duration_sum"]}')
+        lines.append(f'{prefix}_http_request_duration_seconds_count{{{labels}}} {stats["count"]}')
+
+    lines += [f'# HELP {prefix}_http_requests_total Requests by route and status.',
+              f'# TYPE {prefix}_http_requests_total counter']
+    for key, stats in sorted(routes.items()):
+        route, method = key.split('|')
+        for status, count in sorted(stats['status'].items()):
+            labels = _labels(route=route, method=method, status=status)
+            lines.append(f'{prefix}_http_requests_total{{{labels}}} {count}')
+
+    for name, help_text in (
+            ('sql_queries', 'SQL queries run by requests.'),
+            ('sql_seconds', 'Time spent in SQL.'),
+            ('serializer_seconds', 'Time spent in DRF serializers.'),
+            ('response_bytes', 'Response body bytes (streamed responses excluded).')):
+        metric = f'{prefix}_http_{name}_total'
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+        for key, stats in sorted(routes.items()):
+            route, method = key.split('|')
+            lines.append(f'{metric}{{{_labels(route=route, method=method)}}} {stats[name]}')
+
+    for name, value in sorted(counters.items()):
+        metric = f'{prefix}_{name}_total'
+        lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+    return '\n'.join(lines) + '\n'
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics_view(request):
+    routes, counters = merged_snapshots()
+    return HttpResponse(render_prometheus(routes, counters),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
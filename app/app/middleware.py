@@ -0,0 +1,61 @@
+"""
+Base for project middleware that wraps the whole request (timers,
+connection.execute_wrapper, ...) and runs natively under WSGI and ASGI.
+
+Django's MiddlewareMixin only covers process_request/process_response
+hooks. A sync-only middleware anywhere in MIDDLEWARE makes Django run every
+async view (store/async_views.py) in a thread, which undoes the point.
+"""
+import asyncio
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+
+
+class HybridMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # same marker MiddlewareMixin sets, so Django's handler awaits us
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        else:
+            self._is_coroutine = None
+
+    def __call__(self, request):
+        if self._is_coroutine:
+            return self.ahandle(request)
+        return self.handle(request)
+
+    def handle(self, request):
+        raise NotImplementedError
+
+    async def ahandle(self, request):
+        raise NotImplementedError
+
+
+@contextmanager
+def execute_wrapper(wrapper):
+    """connection.execute_wrapper() on every database, replicas included"""
+    with ExitStack() as stack:
+        for conn in connections.all():
+            stack.enter_context(conn.execute_wrapper(wrapper))
+        yield
+
+
+@asynccontextmanager
+async def aexecute_wrapper(wrapper):
+    """
+    execute_wrapper() for async code. Connections are per thread and the
+    async ORM queries from the request's sync_to_async thread, so the wrapper
+    goes on that thread's connections, not the event loop's.
+    """
+    stack = ExitStack()
+    await sync_to_async(lambda: stack.enter_context(execute_wrapper(wrapper)))()
+    try:
+        yield
+    finally:
+        await sync_to_async(stack.close)()
@@ -0,0 +1,158 @@
+"""
+N+1 / duplicate / slow query detector, opt-in for staging.
+
+With QUERY_INSPECTOR_ENABLED, QueryInspectorMiddleware watches every SQL
+statement of a request and groups them by template (literals and IN
+lists collapsed). After the response it reports:
+
+    n_plus_one   a template run more than QUERY_INSPECTOR_THRESHOLD times,
+                 with the app frame and the DRF serializer field that ran it
+    duplicate    the very same statement and params run more than once
+                 (logged as the template and a hash of the params, which
+                 may hold emails, tokens or password hashes)
+    slow_query   a statement over QUERY_INSPECTOR_SLOW_MS
+
+as one JSON log line each on the `app.query_inspector` logger, plus an
+`X-Query-Inspector` summary header (and `X-Query-NPlusOne` naming the
+culprits) so it shows up in the browser/devtools on normal traffic.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+from django.conf import settings
+from rest_framework.fields import Field
+
+from .middleware import HybridMiddleware, aexecute_wrapper, execute_wrapper
+
+logger = logging.getLogger(__name__)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN \((?:\s*\?\s*,)*\s*\?\s*\)', re.IGNORECASE)
+_SPACE = re.compile(r'\s+')
+
+# frames from these are not "where the query came from": libraries, and the
+# project package itself (this module, the metrics wrapper, middleware)
+_SKIP_PATHS = tuple({os.path.dirname(os.path.dirname(module.__file__))
+                     for module in (sys.modules['django'], sys.modules['rest_framework'])} |
+                    {os.path.dirname(__file__) + os.sep})
+
+
+def normalize(sql):
+    """Template of a statement: literals and placeholders -> ?, IN lists -> IN (...)"""
+    sql = _STRING.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+def find_origin():
+    """(first app frame 'file:line in func', innermost serializer field) of the running query"""
+    frame = sys._getframe(2)
+    app_frame = serializer_field = None
+    project_root = str(settings.BASE_DIR)
+    while frame is not None and (app_frame is None or serializer_field is None):
+        code = frame.f_code
+        filename = code.co_filename
+        if app_frame is None and filename.startswith(project_root) \
+                and not filename.startswith(_SKIP_PATHS):
+            app_frame = f'{os.path.relpath(filename, project_root)}:{frame.f_lineno} in {code.co_name}'
+        if serializer_field is None and code.co_name == 'to_representation':
+            field = frame.f_locals.get('field')
+            if isinstance(field, Field) and field.parent is not None:
+                serializer_field = f'{type(field.parent).__name__}.{field.field_name}'
+        frame = frame.f_back
+    return app_frame, serializer_field
+
+
+class QueryLog:
+    """connection.execute_wrapper collecting a request's statements"""
+
+    def __init__(self):
+        self.count = 0
+        self.templates = Counter()
+        self.statements = Counter()
+        self.origins = {}
+        self.slow = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.count += 1
+            template = normalize(sql)
+            self.templates[template] += 1
+            self.statements[(sql, repr(params))] += 1
+            if template not in self.origins:
+                self.origins[template] = find_origin()
+            if elapsed_ms >= settings.QUERY_INSPECTOR_SLOW_MS:
+                self.slow.append((elapsed_ms, sql, self.origins[template]))
+
+
+class QueryInspectorMiddleware(HybridMiddleware):
+
+    def handle(self, request):
+        if not settings.QUERY_INSPECTOR_ENABLED:
+            return self.get_response(request)
+
+        log = QueryLog()
+        with execute_wrapper(log):
+            response = self.get_response(request)
+        self.report(request, response, log)
+        return response
+
+    async def ahandle(self, request):
+        if not settings.QUERY_INSPECTOR_ENABLED:
+            return await self.get_response(request)
+
+        log = QueryLog()
+        async with aexecute_wrapper(log):
+            response = await self.get_response(request)
+        self.report(request, response, log)
+        return response
+
+    def report(self, request, response, log):
+        where = {'method': request.method, 'path': request.path}
+        threshold = settings.QUERY_INSPECTOR_THRESHOLD
+
+        n_plus_one = []
+        for template, count in log.templates.most_common():
+            if count <= threshold:
+                break
+            frame, field = log.origins[template]
+            n_plus_one.append((field or frame or '?', count))
+            self.log('n_plus_one', where, template=template, count=count,
+                     frame=frame, serializer_field=field)
+
+        duplicates = 0
+        for (sql, params), count in log.statements.items():
+            if count > 1:
+                duplicates += 1
+                template = normalize(sql)
+                self.log('duplicate', where, template=template,
+                         params_hash=hashlib.sha1(params.encode()).hexdigest()[:12],
+                         count=count, frame=log.origins[template][0])
+
+        for elapsed_ms, sql, (frame, field) in log.slow:
+            self.log('slow_query', where, ms=round(elapsed_ms, 2), sql=sql,
+                     frame=frame, serializer_field=field)
+
+        response['X-Query-Inspector'] = (
+            f'queries={log.count} n+1={len(n_plus_one)} '
+            f'duplicates={duplicates} slow={len(log.slow)}')
+        if n_plus_one:
+            response['X-Query-NPlusOne'] = ', '.join(
+                f'{origin} x{count}' for origin, count in n_plus_one)
+
+    @staticmethod
+    def log(event, where, **data):
+        logger.warning(json.dumps({'event': event, **where, **data}, default=str))
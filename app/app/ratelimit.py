@@ -0,0 +1,162 @@
+"""
+Sliding-window rate limiting shared by all uwsgi workers.
+
+RateLimitMiddleware checks every request against settings.RATELIMITS
+before the view runs, so a throttled request never reaches the database.
+State lives in the cache named by settings.RATELIMIT_CACHE; point it at a
+backend every worker shares (memcached in docker-compose-deploy.yml), a
+LocMemCache only limits per process.
+
+Each rule counts requests per client in fixed windows and estimates the
+sliding window as
+
+    current window count + previous window count * unexpired fraction
+
+which needs two counters per client and atomic cache.incr() only.
+
+A rule looks like:
+
+    {'name': 'checkout', 'path': r'^/store/orders/?$', 'methods': ['POST'],
+     'params': [], 'rate': '10/m', 'by': 'user_or_ip'}
+
+`params`: only count requests carrying one of these query params.
+`by`: 'ip', or 'user_or_ip' to count authenticated clients by the user id
+in their JWT (decoded without a query) and everyone else by IP.
+"""
+import math
+import re
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+
+from .middleware import HybridMiddleware
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """'100/m' -> (100, 60); '5/10s' -> (5, 10)"""
+    match = re.fullmatch(r'(\d+)/(\d*)([smhd])', rate)
+    if match is None:
+        raise ValueError(f'Invalid rate {rate!r}')
+    count, multiplier, unit = match.groups()
+    return int(count), int(multiplier or 1) * UNITS[unit]
+
+
+class Rule:
+
+    def __init__(self, name, path, rate, methods=None, params=None, by='user_or_ip'):
+        self.name = name
+        self.path = re.compile(path)
+        self.limit, self.window = parse_rate(rate)
+        self.methods = {method.upper() for method in methods or []}
+        self.params = list(params or [])
+        self.by = by
+
+    def matches(self, request):
+        if self.methods and request.method not in self.methods:
+            return False
+        if self.params and not any(request.GET.get(param) for param in self.params):
+            return False
+        return self.path.search(request.path_info) is not None
+
+
+class SlidingWindowLimiter:
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def hit(self, key, limit, window, now=None):
+        """Count one request, returns (allowed, seconds until the next slot)"""
+        now = time.time() if now is None else now
+        index, elapsed = divmod(now, window)
+        current = f'ratelimit:{key}:{int(index)}'
+        previous = f'ratelimit:{key}:{int(index) - 1}'
+
+        self.cache.add(current, 0, timeout=window * 2)
+        try:
+            count = self.cache.incr(current)
+        except ValueError:
+            # expired between add() and incr()
+            self.cache.set(current, 1, timeout=window * 2)
+            count = 1
+        weight = 1 - elapsed / window
+        estimate = (self.cache.get(previous) or 0) * weight + count
+        if estimate <= limit:
+            return True, 0
+        return False, max(1, math.ceil(window - elapsed))
+
+
+def client_ip(request):
+    # nginx passes the client address as REMOTE_ADDR (uwsgi_params)
+    return request.META.get('REMOTE_ADDR', '')
+
+
+_jwt = JWTAuthentication()
+
+
+def jwt_user_id(request):
+    """User id from a valid Authorization: JWT header, without a db lookup"""
+    header = _jwt.get_header(request)
+    if header is None:
+        return None
+    raw = _jwt.get_raw_token(header)
+    if raw is None:
+        return None
+    try:
+        return _jwt.get_validated_token(raw).get(api_settings.USER_ID_CLAIM)
+    except (InvalidToken, TokenError):
+        return None
+
+
+class RateLimitMiddleware(HybridMiddleware):
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.rules = [Rule(**rule) for rule in settings.RATELIMITS]
+        self.limiter = SlidingWindowLimiter(caches[settings.RATELIMIT_CACHE])
+
+    def handle(self, request):
+        if settings.RATELIMIT_ENABLED:
+            rules = [rule for rule in self.rules if rule.matches(request)]
+            if rules:
+                response = self.check(request, rules)
+                if response is not None:
+                    return response
+        return self.get_response(request)
+
+    async def ahandle(self, request):
+        if settings.RATELIMIT_ENABLED:
+            rules = [rule for rule in self.rules if rule.matches(request)]
+            if rules:
+                # blocking cache round trips, keep them off the event loop
+                response = await sync_to_async(self.check)(request, rules)
+                if response is not None:
+                    return response
+        return await self.get_response(request)
+
+    def client_key(self, request, rule, user_id):
+        if rule.by == 'user_or_ip' and user_id is not None:
+            return f'user:{user_id}'
+        return f'ip:{client_ip(request)}'
+
+    def check(self, request, rules):
+        user_id = None
+        if any(rule.by == 'user_or_ip' for rule in rules):
+            user_id = jwt_user_id(request)
+        for rule in rules:
+            key = f'{rule.name}:{self.client_key(request, rule, user_id)}'
+            allowed, retry_after = self.limiter.hit(key, rule.limit, rule.window)
+            if not allowed:
+                response = JsonResponse(
+                    {'detail': f'Request was throttled. Expected available in {retry_after} seconds.'},
+                    status=429)
+                response['Retry-After'] = str(retry_after)
+                return response
+        return None
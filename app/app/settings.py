@@ -11,7 +11,10 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
 from pathlib import Path
+from decimal import Decimal
 import os
+import socket
+import tempfile
 from datetime import timedelta
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -81,9 +84,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so its latency covers the whole stack
+    'app.metrics.MetricsMiddleware',
+    # off unless QUERY_INSPECTOR_ENABLED (staging)
+    'app.query_inspector.QueryInspectorMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    # before anything that may touch the database
+    'app.ratelimit.RateLimitMiddleware',
+    # pins a client that just wrote to the primary database
+    'app.db.replicas.ReplicaPinMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -91,7 +102,8 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'app.urls'
+# app/asgi.py sets app.asgi_urls (async catalog and cart views)
+ROOT_URLCONF = os.environ.get('ROOT_URLCONF', 'app.urls')
 
 TEMPLATES = [
     {
@@ -115,16 +127,105 @@ WSGI_APPLICATION = 'app.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# DB_POOL=1 keeps a pool of connections per worker (app/db/postgresql_pool),
+# otherwise connections persist for CONN_MAX_AGE seconds. Both check a
+# reused connection before handing it to a request.
+DB_POOL = bool(int(os.environ.get('DB_POOL', 0)))
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', 30))
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': os.environ.get(
+            'DB_ENGINE', 'app.db.postgresql_pool' if DB_POOL else 'django.db.backends.postgresql'),
         'HOST': os.environ.get('DB_HOST'),
         'NAME': os.environ.get('DB_NAME'),
         'USER': os.environ.get('DB_USER'),
         'PASSWORD': os.environ.get('DB_PASS'),
+        # the pool replaces persistent connections
+        'CONN_MAX_AGE': 0 if DB_POOL else int(os.environ.get('CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': bool(int(os.environ.get('CONN_HEALTH_CHECKS', 1))),
+    }
+}
+
+# Read replicas (app/db/replicas.py), comma separated: hosts sharing the
+# primary's name and credentials, or database files with SQLite. Catalog
+# reads and staff order reports go to them; writes and everything else, and
+# a client that just wrote for REPLICA_PIN_SECONDS, stay on `default`.
+DATABASE_REPLICAS = []
+for number, replica in enumerate(filter(None, os.environ.get('DB_REPLICAS', '').split(',')), 1):
+    location = 'NAME' if 'sqlite' in DATABASES['default']['ENGINE'] else 'HOST'
+    DATABASES[f'replica_{number}'] = {**DATABASES['default'], location: replica}
+    DATABASE_REPLICAS.append(f'replica_{number}')
+
+DATABASE_ROUTERS = ['app.db.replicas.ReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 10))
+REPLICA_PIN_COOKIE = 'primary_until'
+
+
+# Cache
+# Local-memory by default; point CACHE_BACKEND at the file-based (or a
+# shared) backend so all uwsgi workers see the same catalog version.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'ebuy'),
     }
 }
 
+# Seconds an anonymous product/category response stays cached
+CATALOG_CACHE_TIMEOUT = int(os.environ.get('CATALOG_CACHE_TIMEOUT', 300))
+
+# Per-route limits enforced by app.ratelimit.RateLimitMiddleware. The
+# cache must be shared by all uwsgi workers (memcached in deploy).
+RATELIMIT_ENABLED = bool(int(os.environ.get('RATELIMIT_ENABLED', 1)))
+RATELIMIT_CACHE = 'default'
+RATELIMITS = [
+    {'name': 'product-search', 'path': r'^/store/products/?$', 'methods': ['GET'],
+     'params': ['search'], 'rate': os.environ.get('RATELIMIT_SEARCH', '60/m')},
+    {'name': 'checkout', 'path': r'^/store/orders/?$', 'methods': ['POST'],
+     'rate': os.environ.get('RATELIMIT_CHECKOUT', '10/m')},
+    {'name': 'auth', 'path': r'^/auth/(jwt/(create|refresh)|users)/?$', 'methods': ['POST'],
+     'rate': os.environ.get('RATELIMIT_AUTH', '20/m'), 'by': 'ip'},
+    {'name': 'api', 'path': r'^/(store|user|auth)/',
+     'rate': os.environ.get('RATELIMIT_API', '600/m')},
+]
+
+# Per-route metrics (app/metrics.py): every worker writes its totals to
+# METRICS_DIR/METRICS_HOST, the staff-only /metrics endpoint adds up all
+# hosts. Containers share METRICS_DIR through a volume, each with its own
+# METRICS_HOST (worker liveness is checked by pid, per host)
+METRICS_ENABLED = bool(int(os.environ.get('METRICS_ENABLED', 1)))
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'ebuy-metrics'))
+METRICS_HOST = os.environ.get('METRICS_HOST', socket.gethostname())
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+
+# N+1 / duplicate / slow query reports (app/query_inspector.py), for staging
+QUERY_INSPECTOR_ENABLED = bool(int(os.environ.get('QUERY_INSPECTOR_ENABLED', 0)))
+# flag a query template run more than this many times in one request
+QUERY_INSPECTOR_THRESHOLD = int(os.environ.get('QUERY_INSPECTOR_THRESHOLD', 5))
+QUERY_INSPECTOR_SLOW_MS = float(os.environ.get('QUERY_INSPECTOR_SLOW_MS', 100))
+
+# Serve product list/detail from .values() rows instead of ProductSerializer
+# (store/fastpath.py); same JSON, opt in with CATALOG_FAST_SERIALIZATION=1
+CATALOG_FAST_SERIALIZATION = bool(int(os.environ.get('CATALOG_FAST_SERIALIZATION', 0)))
+
+
+# Tax applied to products whose category has no tax_rate of its own
+DEFAULT_TAX_RATE = Decimal(os.environ.get('DEFAULT_TAX_RATE', '0.10'))
+
+# Carts older than this are deleted by the sweep_carts command
+CART_TTL_DAYS = float(os.environ.get('CART_TTL_DAYS', 7))
+
+# store.OrderItem uses a covering (INCLUDE) index; SQLite, used for the
+# test suite, just ignores the non-key columns
+SILENCED_SYSTEM_CHECKS = ['models.W040']
+
+# Largest table check_query_plans lets a representative query seq-scan
+QUERY_PLAN_SEQ_SCAN_ROWS = int(os.environ.get('QUERY_PLAN_SEQ_SCAN_ROWS', 1000))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -166,6 +267,17 @@ MEDIA_URL = '/static/media/'
 MEDIA_ROOT = '/vol/web/media'
 STATIC_ROOT = '/vol/web/static'
 
+# Product/category images are stored by content hash (store/storage.py),
+# nginx serves those URLs as immutable
+IMAGE_STORAGE = os.environ.get('IMAGE_STORAGE', 'store.storage.ContentAddressedStorage')
+
+# Widths (px) of the resized copies generated for product/category images
+IMAGE_DERIVATIVE_WIDTHS = [160, 480, 960]
+# Resize new uploads in the upload request (after its commit), which adds
+# every resize + encode to that response's latency. Set 0 to leave it to the
+# `generate_image_derivatives --loop` worker; the srcset is empty until then.
+IMAGE_DERIVATIVES_ON_UPLOAD = bool(int(os.environ.get('IMAGE_DERIVATIVES_ON_UPLOAD', 1)))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
@@ -173,12 +285,21 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
 # Email
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
-EMAIL_HOST = 'smtp.gmail.com'
-EMAIL_PORT = 587
+# Emails are queued in the user.OutboxEmail table and sent by the
+# send_outbox command through OUTBOX_EMAIL_BACKEND
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'user.outbox.OutboxEmailBackend')
+OUTBOX_EMAIL_BACKEND = os.environ.get(
+    'OUTBOX_EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+# first retry delay, doubled on every further attempt (capped at an hour)
+OUTBOX_BACKOFF_SECONDS = int(os.environ.get('OUTBOX_BACKOFF_SECONDS', 30))
+# a claimed batch is retried by another worker if not done within this
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', 300))
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'smtp.gmail.com')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
-EMAIL_USE_TLS = True
+EMAIL_USE_TLS = bool(int(os.environ.get('EMAIL_USE_TLS', 1)))
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
 
@@ -188,10 +309,14 @@ AUTH_USER_MODEL = 'user.user'
 REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'user.authentication.CachedJWTAuthentication',
     ),
 }
 
+# Per-worker cache of authenticated users (user/authentication.py)
+AUTH_USER_CACHE_SIZE = int(os.environ.get('AUTH_USER_CACHE_SIZE', 10000))
+AUTH_USER_CACHE_TTL = int(os.environ.get('AUTH_USER_CACHE_TTL', 300))
+
 # custom domain for send djosor verification link !
 DOMAIN = 'localhost:3000'
 SITE_NAME = 'EBuy'
@@ -227,6 +352,11 @@ SIMPLE_JWT = {
     'BLACKLIST_AFTER_ROTATION': True,
 }
 
+# Revoked refresh tokens (user/revocation.py): per-worker Bloom filter size
+# and how often (seconds) it is rebuilt and expired rows pruned
+REVOKED_TOKEN_BLOOM_CAPACITY = int(os.environ.get('REVOKED_TOKEN_BLOOM_CAPACITY', 1000000))
+REVOKED_TOKEN_BLOOM_REFRESH = int(os.environ.get('REVOKED_TOKEN_BLOOM_REFRESH', 600))
+
 
 JAZZMIN_SETTINGS = {
     # title of the window (Will default to current_admin_site.site_title if absent or None)
@@ -14,16 +14,22 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+from user.views import TokenRefreshView
+from app.metrics import metrics_view
 from django.conf.urls.static import static
 from django.conf import settings
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    # before djoser's jwt urls: refresh revokes the rotated token
+    re_path(r'^auth/jwt/refresh/?$', TokenRefreshView.as_view(), name='jwt-refresh'),
     path('auth/', include('djoser.urls')),
     path('auth/', include('djoser.urls.jwt')),
     path('user/', include('user.urls')),
     path('store/', include('store.urls')),
+    # Prometheus text format, staff only
+    path('metrics', metrics_view, name='metrics'),
     
 ]
 
@@ -1,8 +1,8 @@
 from django.contrib import admin
 from django.urls import reverse
 from django.utils.html import format_html, urlencode
-from django.db.models import Count
 from . import models
+from .images import thumbnail_url
 from typing import Sequence
 # Register your models here.
 
@@ -13,7 +13,8 @@ class ProductImageInline(admin.TabularInline):
 
     def thumbnail(self, instance):
         if instance.image.name != '':
-            return format_html(f'<img src="{instance.image.url}" class="thumbnail">')
+            return format_html('<img src="{}" class="thumbnail">',
+                               thumbnail_url(instance.image, instance.derivatives))
         return ''
 
     class Media:
@@ -29,7 +30,8 @@ class CategoryImageInline(admin.StackedInline):
 
     def thumbnail(self, instance):
         if instance.image.name != '':
-            return format_html(f'<img src="{instance.image.url}" class="thumbnail">')
+            return format_html('<img src="{}" class="thumbnail">',
+                               thumbnail_url(instance.image, instance.derivatives))
         return ''
 
 
@@ -51,12 +53,11 @@ class Product(admin.ModelAdmin):
 @admin.register(models.Category)
 class categoryAdmin(admin.ModelAdmin):
     """
-    Actually we don't have product_count 
-    field in our database , so we just 
-    create a method for display product count,
-    : category table does't have that field 
-    since we annotate that field by overriding
-    get_queryset method in ModelAdmin class
+    product_count is a denormalized column on
+    Category kept up to date by store.signals,
+    so the changelist doesn't aggregate the
+    product table; the method below only turns
+    it into a link to the filtered products.
 
     """
     list_display = ['title', 'product_count']
@@ -74,12 +75,6 @@ class categoryAdmin(admin.ModelAdmin):
 
         return format_html(f'<a href="{url}">{category.product_count}</a>')
 
-    # overriding get_queryset method from ModelAdmin class for calculate count of product in a category
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(
-            product_count=Count('products')
-        )
-
 
 class OrderItemInline(admin.TabularInline):
     model = models.OrderItem
@@ -0,0 +1,18 @@
+"""
+Async catalog and cart reads (store/async_views.py) for the ASGI
+deployment, on the same paths and url names as the router in urls.py.
+"""
+from django.urls import re_path
+
+from . import async_views
+
+urlpatterns = [
+    re_path(r'^products/$', async_views.product_list, name='products-list'),
+    re_path(r'^products/(?P<pk>[^/.]+)/$', async_views.product_detail, name='products-detail'),
+    re_path(r'^categories/$', async_views.category_list, name='categories-list'),
+    re_path(r'^carts/(?P<pk>[^/.]+)/$', async_views.cart_detail, name='carts-detail'),
+    re_path(r'^carts/(?P<cart_pk>[^/.]+)/items/$', async_views.cart_item_list,
+            name='cart-items-list'),
+    re_path(r'^carts/(?P<cart_pk>[^/.]+)/items/(?P<pk>[^/.]+)/$', async_views.cart_item_detail,
+            name='cart-items-detail'),
+]
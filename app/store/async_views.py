@@ -0,0 +1,210 @@
+"""
+Async versions of the read-heavy catalog and cart endpoints, for the ASGI
+deployment (app/asgi.py routes them through store/async_urls.py).
+
+Same URLs and the same bytes as the DRF viewsets: each view sets up the
+viewset the router would have run (authentication, content negotiation,
+queryset, filters, pagination) and fetches its rows with the async ORM,
+behind the same catalog cache and conditional GET. A slow client or a slow
+query then parks a coroutine instead of a whole uwsgi worker. Products are
+always built with store.fastpath, whose output the tests check byte for
+byte against the serializers.
+
+Only GETs that end in a 200 (or 304) are answered here. Writes, the
+browsable API and every error (401, 404, bad filters or cursors) fall back
+to the DRF view in a thread, which answers exactly as under uwsgi. Django
+4.1 has no async transactions, so the cart item writes stay sync anyway.
+"""
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from app.db.replicas import ReplicaReadMixin, read_from
+
+from . import urls
+from .cache import acatalog_cache_key, aget_or_build
+from .conditional import aget_validators, set_validators
+from .fastpath import aproduct_dicts, product_values
+
+
+class Fallback(Exception):
+    """Let the DRF view answer this request"""
+
+
+def router_view(name):
+    # the router's own view, so the method -> action mapping is the same
+    for pattern in urls.urlpatterns:
+        if pattern.name == name:
+            return pattern.callback
+    raise LookupError(name)
+
+
+def async_view(name):
+    """
+    Async GET handler for route `name` of store/urls.py. The handler gets the
+    set up viewset instance and the url kwargs; everything it can't answer
+    runs the DRF view in a thread.
+    """
+    callback = router_view(name)
+    fallback = sync_to_async(callback)
+
+    def decorator(handler):
+        @wraps(handler)
+        async def view(request, *args, **kwargs):
+            if request.method == 'GET':
+                try:
+                    view_instance = await setup(callback, request, kwargs)
+                    with read_from(await read_replica(view_instance)):
+                        return await handler(view_instance, **kwargs)
+                # ValidationError / ValueError: lookup values the field can't take
+                except (Fallback, APIException, Http404, ValidationError, ValueError):
+                    pass
+            return await fallback(request, *args, **kwargs)
+        view.csrf_exempt = True
+        return view
+    return decorator
+
+
+async def setup(callback, request, kwargs):
+    """The viewset instance `callback` would run, up to the point the handler is called"""
+    view = callback.cls(**callback.initkwargs)
+    view.action_map = callback.actions
+    # the method handlers as_view() binds, they make the Allow header
+    for method, action in callback.actions.items():
+        setattr(view, method, getattr(view, action))
+    if hasattr(view, 'get') and not hasattr(view, 'head'):
+        view.head = view.get
+    view.args, view.kwargs = (), kwargs
+    view.format_kwarg = None
+    view.headers = view.default_response_headers
+    view.request = request = view.initialize_request(request)
+
+    if 'HTTP_AUTHORIZATION' in request.META:
+        # the JWT user may not be in the user cache yet
+        await sync_to_async(lambda: request.user)()
+    view.check_permissions(request)
+
+    renderer, media_type = view.perform_content_negotiation(request)
+    if not isinstance(renderer, JSONRenderer):
+        raise Fallback
+    request.accepted_renderer, request.accepted_media_type = renderer, media_type
+    return view
+
+
+async def read_replica(view):
+    # ReplicaReadMixin.initial(), which the handlers skip
+    if isinstance(view, ReplicaReadMixin):
+        return await view.aread_replica(view.request)
+    return None
+
+
+def render(view, response):
+    """
+    Finalize `response` as the DRF view would and hand Django a rendered
+    plain HttpResponse (it would render a DRF Response in a thread)
+    """
+    response = view.finalize_response(view.request, response)
+    if not isinstance(response, Response):
+        return response
+    response.render()
+    rendered = HttpResponse(response.content, status=response.status_code)
+    for header, value in response.items():
+        rendered[header] = value
+    return rendered
+
+
+async def catalog_response(view, build, queryset=None):
+    """
+    ConditionalGetMixin (when `queryset` is given) and CatalogCacheMixin
+    around `build`, a coroutine returning the response data
+    """
+    request = view.request
+    etag = last_modified = None
+    if queryset is not None:
+        etag, last_modified = await aget_validators(
+            queryset, view.last_modified_field, request.accepted_renderer.format)
+        if etag is not None:
+            not_modified = get_conditional_response(
+                request, etag=etag, last_modified=last_modified)
+            if not_modified is not None:
+                return render(view, not_modified)
+
+    if request.user and request.user.is_authenticated:
+        data, hit = await build(), None
+    else:
+        prefix = view.catalog_cache_prefix or view.basename
+        key = await acatalog_cache_key(f'{prefix}:{view.action}', request, etag)
+        data, hit = await aget_or_build(key, build)
+
+    response = render(view, Response(data))
+    if hit is not None:
+        response['X-Cache'] = 'HIT' if hit else 'MISS'
+    if etag is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+@async_view('products-list')
+async def product_list(view):
+    # filter backends may query (ModelChoiceFilter validation, building the
+    # in-memory search index), so they run in a thread
+    queryset = await sync_to_async(view.filter_queryset)(view.get_queryset())
+
+    async def build():
+        page = await view.paginator.apaginate_queryset(
+            product_values(queryset), view.request, view)
+        return view.get_paginated_response(await aproduct_dicts(page, view.request)).data
+
+    return await catalog_response(view, build, queryset)
+
+
+@async_view('products-detail')
+async def product_detail(view, pk):
+    queryset = view.get_queryset().filter(**{view.lookup_field: pk})
+
+    async def build():
+        rows = [row async for row in product_values(queryset)]
+        if not rows:
+            raise Http404
+        return (await aproduct_dicts(rows, view.request))[0]
+
+    return await catalog_response(view, build, queryset)
+
+
+@async_view('categories-list')
+async def category_list(view):
+
+    async def build():
+        # images are prefetched, the serializer doesn't query
+        categories = [category async for category in view.filter_queryset(view.get_queryset())]
+        return view.get_serializer(categories, many=True).data
+
+    return await catalog_response(view, build)
+
+
+@async_view('carts-detail')
+async def cart_detail(view, pk):
+    cart = await view.get_queryset().filter(pk=pk).afirst()
+    if cart is None:
+        raise Http404
+    return render(view, Response(view.get_serializer(cart).data))
+
+
+@async_view('cart-items-list')
+async def cart_item_list(view, cart_pk):
+    items = [item async for item in view.filter_queryset(view.get_queryset())]
+    return render(view, Response(view.get_serializer(items, many=True).data))
+
+
+@async_view('cart-items-detail')
+async def cart_item_detail(view, cart_pk, pk):
+    item = await view.filter_queryset(view.get_queryset()).filter(pk=pk).afirst()
+    if item is None:
+        raise Http404
+    return render(view, Response(view.get_serializer(item).data))
@@ -0,0 +1,56 @@
+"""
+Small helpers shared by the bench_* management commands.
+"""
+import time
+from contextlib import contextmanager
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (0 when empty)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def latency_summary(seconds):
+    """p50/p95/p99/max of a list of durations, in milliseconds"""
+    return {
+        'p50': percentile(seconds, 50) * 1000,
+        'p95': percentile(seconds, 95) * 1000,
+        'p99': percentile(seconds, 99) * 1000,
+        'max': max(seconds, default=0) * 1000,
+    }
+
+
+def format_latency(label, seconds):
+    summary = latency_summary(seconds)
+    return (f'{label:<24} n={len(seconds):<6} ' +
+            '  '.join(f'{key}={value:8.2f}ms' for key, value in summary.items()))
+
+
+class QueryCounter:
+    """connection.execute_wrapper that counts statements and their time"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+@contextmanager
+def timer(results):
+    """Append the duration of the block (seconds) to `results`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        results.append(time.perf_counter() - start)
@@ -0,0 +1,242 @@
+"""
+Versioned response cache for the catalog (products and categories).
+
+Every cache key embeds the current catalog version, so bumping the version
+on any catalog write makes all older entries unreachable at once; they just
+age out of the backend. Works on any Django cache backend (locmem, file,
+memcached, ...), configured through settings.CACHES.
+
+Misses are built from the request's read replica (app/db/replicas.py),
+except for REPLICA_PIN_SECONDS after a version bump: a replica still behind
+that write would get its old rows cached under the new version. That is
+the same lag bound that pins a writing client to the primary.
+
+Views with ETags (ConditionalGetMixin) also fold the response's ETag into
+the key. Stock changes at checkout only touch the bought products'
+last_update, which changes the ETag of the responses showing them, so they
+drop just those entries instead of bumping the version for the whole
+catalog.
+
+The a* functions are the same for the async views (store/async_views.py),
+through the cache's async API.
+"""
+import asyncio
+import hashlib
+import threading
+import time
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+from app.db.replicas import read_from
+
+CATALOG_VERSION_KEY = 'store:catalog:version'
+# present for REPLICA_PIN_SECONDS after each bump
+CATALOG_BUMPED_KEY = 'store:catalog:bumped'
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # Seed from the clock so a version evicted from the backend never
+        # restarts below a number that older entries were stored under.
+        cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+async def aget_catalog_version():
+    version = await cache.aget(CATALOG_VERSION_KEY)
+    if version is None:
+        await cache.aadd(CATALOG_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = await cache.aget(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        get_catalog_version()
+    if settings.DATABASE_REPLICAS:
+        cache.set(CATALOG_BUMPED_KEY, 1, timeout=settings.REPLICA_PIN_SECONDS)
+
+
+def build_database(recently_bumped):
+    """Where a miss is built: the request's replica, or the primary right after a bump"""
+    return read_from(None) if recently_bumped else nullcontext()
+
+
+class CatalogCacheStats:
+    """Per-process hit/miss counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+stats = CatalogCacheStats()
+
+
+def _cache_key(version, prefix, request, etag):
+    # Query params are sorted so ?a=1&b=2 and ?b=2&a=1 share an entry
+    params = sorted(request.query_params.lists())
+    raw = f'{request.path}?{params}:{etag}'.encode()
+    digest = hashlib.sha1(raw).hexdigest()
+    return f'store:catalog:{version}:{prefix}:{digest}'
+
+
+def catalog_cache_key(prefix, request, etag=None):
+    return _cache_key(get_catalog_version(), prefix, request, etag)
+
+
+async def acatalog_cache_key(prefix, request, etag=None):
+    return _cache_key(await aget_catalog_version(), prefix, request, etag)
+
+
+def get_or_build(key, build):
+    """
+    Return the cached value for `key`, building it on a miss.
+
+    Only one caller rebuilds a missing hot key: the others wait briefly for
+    it to appear instead of all hitting the database at once (stampede).
+    When the lock goes away without a value (the builder got a 404/400, or
+    raised) the waiters build it themselves straight away.
+    """
+    timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+    lock_timeout = getattr(settings, 'CATALOG_CACHE_LOCK_TIMEOUT', 10)
+
+    value = cache.get(key)
+    if value is not None:
+        stats.record(hit=True)
+        return value, True
+
+    lock_key = f'{key}:lock'
+    if not cache.add(lock_key, 1, timeout=lock_timeout):
+        deadline = time.monotonic() + lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = cache.get(key)
+            if value is not None:
+                stats.record(hit=True)
+                return value, True
+            if cache.get(lock_key) is None:
+                break
+        # Nothing to wait for (no cacheable value), or the builder died or
+        # is too slow; build it ourselves
+        lock_key = None
+
+    stats.record(hit=False)
+    try:
+        recently_bumped = bool(settings.DATABASE_REPLICAS) and \
+            cache.get(CATALOG_BUMPED_KEY) is not None
+        with build_database(recently_bumped):
+            value = build()
+        if value is not None:
+            cache.set(key, value, timeout=timeout)
+    finally:
+        if lock_key:
+            cache.delete(lock_key)
+    return value, False
+
+
+async def aget_or_build(key, build):
+    """get_or_build() with an async `build`"""
+    timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+    lock_timeout = getattr(settings, 'CATALOG_CACHE_LOCK_TIMEOUT', 10)
+
+    value = await cache.aget(key)
+    if value is not None:
+        stats.record(hit=True)
+        return value, True
+
+    lock_key = f'{key}:lock'
+    if not await cache.aadd(lock_key, 1, timeout=lock_timeout):
+        deadline = time.monotonic() + lock_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            value = await cache.aget(key)
+            if value is not None:
+                stats.record(hit=True)
+                return value, True
+            if await cache.aget(lock_key) is None:
+                break
+        lock_key = None
+
+    stats.record(hit=False)
+    try:
+        recently_bumped = bool(settings.DATABASE_REPLICAS) and \
+            await cache.aget(CATALOG_BUMPED_KEY) is not None
+        with build_database(recently_bumped):
+            value = await build()
+        if value is not None:
+            await cache.aset(key, value, timeout=timeout)
+    finally:
+        if lock_key:
+            await cache.adelete(lock_key)
+    return value, False
+
+
+class CatalogCacheMixin:
+    """
+    Serve anonymous list/retrieve responses from the versioned catalog cache.
+
+    The serialized `response.data` is cached (not the rendered bytes), so
+    content negotiation still works. Only 200 responses are stored.
+    """
+    catalog_cache_prefix = None
+    # set by ConditionalGetMixin before the handler runs
+    catalog_etag = None
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if request.user and request.user.is_authenticated:
+            return handler(request, *args, **kwargs)
+
+        prefix = self.catalog_cache_prefix or self.basename
+        key = catalog_cache_key(f'{prefix}:{self.action}', request, self.catalog_etag)
+        uncached = {}
+
+        def build():
+            response = handler(request, *args, **kwargs)
+            uncached['response'] = response
+            if response.status_code != status.HTTP_200_OK:
+                return None
+            return response.data
+
+        data, hit = get_or_build(key, build)
+        if 'response' in uncached:
+            response = uncached['response']
+        else:
+            response = Response(data)
+        response['X-Cache'] = 'HIT' if hit else 'MISS'
+        return response
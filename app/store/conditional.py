@@ -0,0 +1,105 @@
+"""
+Conditional GET support (ETag / Last-Modified / 304) for catalog viewsets.
+
+Validators come from one aggregate over the filtered queryset:
+max(last_update) and the row count. The catalog version (see store.cache)
+is folded into the ETag so edits that don't touch Product.last_update
+(category renames, image uploads) still change it.
+"""
+import hashlib
+
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max
+from django.http import Http404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from .cache import aget_catalog_version, get_catalog_version
+
+
+def validator_aggregates(field):
+    return {'last_modified': Max(field), 'count': Count('pk')}
+
+
+def make_validators(validators, catalog_version, renderer_format):
+    """(ETag, Last-Modified timestamp) from the aggregate, (None, None) when empty"""
+    last_modified = validators['last_modified']
+    if last_modified is None:
+        return None, None
+
+    raw = ':'.join([
+        str(validators['count']),
+        last_modified.isoformat(),
+        str(catalog_version),
+        renderer_format,
+    ])
+    etag = quote_etag(hashlib.sha1(raw.encode()).hexdigest())
+    return etag, int(last_modified.timestamp())
+
+
+async def aget_validators(queryset, field, renderer_format):
+    """get_validators() for the async views"""
+    validators = await queryset.order_by().aaggregate(**validator_aggregates(field))
+    if validators['last_modified'] is None:
+        return None, None
+    return make_validators(validators, await aget_catalog_version(), renderer_format)
+
+
+def set_validators(response, etag, last_modified):
+    if response.status_code == 200:
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+
+
+class ConditionalGetMixin:
+    last_modified_field = 'last_update'
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        # list() filters again; reuse this one so filter backends that
+        # query (e.g. ModelChoiceFilter validation) only run once
+        self._filtered_queryset = queryset
+        return self.conditional_response(
+            self.get_validators(queryset), super().list, request, *args, **kwargs)
+
+    def filter_queryset(self, queryset):
+        filtered = getattr(self, '_filtered_queryset', None)
+        if filtered is not None:
+            return filtered
+        return super().filter_queryset(queryset)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            validators = self.get_validators(self.get_queryset().filter(
+                **{self.lookup_field: kwargs[lookup_url_kwarg]}))
+        # a lookup value the field can't take, e.g. /products/abc/
+        except (ValueError, TypeError, ValidationError):
+            raise Http404
+        return self.conditional_response(
+            validators, super().retrieve, request, *args, **kwargs)
+
+    def get_validators(self, queryset):
+        validators = queryset.order_by().aggregate(
+            **validator_aggregates(self.last_modified_field))
+        if validators['last_modified'] is None:
+            return None, None
+        return make_validators(validators, get_catalog_version(),
+                               self.request.accepted_renderer.format)
+
+    def conditional_response(self, validators, handler, request, *args, **kwargs):
+        etag, last_modified = validators
+        # CatalogCacheMixin keys the cached response by it
+        self.catalog_etag = etag
+        if etag is None:
+            # Empty result or missing object; nothing to validate against
+            return handler(request, *args, **kwargs)
+
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        response = handler(request, *args, **kwargs)
+        set_validators(response, etag, last_modified)
+        return response
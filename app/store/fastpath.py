@@ -0,0 +1,155 @@
+"""
+Read-only fast path for catalog serialization.
+
+Builds the exact payload of ProductSerializer as plain dicts from .values()
+rows plus one query for all images, skipping the DRF field machinery, and
+renders it with the orjson-backed FastJSONRenderer. Enabled with
+settings.CATALOG_FAST_SERIALIZATION; the tests check the rendered bytes
+against the serializer.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from . import models
+from .images import srcset
+from .renderers import FastJSONRenderer
+
+PRODUCT_VALUES = ['id', 'title', 'last_update', 'description', 'inventory',
+                  'unit_price', 'price_with_tax', 'category__title']
+
+
+def enabled():
+    return getattr(settings, 'CATALOG_FAST_SERIALIZATION', False)
+
+
+def product_values(queryset, fields=PRODUCT_VALUES):
+    """
+    .values() version of a product queryset.
+
+    Annotations (search_rank, ...) are kept so keyset pagination can still
+    read the ordering values from the rows.
+    """
+    annotations = [name for name in queryset.query.annotations if name not in fields]
+    return queryset.prefetch_related(None).values(*fields, *annotations)
+
+
+def _datetime(value):
+    # Same as serializers.DateTimeField: current timezone, ISO 8601, 'Z' for UTC
+    if settings.USE_TZ and timezone.is_aware(value):
+        value = value.astimezone(timezone.get_current_timezone())
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def _decimal(value):
+    # With COERCE_DECIMAL_TO_STRING off, DecimalField hands a Decimal to the
+    # JSON encoder, which writes float(value)
+    if value is None:
+        return None
+    if settings.REST_FRAMEWORK.get('COERCE_DECIMAL_TO_STRING', True):
+        return str(value)
+    return float(value)
+
+
+def image_rows(product_ids):
+    return models.ProductImage.objects.filter(product_id__in=product_ids) \
+        .order_by('id').values_list('product_id', 'id', 'image', 'derivatives')
+
+
+def group_images(rows, request=None):
+    storage = models.ProductImage._meta.get_field('image').storage
+    build_uri = request.build_absolute_uri if request is not None else None
+    images = defaultdict(list)
+    for product_id, image_id, name, derivatives in rows:
+        url = None
+        if name:
+            url = storage.url(name)
+            if build_uri is not None:
+                url = build_uri(url)
+        images[product_id].append({
+            'id': image_id, 'image': url,
+            'srcset': srcset(storage, name, derivatives, build_uri)})
+    return images
+
+
+def image_map(product_ids, request=None):
+    """{product_id: [{'id', 'image', 'srcset'}, ...]} in one query, ordered by image id"""
+    return group_images(image_rows(product_ids), request)
+
+
+async def aimage_map(product_ids, request=None):
+    rows = [row async for row in image_rows(product_ids)]
+    return group_images(rows, request)
+
+
+def _product_dict(row, images):
+    return {
+        'id': row['id'],
+        'title': row['title'],
+        'last_update': _datetime(row['last_update']),
+        'description': row['description'],
+        'inventory': row['inventory'],
+        'unit_price': _decimal(row['unit_price']),
+        'price_with_tax': _decimal(row['price_with_tax']),
+        'category': row['category__title'],
+        'images': images.get(row['id'], []),
+    }
+
+
+def product_dicts(rows, request=None):
+    """ProductSerializer payload for .values(*PRODUCT_VALUES) rows"""
+    images = image_map([row['id'] for row in rows], request)
+    return [_product_dict(row, images) for row in rows]
+
+
+async def aproduct_dicts(rows, request=None):
+    """product_dicts() for the async views"""
+    images = await aimage_map([row['id'] for row in rows], request)
+    return [_product_dict(row, images) for row in rows]
+
+
+class FastProductMixin:
+    """
+    list/retrieve through product_dicts() and FastJSONRenderer when
+    CATALOG_FAST_SERIALIZATION is on; writes and the disabled case use the
+    regular serializer and renderers.
+    """
+
+    def get_renderers(self):
+        renderers = super().get_renderers()
+        if not enabled():
+            return renderers
+        return [FastJSONRenderer() if type(renderer) is JSONRenderer else renderer
+                for renderer in renderers]
+
+    def list(self, request, *args, **kwargs):
+        if not enabled():
+            return super().list(request, *args, **kwargs)
+
+        rows = product_values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(product_dicts(page, request))
+        return Response(product_dicts(list(rows), request))
+
+    def retrieve(self, request, *args, **kwargs):
+        if not enabled():
+            return super().retrieve(request, *args, **kwargs)
+
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            rows = list(product_values(self.get_queryset().filter(
+                **{self.lookup_field: kwargs[lookup_url_kwarg]})))
+        except (ValueError, TypeError, ValidationError):
+            raise Http404
+        if not rows:
+            raise Http404
+        return Response(product_dicts(rows, request)[0])
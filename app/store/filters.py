@@ -1,4 +1,4 @@
-from django_filters.rest_framework import FilterSet
+from django_filters.rest_framework import FilterSet, NumberFilter
 from .models import Product
 
 # ref-->https://django-filter.readthedocs.io/
@@ -8,6 +8,10 @@ from .models import Product
 
 
 class ProductFilter(FilterSet):
+    # price_with_tax is a queryset annotation, not a model field
+    price_with_tax__gt = NumberFilter(field_name='price_with_tax', lookup_expr='gt')
+    price_with_tax__lt = NumberFilter(field_name='price_with_tax', lookup_expr='lt')
+
     class Meta:
         model = Product
         fields = {
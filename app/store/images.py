@@ -0,0 +1,147 @@
+"""
+Resized derivatives of product and category images.
+
+Every upload gets one WebP and one fallback (JPEG, or PNG when the image
+has transparency) per width in settings.IMAGE_DERIVATIVE_WIDTHS, written
+next to the original through the same storage. What was generated is kept
+in the model's `derivatives` JSON so serializers can build a srcset
+without touching the storage:
+
+    {'source': 'store/images/a.jpg',
+     'variants': [{'width': 160, 'height': 120, 'format': 'webp',
+                   'name': 'store/images/derivatives/a-160w.webp'}, ...]}
+"""
+import io
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+from . import models
+from .cache import bump_catalog_version
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+SAVE_OPTIONS = {
+    'webp': {'quality': 80, 'method': 4},
+    'jpeg': {'quality': 82, 'optimize': True, 'progressive': True},
+    'png': {'optimize': True},
+}
+
+
+def derivative_formats(image):
+    formats = ['webp'] if features.check('webp') else []
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    return formats + ['png' if has_alpha else 'jpeg']
+
+
+def derivative_name(source, width, fmt):
+    directory, filename = os.path.split(source)
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(directory, 'derivatives', f'{stem}-{width}w.{fmt}')
+
+
+def is_current(derivatives, name):
+    # stale after the image is replaced, until update_derivatives() runs
+    return bool(derivatives) and derivatives.get('source') == name
+
+
+def generate_derivatives(field_file, widths=None):
+    """
+    Write the resized copies of `field_file` and return the derivatives dict.
+
+    Widths at or above the original are skipped, the original already
+    covers them. A missing file or one that is not an image gets no
+    variants, and is not retried until it is replaced (or --force).
+    """
+    widths = widths or settings.IMAGE_DERIVATIVE_WIDTHS
+    storage = field_file.storage
+    try:
+        with storage.open(field_file.name, 'rb') as f:
+            original = Image.open(f)
+            original.load()
+    except (OSError, UnidentifiedImageError):
+        logger.warning('cannot read %s, no derivatives generated', field_file.name)
+        return {'source': field_file.name, 'variants': []}
+
+    original = ImageOps.exif_transpose(original)
+    formats = derivative_formats(original)
+    variants = []
+    for width in sorted(set(widths)):
+        if width >= original.width:
+            continue
+        height = max(1, round(original.height * width / original.width))
+        resized = original.resize((width, height), Image.LANCZOS)
+        for fmt in formats:
+            image = resized
+            if fmt == 'jpeg' and image.mode != 'RGB':
+                image = image.convert('RGB')
+            buffer = io.BytesIO()
+            image.save(buffer, format=fmt.upper(), **SAVE_OPTIONS[fmt])
+            name = derivative_name(field_file.name, width, fmt)
+            if storage.exists(name):
+                storage.delete(name)
+            name = storage.save(name, ContentFile(buffer.getvalue()))
+            variants.append({'width': width, 'height': height, 'format': fmt, 'name': name})
+    return {'source': field_file.name, 'variants': variants}
+
+
+def update_derivatives(instance, bump=True):
+    """
+    (Re)generate derivatives for a ProductImage/CategoryImage if stale.
+
+    Returns whether anything was generated. With bump=False the caller
+    moves the products' last_update on and bumps the catalog version itself,
+    once for a whole batch (see touch_products()).
+    """
+    if not instance.image.name or is_current(instance.derivatives, instance.image.name):
+        return False
+    derivatives = generate_derivatives(instance.image)
+    # update() so no post_save fires again
+    type(instance).objects.filter(pk=instance.pk).update(derivatives=derivatives)
+    instance.derivatives = derivatives
+    # This runs after the upload's commit, and its catalog version bump:
+    # bump again so cached payloads pick up the srcset, and move the
+    # product's Last-Modified/ETag on
+    if bump:
+        if isinstance(instance, models.ProductImage):
+            touch_products([instance.product_id])
+        bump_catalog_version()
+    return True
+
+
+def touch_products(product_ids):
+    models.Product.objects.filter(pk__in=product_ids).update(last_update=timezone.now())
+
+
+def srcset(storage, name, derivatives, build_uri=None):
+    """
+    The srcset list exposed by the image serializers: WebP first, then the
+    fallback format, each by increasing width.
+    """
+    if not is_current(derivatives, name):
+        return []
+    variants = derivatives.get('variants', [])
+    order = {fmt: i for i, fmt in enumerate(CONTENT_TYPES)}
+    result = []
+    for variant in sorted(variants, key=lambda v: (order[v['format']], v['width'])):
+        url = storage.url(variant['name'])
+        if build_uri is not None:
+            url = build_uri(url)
+        result.append({'url': url, 'width': variant['width'], 'height': variant['height'],
+                       'type': CONTENT_TYPES[variant['format']]})
+    return result
+
+
+def thumbnail_url(field_file, derivatives):
+    """Smallest fallback-format derivative, or the original"""
+    if not is_current(derivatives, field_file.name):
+        return field_file.url
+    variants = [v for v in derivatives.get('variants', []) if v['format'] != 'webp']
+    if variants:
+        return field_file.storage.url(min(variants, key=lambda v: v['width'])['name'])
+    return field_file.url
@@ -0,0 +1,169 @@
+"""
+
+django command to benchmark concurrent checkouts
+
+"""
+
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from store import models
+from store.benchmarks import QueryCounter, format_latency, timer
+from store.seeding import seed_catalog, seed_user
+
+RETRYABLE_ERRORS = ('deadlock', 'database is locked', 'could not serialize')
+
+
+class Command(BaseCommand):
+    """
+    Drive the real cart -> cart items -> order flow from N threads.
+
+    Every checkout goes through the viewsets (CartViewSet, CartItemViewSet,
+    OrderViewSet.create) with the Django test client, against whatever
+    database settings.DATABASES points at. Seeds its own catalog and users,
+    so run it against a disposable database.
+
+    SQLite serializes all writers on one file lock, so expect retries and
+    lock failures there; PostgreSQL is the number to size uwsgi with.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--orders', type=int, default=50,
+                            help='Checkouts per worker')
+        parser.add_argument('--items', type=int, default=3,
+                            help='Distinct products per cart')
+        parser.add_argument('--products', type=int, default=200)
+        parser.add_argument('--hot', action='store_true',
+                            help='Every worker buys the same product')
+        parser.add_argument('--retries', type=int, default=10)
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.flow_latency = []
+        self.order_latency = []
+        self.queries_per_order = []
+        self.retried_queries = 0
+        self.retries = 0
+        self.deadlocks = 0
+        self.failures = 0
+
+        _, products = seed_catalog(
+            categories=max(1, options['products'] // 50),
+            products_per_category=min(options['products'], 50),
+            images_per_product=1)
+        models.Product.objects.filter(pk__in=[p.pk for p in products]) \
+            .update(inventory=10 ** 6)
+        self.product_ids = [p.pk for p in products]
+        users = [seed_user() for _ in range(options['workers'])]
+
+        # retried lock errors would otherwise log a traceback each
+        request_logger = logging.getLogger('django.request')
+        level = request_logger.level
+        request_logger.setLevel(logging.CRITICAL)
+
+        start = time.perf_counter()
+        # one client placing orders as fast as it can is what the checkout
+        # rate limit is there to stop
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+                               RATELIMIT_ENABLED=False):
+            if options['workers'] == 1:
+                self.worker(users[0], 0)
+            else:
+                threads = [threading.Thread(target=self.worker, args=(user, i))
+                           for i, user in enumerate(users)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        elapsed = time.perf_counter() - start
+        request_logger.setLevel(level)
+
+        orders = len(self.order_latency)
+        scenario = 'hot product' if options['hot'] else 'spread catalog'
+        self.stdout.write(
+            f'{scenario}: {options["workers"]} workers, {orders} orders '
+            f'in {elapsed:.2f}s -> {orders / elapsed:.1f} orders/s')
+        self.stdout.write(format_latency('checkout flow', self.flow_latency))
+        self.stdout.write(format_latency('order create', self.order_latency))
+        if self.queries_per_order:
+            self.stdout.write(
+                f'queries per order: {sum(self.queries_per_order) / orders:.1f} '
+                f'(max {max(self.queries_per_order)}), '
+                f'{self.retried_queries} more in retried attempts')
+        self.stdout.write(
+            f'retries={self.retries} deadlocks={self.deadlocks} failures={self.failures}')
+
+    def worker(self, user, seed):
+        rnd = random.Random(seed)
+        client = APIClient()
+        client.force_authenticate(user)
+        try:
+            for _ in range(self.options['orders']):
+                self.checkout(client, rnd)
+        finally:
+            connection.close()
+
+    def checkout(self, client, rnd):
+        if self.options['hot']:
+            product_ids = self.product_ids[:1]
+        else:
+            product_ids = rnd.sample(self.product_ids, self.options['items'])
+        lines = [{'product_id': pk, 'quantity': 1} for pk in product_ids]
+
+        flow, order = [], []
+        counter = QueryCounter()
+        response = None
+        with timer(flow):
+            cart = self.request(client.post, '/store/carts/', {})
+            if cart is not None:
+                cart_id = cart.data['id']
+                added = self.request(client.post, f'/store/carts/{cart_id}/items/', lines)
+                if added is not None:
+                    with connection.execute_wrapper(counter), timer(order):
+                        response = self.request(
+                            client.post, '/store/orders/', {'cart_id': cart_id},
+                            counter=counter)
+
+        with self.lock:
+            if response is None or response.status_code != 200:
+                self.failures += 1
+                return
+            self.flow_latency += flow
+            self.order_latency += order
+            self.queries_per_order.append(counter.count)
+
+    def request(self, method, url, data, counter=None):
+        """
+        Call the view, retrying deadlocks / lock timeouts with backoff.
+
+        `counter` is reset before each attempt, so it ends up holding the
+        queries of the attempt that went through; the rest are added to
+        self.retried_queries.
+        """
+        for attempt in range(self.options['retries'] + 1):
+            if counter is not None:
+                counter.count, counter.seconds = 0, 0.0
+            try:
+                return method(url, data, format='json')
+            except OperationalError as e:
+                message = str(e).lower()
+                if not any(error in message for error in RETRYABLE_ERRORS):
+                    raise
+                with self.lock:
+                    self.retries += 1
+                    if counter is not None:
+                        self.retried_queries += counter.count
+                    if 'deadlock' in message:
+                        self.deadlocks += 1
+                time.sleep(0.01 * 2 ** attempt)
+        return None
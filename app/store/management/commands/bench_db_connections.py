@@ -0,0 +1,95 @@
+"""
+
+django command to compare per-request, persistent and pooled db connections
+
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection, connections
+from django.db.utils import load_backend
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from store import models
+from store.benchmarks import format_latency, percentile, timer
+from store.seeding import seed_catalog, seed_user
+
+
+class Command(BaseCommand):
+    """
+    GET /store/products/<id>/ repeatedly under each connection mode:
+
+        new          CONN_MAX_AGE=0, a fresh connection per request
+        persistent   CONN_MAX_AGE=60 with health checks
+        pooled       app.db.postgresql_pool (PostgreSQL only)
+
+    Requests are authenticated so the catalog cache doesn't hide the
+    database. The handshake only really costs something on PostgreSQL (more
+    so over TLS); against SQLite the modes are nearly the same.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+
+    def handle(self, *args, **options):
+        product = models.Product.objects.order_by('id').first()
+        if product is None:
+            product = seed_catalog(categories=1, products_per_category=1)[1][0]
+        self.url = f'/store/products/{product.id}/'
+        self.user = seed_user()
+        self.requests = options['requests']
+
+        results = {}
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            results['new'] = self.run(max_age=0)
+            results['persistent'] = self.run(max_age=60)
+            if connection.vendor == 'postgresql':
+                results['pooled'] = self.run_pooled()
+            else:
+                self.stdout.write('pooled: skipped, needs PostgreSQL')
+        self.user.delete()
+
+        for label, latencies in results.items():
+            self.stdout.write(format_latency(label, latencies))
+        baseline = percentile(results['new'], 50)
+        for label, latencies in results.items():
+            if label != 'new':
+                self.stdout.write(
+                    f'{label}: p50 {baseline * 1000 - percentile(latencies, 50) * 1000:+.2f}ms '
+                    f'faster than a new connection per request')
+
+    def run(self, max_age):
+        connection.close()
+        original = connection.settings_dict['CONN_MAX_AGE']
+        connection.settings_dict['CONN_MAX_AGE'] = max_age
+        try:
+            return self.drive()
+        finally:
+            connection.close()
+            connection.settings_dict['CONN_MAX_AGE'] = original
+
+    def run_pooled(self):
+        connection.close()
+        default = connections['default']
+        backend = load_backend('app.db.postgresql_pool')
+        pooled = backend.DatabaseWrapper({**default.settings_dict, 'CONN_MAX_AGE': 0}, 'default')
+        connections['default'] = pooled
+        try:
+            return self.drive()
+        finally:
+            pooled.close()
+            connections['default'] = default
+
+    def drive(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        latencies = []
+        for _ in range(self.requests):
+            with timer(latencies):
+                response = client.get(self.url)
+                # what request_finished does outside the test client
+                close_old_connections()
+            if response.status_code != 200:
+                raise RuntimeError(f'{self.url} returned {response.status_code}')
+        return latencies
@@ -0,0 +1,70 @@
+"""
+
+django command to compare the serializer and fast path for catalog payloads
+
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from rest_framework.renderers import JSONRenderer
+
+from store import fastpath, models, serializers
+from store.benchmarks import format_latency, timer
+from store.renderers import FastJSONRenderer
+from store.seeding import seed_catalog
+
+
+class Command(BaseCommand):
+    """
+    Time serialize + render of one product page both ways.
+
+    "serializer" is ProductSerializer over the prefetched queryset rendered
+    with JSONRenderer (what ProductViewSet does by default); "fast path" is
+    fastpath.product_dicts() over .values() rows rendered with
+    FastJSONRenderer. Both include the database queries. Seeds its own
+    catalog, so run it against a disposable database.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100,
+                            help='Products per page')
+        parser.add_argument('--images', type=int, default=2)
+        parser.add_argument('--rounds', type=int, default=50)
+
+    def handle(self, *args, **options):
+        # image urls are absolute, so the fake request needs a valid host
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            self.run(options)
+
+    def run(self, options):
+        seed_catalog(categories=1, products_per_category=options['products'],
+                     images_per_product=options['images'])
+        request = RequestFactory().get('/store/products/')
+        queryset = models.Product.objects.with_price_with_tax() \
+            .select_related('category').prefetch_related('images') \
+            .order_by('-id')[:options['products']]
+
+        def slow():
+            data = serializers.ProductSerializer(
+                queryset.all(), many=True, context={'request': request}).data
+            return JSONRenderer().render(data)
+
+        def fast():
+            rows = list(fastpath.product_values(queryset.all()))
+            return FastJSONRenderer().render(fastpath.product_dicts(rows, request))
+
+        if slow() != fast():
+            raise CommandError('fast path and serializer payloads differ')
+
+        results = {}
+        for label, build in (('serializer', slow), ('fast path', fast)):
+            results[label] = []
+            for _ in range(options['rounds']):
+                with timer(results[label]):
+                    build()
+            self.stdout.write(format_latency(label, results[label]))
+
+        speedup = sum(results['serializer']) / sum(results['fast path'])
+        self.stdout.write(f'{options["products"]} products/page: {speedup:.1f}x faster')
@@ -0,0 +1,134 @@
+"""
+
+django command to load test the uwsgi and ASGI deployments side by side
+
+"""
+
+import http.client
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from store import models
+from store.benchmarks import format_latency
+from store.seeding import seed_cart, seed_catalog, seed_user
+
+
+class Command(BaseCommand):
+    """
+    GET the same catalog and cart URLs from --concurrency client threads
+    against each running server in turn, e.g.
+
+        RATELIMIT_ENABLED=0 uwsgi --http :9100 --module app.wsgi --master --workers 4 \\
+            --enable-threads
+        RATELIMIT_ENABLED=0 CONN_MAX_AGE=0 uvicorn app.asgi:application --port 9200 --workers 4
+        python manage.py bench_servers --target uwsgi=http://127.0.0.1:9100 \\
+            --target asgi=http://127.0.0.1:9200 --concurrency 200
+
+    The servers must use the same database as this command: without --path
+    it picks (or seeds) a product and a cart to request. With --uncached the
+    requests carry a JWT, so the catalog cache is skipped and every request
+    waits on the database, which is where the async views differ.
+
+    The servers must run with rate limiting off (RATELIMIT_ENABLED=0), all
+    requests come from one address; a 429 stops the command.
+
+    The client is Python threads too; run it from another machine for
+    absolute numbers, the comparison holds either way.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', required=True,
+                            help='name=http://host:port, repeat for each server')
+        parser.add_argument('--path', action='append', default=[])
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--uncached', action='store_true')
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options['target']:
+            name, _, url = target.partition('=')
+            if not url:
+                raise CommandError(f'--target {target!r} should look like name=http://host:port')
+            targets.append((name, urlsplit(url)))
+
+        paths = options['path'] or self.default_paths()
+        headers = {'Accept': 'application/json'}
+        if options['uncached']:
+            headers['Authorization'] = f'JWT {AccessToken.for_user(seed_user())}'
+
+        self.stdout.write(f'{options["requests"]} requests, {options["concurrency"]} clients, '
+                          f'paths: {" ".join(paths)}')
+        for name, url in targets:
+            # one warm-up round: worker startup, first connections, cache fill
+            self.load(url, paths, headers, len(paths) * 2, min(options['concurrency'], 4))
+            latencies, errors, elapsed = self.load(
+                url, paths, headers, options['requests'], options['concurrency'])
+            if self.limited:
+                raise CommandError(f'{name} rate limited {self.limited} requests, '
+                                   'start it with RATELIMIT_ENABLED=0')
+            self.stdout.write(f'{format_latency(name, latencies)}  '
+                              f'{len(latencies) / elapsed:8.1f} req/s  errors={errors}')
+
+    def default_paths(self):
+        if models.Product.objects.count() < 10:
+            seed_catalog(categories=2, products_per_category=20)
+        product = models.Product.objects.order_by('id').first()
+        cart = models.Cart.objects.filter(items__isnull=False).first()
+        if cart is None:
+            cart = seed_cart(models.Product.objects.all()[:10])
+        return ['/store/products/', f'/store/products/{product.id}/', '/store/categories/',
+                f'/store/carts/{cart.id}/']
+
+    def load(self, url, paths, headers, total, concurrency):
+        """(latencies of the 200s, failed requests, wall time), 429s in self.limited"""
+        self.limited = 0
+        counter = itertools.count()
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        prefix = url.path.rstrip('/')
+
+        def client():
+            connection = None
+            seen, failed = [], 0
+            while (i := next(counter)) < total:
+                if connection is None:
+                    # keep-alive, like nginx in front of either server
+                    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+                start = time.perf_counter()
+                try:
+                    connection.request('GET', prefix + paths[i % len(paths)], headers=headers)
+                    response = connection.getresponse()
+                    response.read()
+                    ok = response.status == 200
+                    if response.status == 429:
+                        with lock:
+                            self.limited += 1
+                    if response.will_close:
+                        connection.close()
+                        connection = None
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    connection, ok = None, False
+                if ok:
+                    seen.append(time.perf_counter() - start)
+                else:
+                    failed += 1
+            if connection is not None:
+                connection.close()
+            with lock:
+                latencies.extend(seen)
+                errors.append(failed)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for _ in range(concurrency):
+                pool.submit(client)
+        return latencies, sum(errors), time.perf_counter() - start
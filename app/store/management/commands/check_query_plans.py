@@ -0,0 +1,41 @@
+"""
+
+django command to check the query plans of the store viewsets
+
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from store.query_plans import find_seq_scans, representative_queries
+
+
+class Command(BaseCommand):
+    """EXPLAIN each viewset's hot queries and fail on large sequential scans"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threshold', type=int,
+            default=getattr(settings, 'QUERY_PLAN_SEQ_SCAN_ROWS', 1000),
+            help='Largest table (in rows) allowed to be sequentially scanned')
+
+    def handle(self, *args, **options):
+        threshold = options['threshold']
+        regressions = []
+        for label, queryset in representative_queries():
+            scans = find_seq_scans(label, queryset, threshold)
+            if scans:
+                regressions.extend(scans)
+                self.stdout.write(self.style.ERROR(f'SEQ SCAN  {label}'))
+            else:
+                self.stdout.write(f'ok        {label}')
+
+        if regressions:
+            details = '\n'.join(
+                f'{scan.label}: sequential scan on {scan.table} (~{scan.rows} rows)\n{scan.plan}'
+                for scan in regressions)
+            raise CommandError(
+                f'{len(regressions)} query plan(s) regressed to a sequential scan '
+                f'above {threshold} rows:\n{details}')
+
+        self.stdout.write(self.style.SUCCESS('Query plans OK'))
@@ -0,0 +1,76 @@
+"""
+
+django command to generate missing image derivatives
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+from django.db.models.fields.json import KeyTextTransform
+
+from store import images, models
+from store.cache import bump_catalog_version
+
+
+class Command(BaseCommand):
+    """
+    Backfill resized copies for images uploaded before derivatives existed,
+    or whose derivatives are stale. --force regenerates everything, e.g.
+    after changing IMAGE_DERIVATIVE_WIDTHS.
+
+    Runs once by default; --loop keeps polling every --poll seconds, which
+    is what resizes uploads when IMAGE_DERIVATIVES_ON_UPLOAD is off (run it
+    as its own container/process).
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true')
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--loop', action='store_true')
+        parser.add_argument('--poll', type=float, default=5)
+
+    def handle(self, *args, **options):
+        force = options['force']
+        while True:
+            generated = self.backfill(force, options['batch_size'])
+            if generated or not options['loop']:
+                self.stdout.write(self.style.SUCCESS(
+                    f'Generated derivatives for {generated} images'))
+            if not options['loop']:
+                break
+            # --force is for the first pass only
+            force = False
+            time.sleep(options['poll'])
+
+    def backfill(self, force, batch_size):
+        generated = 0
+        for model in (models.ProductImage, models.CategoryImage):
+            queryset = model.objects.exclude(image='')
+            if not force:
+                # only rows whose derivatives are missing or for another file
+                queryset = queryset.alias(
+                    source=KeyTextTransform('source', 'derivatives')) \
+                    .filter(Q(source__isnull=True) | ~Q(source=F('image')))
+            last_pk = 0
+            while True:
+                batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+                if not batch:
+                    break
+                product_ids = set()
+                for instance in batch:
+                    if force:
+                        instance.derivatives = {}
+                    # the catalog bump and last_update go once per batch/run
+                    if images.update_derivatives(instance, bump=False):
+                        generated += 1
+                        product_ids.add(getattr(instance, 'product_id', None))
+                product_ids.discard(None)
+                if product_ids:
+                    images.touch_products(product_ids)
+                last_pk = batch[-1].pk
+
+        if generated:
+            bump_catalog_version()
+        return generated
@@ -0,0 +1,17 @@
+"""
+
+django command to rebuild the product search documents
+
+"""
+
+from django.core.management.base import BaseCommand
+
+from store import search
+
+
+class Command(BaseCommand):
+    """Recompute every product's search document (e.g. after bulk imports)"""
+
+    def handle(self, *args, **options):
+        search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
@@ -0,0 +1,53 @@
+"""
+
+django command to recompute Category.product_count
+
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from store import models
+from store.cache import bump_catalog_version
+
+
+class Command(BaseCommand):
+    """Recompute the denormalized product_count of every category in batches"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        checked = fixed = 0
+        last_pk = 0
+        while True:
+            with transaction.atomic():
+                categories = list(models.Category.objects
+                                  .filter(pk__gt=last_pk).order_by('pk')
+                                  .select_for_update()[:batch_size])
+                if not categories:
+                    break
+                counts = dict(models.Product.objects
+                              .filter(category__in=categories)
+                              .order_by().values('category')
+                              .annotate(n=Count('pk'))
+                              .values_list('category', 'n'))
+                stale = []
+                for category in categories:
+                    actual = counts.get(category.pk, 0)
+                    if category.product_count != actual:
+                        category.product_count = actual
+                        stale.append(category)
+                models.Category.objects.bulk_update(stale, ['product_count'])
+                if stale:
+                    # counts are part of the cached category payload
+                    transaction.on_commit(bump_catalog_version)
+
+            checked += len(categories)
+            fixed += len(stale)
+            last_pk = categories[-1].pk
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {checked} categories, fixed {fixed} product counts'))
@@ -0,0 +1,112 @@
+"""
+
+django command to delete abandoned carts
+
+"""
+
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from store import models
+
+
+def default_state_file():
+    return getattr(settings, 'CART_SWEEP_STATE_FILE', None) or \
+        os.path.join(tempfile.gettempdir(), 'ebuy-cart-sweep.json')
+
+
+class Command(BaseCommand):
+    """
+    Delete carts idle for longer than the TTL (Cart.updated_at, moved on by
+    every cart item change) in bounded primary-key chunks.
+
+    Each chunk is its own short transaction and the command sleeps between
+    chunks, so it never holds long locks or produces a burst of WAL. Progress
+    (cutoff and last primary key) is checkpointed after every chunk; an
+    interrupted run picks up from there on the next invocation.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ttl-days', type=float,
+            default=getattr(settings, 'CART_TTL_DAYS', 7),
+            help='Delete carts not changed for more than this many days')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--pause', type=float, default=0.2,
+            help='Seconds to sleep between batches')
+        parser.add_argument('--state-file', default=None)
+
+    def handle(self, *args, **options):
+        state_file = options['state_file'] or default_state_file()
+        batch_size = options['batch_size']
+        state = self.load_state(state_file)
+
+        if state:
+            cutoff = parse_datetime(state['cutoff'])
+            last_pk = state['last_pk']
+            self.stdout.write(f'Resuming sweep after cart {last_pk}')
+        else:
+            cutoff = timezone.now() - timedelta(days=options['ttl_days'])
+            last_pk = None
+
+        carts = items = 0
+        # deleting vs sleeping, so the rate shows what --pause costs
+        delete_time = pause_time = 0.0
+        start = time.monotonic()
+        while True:
+            queryset = models.Cart.objects.filter(updated_at__lt=cutoff)
+            if last_pk is not None:
+                queryset = queryset.filter(pk__gt=last_pk)
+            chunk_start = time.monotonic()
+            pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                delete_time += time.monotonic() - chunk_start
+                break
+
+            # again: an item may have been added since the select
+            _, deleted = models.Cart.objects.filter(pk__in=pks, updated_at__lt=cutoff).delete()
+            delete_time += time.monotonic() - chunk_start
+            carts += deleted.get('store.Cart', 0)
+            items += deleted.get('store.CartItem', 0)
+            last_pk = str(pks[-1])
+            self.save_state(state_file, cutoff, last_pk)
+
+            if len(pks) < batch_size:
+                break
+            pause_start = time.monotonic()
+            time.sleep(options['pause'])
+            pause_time += time.monotonic() - pause_start
+
+        if os.path.exists(state_file):
+            os.remove(state_file)
+
+        elapsed = time.monotonic() - start
+        rows = carts + items
+        rate = rows / delete_time if delete_time else 0
+        overall = rows / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {carts} carts and {items} cart items in {elapsed:.2f}s: '
+            f'{delete_time:.2f}s deleting ({rate:.0f} rows/s), '
+            f'{pause_time:.2f}s paused ({overall:.0f} rows/s overall)'))
+
+    def load_state(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_state(self, path, cutoff, last_pk):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'cutoff': cutoff.isoformat(), 'last_pk': last_pk}, f)
+        os.replace(tmp, path)
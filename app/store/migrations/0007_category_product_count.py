@@ -0,0 +1,29 @@
+# Generated by Django 4.1.6 on 2026-10-17 15:52
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def populate_product_count(apps, schema_editor):
+    Category = apps.get_model('store', 'Category')
+    Product = apps.get_model('store', 'Product')
+    count = Product.objects.filter(category=models.OuterRef('pk')) \
+        .order_by().values('category').annotate(n=models.Count('pk')).values('n')
+    Category.objects.update(
+        product_count=Coalesce(models.Subquery(count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='product_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_product_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.1.6 on 2026-10-17 16:03
+
+from django.db import migrations, models
+import store.storage
+import store.validators
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='categoryimage',
+            name='image',
+            field=models.ImageField(storage=store.storage.image_storage, upload_to='store/images', validators=[store.validators.validate_product_img_size]),
+        ),
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(storage=store.storage.image_storage, upload_to='store/images', validators=[store.validators.validate_product_img_size]),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.1.6 on 2026-10-17 17:39
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def copy_created_at(apps, schema_editor):
+    # existing carts count as idle since they were created
+    Cart = apps.get_model('store', 'Cart')
+    Cart.objects.using(schema_editor.connection.alias).update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_cart_item_max_quantity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='updated_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.RunPython(copy_created_at, migrations.RunPython.noop),
+    ]
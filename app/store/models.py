@@ -1,21 +1,58 @@
-from django.db import models
-from django.core.validators import MinValueValidator
+from django.core.exceptions import ValidationError
+from django.db import connections, models, transaction
+from django.db.backends.base.operations import BaseDatabaseOperations
+from django.db.models import F, Value
+from django.contrib.postgres.search import SearchVectorField
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db.models.functions import Coalesce, Round
+from decimal import ROUND_HALF_UP, Decimal
+from .storage import image_storage
 from .validators import validate_product_img_size
 from django.conf import settings
+from django.utils import timezone
 import uuid
+from contextlib import nullcontext
 # Create your models here.
 
 
 class Category(models.Model):
     title = models.CharField(max_length=255)
+    # Denormalized count of products, maintained by store.signals and
+    # repaired by the reconcile_category_counts command
+    product_count = models.PositiveIntegerField(default=0, editable=False)
+    # e.g. 0.1800 for 18%; empty means settings.DEFAULT_TAX_RATE
+    tax_rate = models.DecimalField(
+        max_digits=5, decimal_places=4, null=True, blank=True,
+        validators=[MinValueValidator(0), MaxValueValidator(1)])
 
     def __str__(self) -> str:
         return self.title
 
+    @property
+    def effective_tax_rate(self):
+        if self.tax_rate is None:
+            return settings.DEFAULT_TAX_RATE
+        return self.tax_rate
+
     class Meta:
         ordering = ['title']
 
 
+class ProductQuerySet(models.QuerySet):
+
+    def with_price_with_tax(self):
+        """
+        Annotate price_with_tax = round(unit_price * (1 + tax rate), 2) in SQL,
+        so lists need no per-row Decimal work and can sort/filter by it
+        """
+        rate = Coalesce(
+            'category__tax_rate', Value(settings.DEFAULT_TAX_RATE),
+            output_field=models.DecimalField(max_digits=5, decimal_places=4))
+        return self.annotate(price_with_tax=Round(
+            F('unit_price') * (Value(Decimal(1)) + rate), 2,
+            output_field=models.DecimalField(max_digits=12, decimal_places=2)))
+
+
 class Product(models.Model):
     title = models.CharField(max_length=255)
     # slug=models.SlugField()
@@ -29,23 +66,65 @@ class Product(models.Model):
         on_delete=models.PROTECT,
         related_name='products'
     )
+    # Weighted title/description tsvector kept up to date by store.search;
+    # GIN-indexed on PostgreSQL, unused on other databases
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ProductQuerySet.as_manager()
 
     def __str__(self) -> str:
         return self.title
 
+    # Normally set by ProductQuerySet.with_price_with_tax(); computed here
+    # only for instances loaded without the annotation (e.g. after a save)
+    @property
+    def price_with_tax(self):
+        value = self.__dict__.get('_price_with_tax')
+        if value is None:
+            rate = self.category.effective_tax_rate
+            value = (self.unit_price * (1 + rate)).quantize(
+                Decimal('0.01'), rounding=ROUND_HALF_UP)
+        return value
+
+    @price_with_tax.setter
+    def price_with_tax(self, value):
+        self.__dict__['_price_with_tax'] = value
+
+    def save(self, *args, **kwargs):
+        # The category product_count update done by the save signals must
+        # commit or roll back together with the product row
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+
+    class Meta:
+        # Keyset pagination appends id to every ordering, so the ordering
+        # indexes carry it too
+        indexes = [
+            models.Index(fields=['category', 'unit_price'],
+                         name='store_product_cat_price_idx'),
+            models.Index(fields=['unit_price', 'id'],
+                         name='store_product_price_id_idx'),
+            models.Index(fields=['last_update', 'id'],
+                         name='store_product_updated_id_idx'),
+        ]
+
 
 class ProductImage(models.Model):
     product = models.ForeignKey(
         Product, on_delete=models.CASCADE, related_name='images')
-    image = models.ImageField(upload_to='store/images',
+    image = models.ImageField(upload_to='store/images', storage=image_storage,
                               validators=[validate_product_img_size,])
+    # resized WebP/fallback copies, written by store.images on upload
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
 
 
 class CategoryImage(models.Model):
     category = models.ForeignKey(
         Category, on_delete=models.CASCADE, related_name='images')
-    image = models.ImageField(upload_to='store/images',
+    image = models.ImageField(upload_to='store/images', storage=image_storage,
                               validators=[validate_product_img_size,])
+    # resized WebP/fallback copies, written by store.images on upload
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
 
 
 class Order(models.Model):
@@ -61,20 +140,112 @@ class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.PROTECT)
 
+    class Meta:
+        indexes = [
+            # customer order history: WHERE user_id = ? ORDER BY id DESC
+            models.Index(fields=['user', '-id'], name='store_order_user_id_idx'),
+        ]
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(
         Order, on_delete=models.CASCADE, related_name='items')
+    # Indexed by the covering index below instead of the default FK index
     product = models.ForeignKey(
-        Product, on_delete=models.CASCADE, related_name='orderitems')
+        Product, on_delete=models.CASCADE, related_name='orderitems', db_index=False)
     quantity = models.PositiveSmallIntegerField()
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            # per-product sales lookups read quantity/price from the index
+            # alone (INCLUDE is PostgreSQL-only, other databases ignore it)
+            models.Index(fields=['product'], include=['quantity', 'unit_price'],
+                         name='store_orderitem_product_idx'),
+        ]
+
+
+class CartManager(models.Manager):
+
+    def touch(self, cart_id):
+        """Mark the cart active now, so sweep_carts leaves it alone"""
+        self.filter(pk=cart_id).update(updated_at=timezone.now())
+
 
 class Cart(models.Model):
     id = models.UUIDField(default=uuid.uuid4,
                           primary_key=True, unique=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # last change to the cart or its items; abandoned carts are swept by it
+    updated_at = models.DateTimeField(default=timezone.now, db_index=True, editable=False)
+
+    objects = CartManager()
+
+
+# Largest CartItem.quantity on every backend (SQLite doesn't enforce it)
+MAX_CART_QUANTITY = BaseDatabaseOperations.integer_field_ranges['PositiveSmallIntegerField'][1]
+
+
+class CartItemManager(models.Manager):
+
+    def add_lines(self, cart_id, lines):
+        """
+        Add {product_id: quantity} lines to a cart in one statement.
+
+        INSERT ... ON CONFLICT (cart_id, product_id) DO UPDATE increments the
+        quantity of lines already in the cart, so concurrent adds of the same
+        product can't race into the unique_together constraint. Works on
+        PostgreSQL and SQLite >= 3.35 (RETURNING).
+
+        Raises ValidationError, adding nothing, when a line would take the
+        cart's quantity of a product above MAX_CART_QUANTITY. Otherwise the
+        cart's updated_at moves to now.
+        """
+        if not lines:
+            return []
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        cart_value = self.model._meta.get_field('cart').get_db_prep_value(
+            cart_id, connection)
+
+        values = ', '.join(['(%s, %s, %s)'] * len(lines))
+        params = []
+        for product_id, quantity in lines.items():
+            params += [cart_value, product_id, quantity]
+
+        sql = (
+            f'INSERT INTO {table} ({qn("cart_id")}, {qn("product_id")}, {qn("quantity")}) '
+            f'VALUES {values} '
+            f'ON CONFLICT ({qn("cart_id")}, {qn("product_id")}) DO UPDATE '
+            f'SET {qn("quantity")} = {table}.{qn("quantity")} + EXCLUDED.{qn("quantity")} '
+            # no row comes back for a line that would overflow
+            f'WHERE {table}.{qn("quantity")} + EXCLUDED.{qn("quantity")} <= %s '
+            f'RETURNING {qn("id")}, {qn("product_id")}, {qn("quantity")}'
+        )
+        params.append(MAX_CART_QUANTITY)
+        # one line is one statement, nothing to roll back
+        atomic = transaction.atomic(using=self.db) if len(lines) > 1 else nullcontext()
+        with atomic, connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            over = [str(product_id) for product_id in lines
+                    if product_id not in {row[1] for row in rows}]
+            if over:
+                # rolls back the lines that were added
+                raise ValidationError(
+                    f'Quantity in cart would exceed {MAX_CART_QUANTITY} for products: '
+                    f'{", ".join(over)}')
+        Cart.objects.db_manager(self.db).touch(cart_id)
+
+        items = {product_id: self.model(id=pk, cart_id=cart_id, product_id=product_id,
+                                        quantity=quantity)
+                 for pk, product_id, quantity in rows}
+        for item in items.values():
+            item._state.adding = False
+            item._state.db = self.db
+        # Same order as the lines that were sent
+        return [items[product_id] for product_id in lines]
 
 
 class CartItem(models.Model):
@@ -82,7 +253,9 @@ class CartItem(models.Model):
         Cart, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveSmallIntegerField(
-        validators=[MinValueValidator(1)])
+        validators=[MinValueValidator(1), MaxValueValidator(MAX_CART_QUANTITY)])
+
+    objects = CartItemManager()
 
     class Meta:
         # No duplicated records for the same product in the same cart
@@ -0,0 +1,210 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are addressed by the ordering values of the last row seen instead of
+an OFFSET, so page 1000 costs the same as page 1 and no COUNT(*) is needed.
+The primary key is always appended to the ordering as a tie-breaker, which
+keeps pages stable when many rows share a price or a timestamp.
+"""
+import base64
+import datetime
+import decimal
+import json
+from functools import reduce
+from operator import and_, or_
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    # Used when neither the view nor OrderingFilter ordered the queryset
+    default_ordering = ('-id',)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset, values, reverse = self.page_queryset(queryset, request)
+        return self.page_rows(list(queryset), values, reverse)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """paginate_queryset() for the async views, rows fetched with the async ORM"""
+        queryset, values, reverse = self.page_queryset(queryset, request)
+        return self.page_rows([row async for row in queryset], values, reverse)
+
+    def page_queryset(self, queryset, request):
+        """(queryset of the page plus one lookahead row, cursor values, reverse)"""
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset)
+
+        values, reverse = self.decode_cursor(request, queryset)
+        ordering = self.ordering
+        if reverse:
+            ordering = [self._flip(field) for field in ordering]
+
+        queryset = queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self._after(ordering, values))
+        return queryset[:self.page_size + 1], values, reverse
+
+    def page_rows(self, rows, values, reverse):
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        # Walking forward, `has_more` tells whether a next page exists and a
+        # cursor means we came from an earlier one; walking back it's the
+        # other way round.
+        if reverse:
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+        self.next_row = rows[-1] if rows and has_next else None
+        self.previous_row = rows[0] if rows and has_previous else None
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_ordering(self, queryset):
+        ordering = [field for field in queryset.query.order_by
+                    if isinstance(field, str)] or list(self.default_ordering)
+        pk_name = queryset.model._meta.pk.name
+        if not any(field.lstrip('-') in ('pk', pk_name) for field in ordering):
+            # Same direction as the last field so a (field, id) index can
+            # serve the whole ordering in one scan
+            direction = '-' if ordering[-1].startswith('-') else ''
+            ordering.append(f'{direction}{pk_name}')
+        return ordering
+
+    def get_next_link(self):
+        if self.next_row is None:
+            return None
+        return self.encode_cursor(self.next_row, reverse=False)
+
+    def get_previous_link(self):
+        if self.previous_row is None:
+            return None
+        return self.encode_cursor(self.previous_row, reverse=True)
+
+    # Cursor encoding
+
+    def encode_cursor(self, row, reverse):
+        values = [self._encode_value(self._value(row, field))
+                  for field in self.ordering]
+        payload = json.dumps({'v': values, 'r': int(reverse)})
+        cursor = base64.urlsafe_b64encode(payload.encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request, queryset):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            values, reverse = payload['v'], bool(payload['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        # a hand-edited cursor must not reach the WHERE with values the
+        # ordering fields can't take
+        try:
+            values = [self._ordering_field(queryset, field).to_python(value)
+                      for field, value in zip(self.ordering, values)]
+        except (TypeError, ValueError, ValidationError, FieldDoesNotExist):
+            raise NotFound(self.invalid_cursor_message)
+        if None in values:
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    # Keyset helpers
+
+    @staticmethod
+    def _flip(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    @staticmethod
+    def _after(ordering, values):
+        """
+        Lexicographic "row comes after the cursor" condition, i.e. for
+        ordering (a, -b, id): a > x OR (a = x AND b < y) OR (a = x AND b = y AND id > z)
+        """
+        clauses = []
+        for i, field in enumerate(ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            equal = [Q(**{ordering[j].lstrip('-'): values[j]}) for j in range(i)]
+            clauses.append(reduce(and_, equal + [Q(**{f'{name}__{lookup}': values[i]})]))
+        return reduce(or_, clauses)
+
+    @staticmethod
+    def _ordering_field(queryset, field):
+        """Model field (or annotation output field) behind an ordering entry"""
+        name = field.lstrip('-')
+        annotation = queryset.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        opts = queryset.model._meta
+        for attr in name.split('__'):
+            model_field = opts.pk if attr == 'pk' else opts.get_field(attr)
+            if model_field.related_model is not None:
+                opts = model_field.related_model._meta
+        return model_field
+
+    @staticmethod
+    def _value(row, field):
+        name = field.lstrip('-')
+        if isinstance(row, dict):
+            return row[name]
+        for attr in name.split('__'):
+            row = getattr(row, attr)
+        return row
+
+    @staticmethod
+    def _encode_value(value):
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        if isinstance(value, decimal.Decimal):
+            return str(value)
+        return value
+
+
+class ProductPagination(KeysetPagination):
+    # Newest first unless ?ordering=unit_price / last_update is given
+    default_ordering = ('-last_update',)
+
+
+class OrderPagination(KeysetPagination):
+    default_ordering = ('-id',)
@@ -0,0 +1,93 @@
+"""
+Representative queries of each viewset and an EXPLAIN-based scan check.
+
+Used by the check_query_plans command to catch plans that regress to a
+sequential scan of a large table (a dropped index, a new filter nobody
+indexed, ...).
+"""
+import re
+import uuid
+from dataclasses import dataclass
+
+from django.db import connections
+
+from . import models
+
+PG_SEQ_SCAN_RE = re.compile(r'Seq Scan on (\w+)')
+SQLITE_SCAN_RE = re.compile(r'\bSCAN (\w+)\b(?! USING)')
+
+
+@dataclass
+class SeqScan:
+    label: str
+    table: str
+    rows: int
+    plan: str
+
+
+def representative_queries():
+    """(label, queryset) pairs mirroring the hot paths of each viewset"""
+    category_id = models.Category.objects.values_list('id', flat=True).first() or 0
+    product_id = models.Product.objects.values_list('id', flat=True).first() or 0
+    user_id = models.Order.objects.values_list('user_id', flat=True).first() or 0
+    cart_id = models.Cart.objects.values_list('id', flat=True).first() or uuid.uuid4()
+    page = 20
+
+    products = models.Product.objects.select_related('category')
+    return [
+        ('products-list by category and price',
+         products.filter(category_id=category_id, unit_price__gt=10)
+         .order_by('unit_price', 'id')[:page]),
+        ('products-list newest first',
+         products.order_by('-last_update', '-id')[:page]),
+        ('products-list by price',
+         products.order_by('unit_price', 'id')[:page]),
+        ('products-detail', products.filter(pk=product_id)),
+        ('product-images prefetch',
+         models.ProductImage.objects.filter(product_id__in=[product_id])),
+        ('carts-detail items',
+         models.CartItem.objects.filter(cart_id=cart_id)),
+        ('orders-list customer',
+         models.Order.objects.filter(user_id=user_id).order_by('-id')[:page]),
+        ('orders-list staff', models.Order.objects.order_by('-id')[:page]),
+        ('order-items prefetch',
+         models.OrderItem.objects.filter(order_id__in=[1, 2, 3])),
+        ('order-items by product',
+         models.OrderItem.objects.filter(product_id=product_id)),
+    ]
+
+
+def table_rows(connection, table):
+    """Size of `table`: the planner's estimate on PostgreSQL, else COUNT(*)"""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # -1 until the table is first vacuumed/analyzed
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [table])
+            row = cursor.fetchone()
+            if row is not None and row[0] >= 0:
+                return int(row[0])
+        cursor.execute(f'SELECT COUNT(*) FROM {connection.ops.quote_name(table)}')
+        return cursor.fetchone()[0]
+
+
+def find_seq_scans(label, queryset, threshold):
+    """Sequential scans in the plan of `queryset` over tables of more than `threshold` rows"""
+    connection = connections[queryset.db]
+    plan = queryset.explain()
+    scans = []
+    if connection.vendor == 'postgresql':
+        # the node's rows= is the estimate after its filter, not what it reads
+        for table in dict.fromkeys(PG_SEQ_SCAN_RE.findall(plan)):
+            scans.append(SeqScan(label, table, table_rows(connection, table), plan))
+    elif connection.vendor == 'sqlite':
+        # SQLite plans carry no row estimates; use the table size instead.
+        # A scan already in the requested order (no temp b-tree sort) stops
+        # after LIMIT rows, e.g. ORDER BY id DESC LIMIT 20 walking the rowid.
+        limit = queryset.query.high_mark
+        presorted = 'TEMP B-TREE' not in plan
+        for table in SQLITE_SCAN_RE.findall(plan):
+            rows = table_rows(connection, table)
+            if limit is not None and presorted:
+                rows = min(rows, limit)
+            scans.append(SeqScan(label, table, rows, plan))
+    return [scan for scan in scans if scan.rows > threshold]
@@ -0,0 +1,74 @@
+import csv
+import io
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+_encoder = JSONEncoder()
+
+
+def _default(obj):
+    # Anything orjson can't encode natively (Decimal, lazy strings, ...)
+    # goes through DRF's encoder so the output stays the same
+    return _encoder.default(obj)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer producing the same bytes as DRF's compact output, using
+    orjson when it is installed.
+
+    Falls back to the stock renderer for indented output (browsable API,
+    `Accept: application/json; indent=4`) or when orjson is missing.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if orjson is None or indent is not None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # Datetimes go through DRF's encoder too: orjson's own format differs
+        ret = orjson.dumps(data, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME |
+                           orjson.OPT_NON_STR_KEYS)
+        # Same strict-javascript-subset escaping as JSONRenderer
+        return ret.replace('\u2028'.encode(), b'\\u2028') \
+                  .replace('\u2029'.encode(), b'\\u2029')
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    text/csv for the order export. The export streams its own rows, this
+    only renders the non-streamed responses (errors) as a one-row CSV.
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not isinstance(data, dict):
+            data = {'detail': data}
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(data.keys())
+        writer.writerow(data.values())
+        return out.getvalue().encode(self.charset)
+
+
+class NDJSONRenderer(FastJSONRenderer):
+    """application/x-ndjson, one JSON document per line"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return super().render(data, accepted_media_type, renderer_context) + b'\n'
@@ -0,0 +1,206 @@
+"""
+Ranked product search over a precomputed search document.
+
+On PostgreSQL every product keeps a weighted tsvector (title 'A',
+description 'B') in Product.search_vector, backed by a GIN index, and
+results are ranked with ts_rank. Other databases (SQLite in tests and
+local development) use an in-process inverted index instead, built lazily
+from the product table and updated incrementally on save/delete. That
+index lives in each worker process, so it is only meant as a fallback.
+"""
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Cast
+from rest_framework.filters import SearchFilter
+
+from . import models
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Relative weight of a title match vs a description match, mirroring the
+# 'A'/'B' tsvector weights used on PostgreSQL
+FIELD_WEIGHTS = {'title': 1.0, 'description': 0.4}
+
+
+def search_config():
+    return getattr(settings, 'SEARCH_CONFIG', 'english')
+
+
+def uses_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or '').lower())
+
+
+def product_search_vector():
+    config = search_config()
+    return (SearchVector('title', weight='A', config=config) +
+            SearchVector('description', weight='B', config=config))
+
+
+class InvertedIndex:
+    """token -> {product_id: weighted term frequency}"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = False
+        self._postings = defaultdict(dict)
+        self._documents = {}
+
+    def reset(self):
+        with self._lock:
+            self._built = False
+            self._postings = defaultdict(dict)
+            self._documents = {}
+
+    def rebuild(self):
+        rows = models.Product.objects.values_list('id', 'title', 'description')
+        with self._lock:
+            self.reset()
+            for product_id, title, description in rows.iterator():
+                self._add(product_id, title, description)
+            self._built = True
+
+    def _ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def _add(self, product_id, title, description):
+        weights = defaultdict(float)
+        for field, text in (('title', title), ('description', description)):
+            for token in tokenize(text):
+                weights[token] += FIELD_WEIGHTS[field]
+        for token, weight in weights.items():
+            self._postings[token][product_id] = weight
+        self._documents[product_id] = set(weights)
+
+    def _remove(self, product_id):
+        for token in self._documents.pop(product_id, ()):
+            postings = self._postings[token]
+            postings.pop(product_id, None)
+            if not postings:
+                del self._postings[token]
+
+    def update(self, product):
+        with self._lock:
+            if not self._built:
+                # The next search builds from the table anyway
+                return
+            self._remove(product.pk)
+            self._add(product.pk, product.title, product.description)
+
+    def remove(self, product_id):
+        with self._lock:
+            if self._built:
+                self._remove(product_id)
+
+    def search(self, terms):
+        """
+        Return {product_id: score} for products matching every term.
+
+        The last term also matches as a prefix, so results show up while the
+        user is still typing. Scores are summed tf-idf.
+        """
+        tokens = [token for term in terms for token in tokenize(term)]
+        if not tokens:
+            return {}
+
+        with self._lock:
+            self._ensure_built()
+            total = len(self._documents) or 1
+            scores = None
+            for i, token in enumerate(tokens):
+                postings = dict(self._postings.get(token, {}))
+                if i == len(tokens) - 1:
+                    for candidate, candidate_postings in self._postings.items():
+                        if candidate != token and candidate.startswith(token):
+                            for product_id, weight in candidate_postings.items():
+                                postings[product_id] = max(
+                                    postings.get(product_id, 0), weight)
+                if not postings:
+                    return {}
+                idf = math.log(1 + total / len(postings))
+                term_scores = {pid: weight * idf for pid, weight in postings.items()}
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {pid: score + term_scores[pid]
+                              for pid, score in scores.items() if pid in term_scores}
+                if not scores:
+                    return {}
+            return scores
+
+
+memory_index = InvertedIndex()
+
+
+def index_product(product):
+    if uses_postgres():
+        models.Product.objects.filter(pk=product.pk) \
+            .update(search_vector=product_search_vector())
+    else:
+        memory_index.update(product)
+
+
+def remove_product(product_id):
+    if not uses_postgres():
+        memory_index.remove(product_id)
+
+
+def rebuild_index():
+    if uses_postgres():
+        models.Product.objects.update(search_vector=product_search_vector())
+    else:
+        memory_index.rebuild()
+
+
+def raw_tsquery(terms):
+    tokens = [token for term in terms for token in tokenize(term)]
+    if not tokens:
+        return None
+    tokens[-1] += ':*'
+    return ' & '.join(tokens)
+
+
+class ProductSearchFilter(SearchFilter):
+    """
+    Drop-in replacement for SearchFilter on products.
+
+    Matches against the indexed search document and annotates
+    `search_rank`; results are ordered by it unless ?ordering= is given.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+
+        if uses_postgres():
+            tsquery = raw_tsquery(terms)
+            if tsquery is None:
+                return queryset.none()
+            query = SearchQuery(tsquery, search_type='raw', config=search_config())
+            # Cast to double precision so the rank round-trips exactly
+            # through a pagination cursor
+            queryset = queryset.filter(search_vector=query).annotate(
+                search_rank=Cast(SearchRank(F('search_vector'), query), FloatField()))
+        else:
+            scores = memory_index.search(terms)
+            if not scores:
+                return queryset.none()
+            queryset = queryset.filter(id__in=scores).annotate(search_rank=Case(
+                *[When(id=pid, then=Value(score)) for pid, score in scores.items()],
+                output_field=FloatField()))
+
+        if not request.query_params.get('ordering'):
+            queryset = queryset.order_by('-search_rank')
+        return queryset
@@ -0,0 +1,84 @@
+"""
+Helpers for seeding a realistic catalog and order history.
+
+Used by the test suite and the benchmark commands so both exercise
+the same shape of data.
+"""
+import random
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+
+from . import models
+
+User = get_user_model()
+
+
+def seed_catalog(categories=5, products_per_category=20, images_per_product=2, seed=0):
+    """Create categories with images, products and product images in bulk"""
+    rnd = random.Random(seed)
+
+    category_objs = models.Category.objects.bulk_create([
+        models.Category(title=f'Category {uuid.uuid4().hex[:8]}',
+                        product_count=products_per_category)
+        for _ in range(categories)
+    ])
+    models.CategoryImage.objects.bulk_create([
+        models.CategoryImage(category=category,
+                             image=f'store/images/category-{category.id}.jpg')
+        for category in category_objs
+    ])
+
+    product_objs = models.Product.objects.bulk_create([
+        models.Product(
+            title=f'Product {c}-{p}',
+            description=f'Description of product {p} in category {c}',
+            unit_price=Decimal(rnd.randint(100, 100000)) / 100,
+            inventory=rnd.randint(50, 500),
+            category=category,
+        )
+        for c, category in enumerate(category_objs)
+        for p in range(products_per_category)
+    ])
+    models.ProductImage.objects.bulk_create([
+        models.ProductImage(product=product,
+                            image=f'store/images/product-{product.id}-{i}.jpg')
+        for product in product_objs
+        for i in range(images_per_product)
+    ])
+    return category_objs, product_objs
+
+
+def seed_user(email=None, is_staff=False):
+    email = email or f'{uuid.uuid4().hex[:12]}@ebuy.test'
+    return User.objects.create_user(
+        email=email, full_name='Seed User', password='pass',
+        is_active=True, is_staff=is_staff)
+
+
+def seed_cart(products, items=3, seed=0):
+    """Create a cart holding `items` distinct products"""
+    rnd = random.Random(seed)
+    cart = models.Cart.objects.create()
+    models.CartItem.objects.bulk_create([
+        models.CartItem(cart=cart, product=product, quantity=rnd.randint(1, 3))
+        for product in rnd.sample(list(products), items)
+    ])
+    return cart
+
+
+def seed_orders(user, products, orders=10, items_per_order=3, seed=0):
+    """Create an order history for `user` with a few items per order"""
+    rnd = random.Random(seed)
+    order_objs = models.Order.objects.bulk_create([
+        models.Order(user=user) for _ in range(orders)
+    ])
+    order_items = []
+    for order in order_objs:
+        for product in rnd.sample(list(products), items_per_order):
+            order_items.append(models.OrderItem(
+                order=order, product=product,
+                quantity=rnd.randint(1, 3), unit_price=product.unit_price))
+    models.OrderItem.objects.bulk_create(order_items)
+    return order_objs
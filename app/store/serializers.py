@@ -1,12 +1,25 @@
 from rest_framework import serializers
 from . import models
-from decimal import Decimal
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from . import images
 from django.contrib.auth import get_user_model
 User = get_user_model()
 
 
-class ProductImageSerializer(serializers.ModelSerializer):
+class SrcsetMixin(serializers.Serializer):
+    # resized WebP + fallback copies of the image, see store.images
+    srcset = serializers.SerializerMethodField()
+
+    def get_srcset(self, instance):
+        request = self.context.get('request')
+        return images.srcset(instance.image.storage, instance.image.name, instance.derivatives,
+                             request.build_absolute_uri if request is not None else None)
+
+
+class ProductImageSerializer(SrcsetMixin, serializers.ModelSerializer):
 
     def create(self, validated_data):
         product_id = self.context['product_id']
@@ -14,10 +27,10 @@ class ProductImageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = models.ProductImage
-        fields = ['id', 'image']
+        fields = ['id', 'image', 'srcset']
 
 
-class CategoryImageSerializer(serializers.ModelSerializer):
+class CategoryImageSerializer(SrcsetMixin, serializers.ModelSerializer):
 
     def create(self, validated_data):
         product_id = self.context['category_id']
@@ -25,7 +38,7 @@ class CategoryImageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = models.CategoryImage
-        fields = ['id', 'image']
+        fields = ['id', 'image', 'srcset']
 
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -48,12 +61,10 @@ class ProductSerializer(serializers.ModelSerializer):
         fields = ['id', 'title', 'last_update', 'description', 'inventory',
                   'unit_price', 'price_with_tax', 'category', 'images']
 
-    # CustomSerializerField
-    price_with_tax = serializers.SerializerMethodField(
-        method_name='calculate_tax')
-
-    def calculate_tax(self, product: models.Product):
-        return round((product.unit_price * Decimal(1.1)), 2)
+    # Annotated in SQL by Product.objects.with_price_with_tax(), using the
+    # category tax rate
+    price_with_tax = serializers.DecimalField(
+        max_digits=12, decimal_places=2, read_only=True)
 
 
 class SimpleProductSerializer(serializers.ModelSerializer):
@@ -96,40 +107,76 @@ class CartSerializer(serializers.ModelSerializer):
         fields = ['id', 'items', 'total_price']
 
 
+class AddCartItemListSerializer(serializers.ListSerializer):
+    """Add several {product_id, quantity} lines to a cart in one POST"""
+
+    def __init__(self, *args, **kwargs):
+        # an empty batch would be an INSERT without VALUES
+        kwargs.setdefault('allow_empty', False)
+        super().__init__(*args, **kwargs)
+
+    # One query validates every product_id instead of an exists() per line
+    def validate(self, attrs):
+        product_ids = {line['product_id'] for line in attrs}
+        found = set(models.Product.objects.filter(
+            pk__in=product_ids).values_list('pk', flat=True))
+        missing = sorted(product_ids - found)
+        if missing:
+            raise serializers.ValidationError(
+                f'No products with given id: {", ".join(map(str, missing))}')
+        over = sorted(product_id for product_id, quantity in merge_lines(attrs).items()
+                      if quantity > models.MAX_CART_QUANTITY)
+        if over:
+            raise serializers.ValidationError(
+                f'Quantity would exceed {models.MAX_CART_QUANTITY} for products: '
+                f'{", ".join(map(str, over))}')
+        return attrs
+
+    def create(self, validated_data):
+        return add_lines(self.context['cart_id'], merge_lines(validated_data))
+
+
+def merge_lines(lines):
+    """Repeated products in one request are merged into a single line"""
+    merged = {}
+    for line in lines:
+        merged[line['product_id']] = merged.get(line['product_id'], 0) + line['quantity']
+    return merged
+
+
+def add_lines(cart_id, lines):
+    try:
+        return models.CartItem.objects.add_lines(cart_id, lines)
+    except DjangoValidationError as error:
+        raise serializers.ValidationError({'quantity': error.messages})
+
+
 class AddCartItemSerializer(serializers.ModelSerializer):
     # product_id declaration
     product_id = serializers.IntegerField()
 
     # Validating product_id, if it is not exists then rise an error message
     def validate_product_id(self, value):
+        # the list serializer checks all lines at once
+        if isinstance(self.parent, serializers.ListSerializer):
+            return value
         if not models.Product.objects.filter(pk=value).exists():
             raise serializers.ValidationError('No products with given id')
         return value
 
-    # Override, create a new cartitem or update an existing one
+    # Override, create a new cartitem or add to the quantity of an existing one
     def save(self, **kwargs):
         cart_id = self.context['cart_id']
         product_id = self.validated_data['product_id']
         quantity = self.validated_data['quantity']
 
-        try:
-            cart_item = models.CartItem.objects.get(
-                cart_id=cart_id, product_id=product_id)
-            # update an item
-            cart_item.quantity += quantity
-            cart_item.save()
-            self.instance = cart_item
-
-        except models.CartItem.DoesNotExist:
-            # create an item
-            self.instance = models.CartItem.objects.create(
-                cart_id=cart_id, **self.validated_data)
-
+        self.instance, = add_lines(cart_id, {product_id: quantity})
         return self.instance
 
     class Meta:
         model = models.CartItem
         fields = ['id', 'product_id', 'quantity']
+        list_serializer_class = AddCartItemListSerializer
 
 
 class UpdateCartItemSerializer(serializers.ModelSerializer):
@@ -146,7 +193,6 @@ class OrderItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'unit_price', 'quantity']
 
 
-# FIXME: 94 quries executing while send get
 class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
     # payment = PaymentSerializer(many=True)
@@ -184,9 +230,14 @@ class CreateOrderSerializer(serializers.Serializer):
             user_id = self.context['user_id']
             # print('user',user_id)
 
+            # product_id order keeps the row locks taken below in the same
+            # order for every checkout, so two carts can't deadlock
             cart_items = models.CartItem.objects \
                 .select_related('product') \
-                .filter(cart_id=cart_id)
+                .filter(cart_id=cart_id) \
+                .order_by('product_id')
+
+            self.reserve_inventory(cart_items)
 
             total_price = sum([(item.quantity * item.product.unit_price)
                                for item in cart_items])
@@ -215,11 +266,34 @@ class CreateOrderSerializer(serializers.Serializer):
             # delete cart
             models.Cart.objects.filter(pk=cart_id).delete()
 
+            # no catalog version bump: reserve_inventory() touches the
+            # bought products' last_update, which changes the ETag that
+            # their cached responses are keyed by (store.cache)
+
             # send signal
             # order_created.send_robust(sender=self.__class__, order=order)
 
             return order
 
+    def reserve_inventory(self, cart_items):
+        """
+        Decrement stock with one conditional UPDATE per product.
+
+        The WHERE inventory >= quantity check and the decrement happen in
+        the same statement, so concurrent checkouts can't both pass a stale
+        read. Only the rows being bought are locked, so checkouts of
+        different products never wait on each other. Raising rolls back
+        every reservation already made for this order.
+        """
+        for item in cart_items:
+            reserved = models.Product.objects \
+                .filter(pk=item.product_id, inventory__gte=item.quantity) \
+                .update(inventory=F('inventory') - item.quantity,
+                        last_update=timezone.now())
+            if not reserved:
+                raise serializers.ValidationError(
+                    {'cart_id': f'Not enough stock for {item.product.title}'})
+
 
 class FeedbackSerializer(serializers.ModelSerializer):
     class Meta:
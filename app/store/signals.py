@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import images
+from . import models
+from . import search
+from .cache import bump_catalog_version
+
+
+# Bump once when the write is visible to other connections, otherwise a
+# concurrent reader could cache the old rows under the new version.
+# Receivers are bound per sender so deletes of other models (carts, orders)
+# keep Django's fast-delete path.
+@receiver(post_save, sender=models.Product)
+@receiver(post_save, sender=models.ProductImage)
+@receiver(post_save, sender=models.Category)
+@receiver(post_save, sender=models.CategoryImage)
+@receiver(post_delete, sender=models.Product)
+@receiver(post_delete, sender=models.ProductImage)
+@receiver(post_delete, sender=models.Category)
+@receiver(post_delete, sender=models.CategoryImage)
+def invalidate_catalog_cache(sender, **kwargs):
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(post_save, sender=models.Product)
+def index_product(sender, instance, **kwargs):
+    if search.uses_postgres():
+        search.index_product(instance)
+    else:
+        transaction.on_commit(lambda: search.index_product(instance))
+
+
+@receiver(post_delete, sender=models.Product)
+def unindex_product(sender, instance, **kwargs):
+    product_id = instance.pk
+    transaction.on_commit(lambda: search.remove_product(product_id))
+
+
+# Resize after commit so the request's transaction isn't held open meanwhile.
+# on_commit still runs in the request, so the upload response waits for every
+# derivative to be encoded; with IMAGE_DERIVATIVES_ON_UPLOAD off that is left
+# to `generate_image_derivatives --loop` instead.
+@receiver(post_save, sender=models.ProductImage)
+@receiver(post_save, sender=models.CategoryImage)
+def generate_image_derivatives(sender, instance, **kwargs):
+    if not settings.IMAGE_DERIVATIVES_ON_UPLOAD:
+        return
+    if instance.image.name and not images.is_current(instance.derivatives, instance.image.name):
+        transaction.on_commit(lambda: images.update_derivatives(instance))
+
+
+# Category.product_count bookkeeping. Product.save runs in a transaction, so
+# the counter changes commit together with the product row. The row lock
+# makes a concurrent move of the same product wait and then see the new
+# category, instead of both decrementing the original one.
+@receiver(pre_save, sender=models.Product)
+def remember_previous_category(sender, instance, using, **kwargs):
+    instance._previous_category_id = None
+    if not instance._state.adding:
+        instance._previous_category_id = models.Product.objects.using(using) \
+            .select_for_update().filter(pk=instance.pk) \
+            .values_list('category_id', flat=True).first()
+
+
+def adjust_product_count(category_id, delta):
+    models.Category.objects.filter(pk=category_id) \
+        .update(product_count=F('product_count') + delta)
+
+
+@receiver(post_save, sender=models.Product)
+def count_saved_product(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous_category_id', None)
+    if created or previous is None:
+        adjust_product_count(instance.category_id, 1)
+    elif previous != instance.category_id:
+        adjust_product_count(previous, -1)
+        adjust_product_count(instance.category_id, 1)
+
+
+@receiver(post_delete, sender=models.Product)
+def count_deleted_product(sender, instance, **kwargs):
+    adjust_product_count(instance.category_id, -1)
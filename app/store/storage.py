@@ -0,0 +1,50 @@
+"""
+Content-addressed media storage.
+
+Files are stored under their SHA-256, so the same bytes uploaded twice are
+kept once and a name (and so its URL) always refers to the same content.
+That makes the URLs safe to serve with `Cache-Control: immutable`, see the
+`/static/media` location in proxy/nginx.
+"""
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils.module_loading import import_string
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    FileSystemStorage that names files `<upload dir>/<h[:2]>/<sha256><ext>`.
+
+    The requested name only contributes its directory and extension. Files
+    are shared between rows, so nothing here deletes them.
+    """
+
+    def hashed_name(self, name, content):
+        digest = hashlib.sha256()
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        digest = digest.hexdigest()
+        directory, filename = os.path.split(name)
+        ext = os.path.splitext(filename)[1].lower()
+        return os.path.join(directory, digest[:2], digest + ext).replace('\\', '/')
+
+    def _save(self, name, content):
+        name = self.hashed_name(name, content)
+        if self.exists(name):
+            # identical bytes already stored
+            return name
+        # two uploads racing on the same new hash: the loser gets a suffixed
+        # copy from get_available_name(), still immutable
+        return super()._save(name, content)
+
+
+def image_storage():
+    """Storage of ProductImage/CategoryImage, settings.IMAGE_STORAGE"""
+    return import_string(settings.IMAGE_STORAGE)()
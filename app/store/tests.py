@@ -1,3 +1,1565 @@
-from django.test import TestCase
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.base import BaseHandler
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.test import AsyncClient, TestCase, override_settings
+from django.utils import timezone
+from unittest import mock, skipUnless
+from PIL import Image
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import NotFound
+from rest_framework.renderers import JSONRenderer
+from rest_framework.serializers import BaseSerializer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from app.db.replicas import ReplicaRouter, read_from
+from app.metrics import Registry, registry
+from app.query_inspector import normalize
+from app.ratelimit import SlidingWindowLimiter, parse_rate
+
+from . import fastpath, models, search, serializers, views
+from .query_plans import find_seq_scans
+from .renderers import FastJSONRenderer
+from .storage import ContentAddressedStorage
+from .cache import CATALOG_BUMPED_KEY, CATALOG_VERSION_KEY, get_catalog_version, get_or_build, stats
+from .seeding import seed_catalog, seed_cart, seed_orders, seed_user
+
+
+# reads of data written by the test itself stay on `default` even when
+# DB_REPLICAS is set; ReplicaRoutingTests turn the replicas back on
+@override_settings(DATABASE_REPLICAS=[])
+class StoreTestCase(TestCase):
+    """Start every test with an empty cache and a search index in sync"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        search.memory_index.rebuild()
+        self.client = APIClient()
+
+
+class QueryBudgetMixin:
+    """
+    Run a request and assert it stays within a fixed number of SQL queries.
+
+    The budget is independent of the seeded data size, so any N+1 on a
+    nested serializer blows it. Wall time of every call is recorded and
+    printed as a small report once the test case finishes.
+    """
+    timings = []
+
+    def assertQueryBudget(self, budget, method, url, data=None, status_code=200):
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            response = getattr(self.client, method)(url, data, format='json')
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual(response.status_code, status_code, response.content)
+        queries = len(ctx.captured_queries)
+        self.assertLessEqual(
+            queries, budget,
+            f'{method.upper()} {url} ran {queries} queries (budget {budget}):\n' +
+            '\n'.join(q['sql'] for q in ctx.captured_queries))
+        QueryBudgetMixin.timings.append(
+            (f'{method.upper()} {url}', queries, elapsed * 1000))
+        return response
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if cls.timings:
+            sys.stderr.write(f'\n{cls.__name__} wall times:\n')
+            for label, queries, ms in cls.timings:
+                sys.stderr.write(f'  {ms:8.2f} ms  {queries:3d} q  {label}\n')
+            QueryBudgetMixin.timings = []
+
+
+class StoreEndpointBudgetTests(QueryBudgetMixin, StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(
+            categories=5, products_per_category=10, images_per_product=2)
+        cls.user = seed_user()
+        cls.staff = seed_user(is_staff=True)
+        cls.orders = seed_orders(cls.user, cls.products, orders=15)
+        seed_orders(cls.staff, cls.products, orders=5)
+
+    def test_product_list(self):
+        response = self.assertQueryBudget(3, 'get', '/store/products/?page_size=100')
+        self.assertEqual(len(response.data['results']), len(self.products))
+
+    def test_product_filter_search_and_ordering(self):
+        category = self.categories[0]
+        self.assertQueryBudget(
+            4, 'get', f'/store/products/?category_id={category.id}&unit_price__gt=1')
+        self.assertQueryBudget(3, 'get', '/store/products/?search=Product')
+        self.assertQueryBudget(3, 'get', '/store/products/?ordering=-unit_price')
+
+    def test_product_detail(self):
+        self.assertQueryBudget(
+            3, 'get', f'/store/products/{self.products[0].id}/')
+
+    def test_product_delete_with_orders_is_rejected(self):
+        product_id = models.OrderItem.objects.values_list(
+            'product_id', flat=True).first()
+        self.client.force_authenticate(self.staff)
+        self.assertQueryBudget(
+            1, 'delete', f'/store/products/{product_id}/',
+            status_code=405)
+
+    def test_category_list(self):
+        response = self.assertQueryBudget(2, 'get', '/store/categories/')
+        self.assertEqual(response.data[0]['product_count'], 10)
+
+    def test_category_detail(self):
+        self.assertQueryBudget(
+            2, 'get', f'/store/categories/{self.categories[0].id}/')
+
+    def test_cart_lifecycle(self):
+        response = self.assertQueryBudget(
+            3, 'post', '/store/carts/', {}, status_code=201)
+        cart_id = response.data['id']
+        # + UPDATE store_cart: every item change moves cart.updated_at
+        self.assertQueryBudget(
+            3, 'post', f'/store/carts/{cart_id}/items/',
+            {'product_id': self.products[0].id, 'quantity': 1}, status_code=201)
+        response = self.assertQueryBudget(
+            3, 'post', f'/store/carts/{cart_id}/items/',
+            {'product_id': self.products[0].id, 'quantity': 2}, status_code=201)
+        self.assertEqual(response.data['quantity'], 3)
+        lines = [{'product_id': p.id, 'quantity': 1} for p in self.products[:10]]
+        # + SAVEPOINT/RELEASE: a batch is rolled back if one line would overflow
+        self.assertQueryBudget(
+            5, 'post', f'/store/carts/{cart_id}/items/', lines, status_code=201)
+
+    def test_cart_detail(self):
+        cart = seed_cart(self.products, items=5)
+        response = self.assertQueryBudget(4, 'get', f'/store/carts/{cart.id}/')
+        self.assertEqual(len(response.data['items']), 5)
+
+    def test_cart_items(self):
+        cart = seed_cart(self.products, items=5)
+        self.assertQueryBudget(3, 'get', f'/store/carts/{cart.id}/items/')
+        item = cart.items.first()
+        self.assertQueryBudget(
+            4, 'patch', f'/store/carts/{cart.id}/items/{item.id}/', {'quantity': 4})
+        self.assertQueryBudget(
+            4, 'delete', f'/store/carts/{cart.id}/items/{item.id}/', status_code=204)
+
+    def test_order_list_customer(self):
+        self.client.force_authenticate(self.user)
+        response = self.assertQueryBudget(4, 'get', '/store/orders/')
+        self.assertEqual(len(response.data['results']), len(self.orders))
+
+    def test_order_list_staff(self):
+        self.client.force_authenticate(self.staff)
+        response = self.assertQueryBudget(4, 'get', '/store/orders/?page_size=100')
+        self.assertEqual(len(response.data['results']), models.Order.objects.count())
+
+    def test_order_detail(self):
+        self.client.force_authenticate(self.user)
+        self.assertQueryBudget(4, 'get', f'/store/orders/{self.orders[0].id}/')
+
+    def test_order_update(self):
+        self.client.force_authenticate(self.staff)
+        self.assertQueryBudget(
+            2, 'patch', f'/store/orders/{self.orders[0].id}/', {'is_shipped': True})
+
+    def test_order_create(self):
+        cart = seed_cart(self.products, items=5)
+        self.client.force_authenticate(self.user)
+        response = self.assertQueryBudget(
+            19, 'post', '/store/orders/', {'cart_id': str(cart.id)})
+        self.assertEqual(len(response.data['items']), 5)
+
+    def test_feedback(self):
+        self.assertQueryBudget(
+            1, 'post', '/store/feedback/',
+            {'name': 'a', 'email': 'a@b.c', 'mobile': '1', 'comment': 'ok'},
+            status_code=201)
+
+
+class CatalogCacheTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(
+            categories=2, products_per_category=5)
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+    def test_second_anonymous_get_is_served_from_cache(self):
+        first = self.client.get('/store/products/')
+        self.assertEqual(first['X-Cache'], 'MISS')
+        # only the ETag/Last-Modified aggregate runs
+        with self.assertNumQueries(1):
+            second = self.client.get('/store/products/')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(stats.as_dict()['hits'], 1)
+        self.assertEqual(stats.as_dict()['misses'], 1)
+
+    def test_query_params_are_part_of_the_key(self):
+        self.client.get('/store/products/?ordering=unit_price')
+        response = self.client.get('/store/products/?ordering=-unit_price')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        response = self.client.get(
+            f'/store/products/?search=Product&category_id={self.categories[0].id}')
+        self.assertEqual(len(response.data['results']), 5)
+        response = self.client.get(
+            f'/store/products/?category_id={self.categories[0].id}&search=Product')
+        self.assertEqual(response['X-Cache'], 'HIT')
+
+    def test_catalog_writes_bump_the_version(self):
+        for instance in (self.products[0], self.categories[0]):
+            version = get_catalog_version()
+            with self.captureOnCommitCallbacks(execute=True):
+                instance.title = 'Renamed'
+                instance.save()
+            self.assertGreater(get_catalog_version(), version)
+
+        self.client.get(f'/store/products/{self.products[1].id}/')
+        with self.captureOnCommitCallbacks(execute=True):
+            models.ProductImage.objects.filter(product=self.products[1]).delete()
+            self.products[1].images.create(image='store/images/new.jpg')
+        response = self.client.get(f'/store/products/{self.products[1].id}/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.data['images']), 1)
+
+    def test_authenticated_requests_bypass_the_cache(self):
+        self.client.force_authenticate(seed_user())
+        self.client.get('/store/categories/')
+        response = self.client.get('/store/categories/')
+        self.assertFalse(response.has_header('X-Cache'))
+
+    def test_waiters_reuse_the_value_built_by_the_lock_holder(self):
+        key = 'store:catalog:test'
+        cache.add(f'{key}:lock', 1)
+        cache.set(key, 'built elsewhere')
+        value, hit = get_or_build(key, lambda: self.fail('rebuilt a hot key'))
+        self.assertEqual((value, hit), ('built elsewhere', True))
+
+    @override_settings(CATALOG_CACHE_LOCK_TIMEOUT=10)
+    def test_waiters_stop_waiting_when_the_builder_caches_nothing(self):
+        # a 404/400 response builds None, a raising handler stores nothing either
+        def not_found():
+            raise NotFound()
+
+        for label, build in (('404', lambda: None), ('raises', not_found)):
+            with self.subTest(label):
+                key = f'store:catalog:test:{label}'
+                building, release = threading.Event(), threading.Event()
+
+                def slow_build():
+                    building.set()
+                    release.wait(5)
+                    return build()
+
+                def builder():
+                    try:
+                        get_or_build(key, slow_build)
+                    except NotFound:
+                        pass
+
+                thread = threading.Thread(target=builder)
+                thread.start()
+                building.wait(5)
+                waiter_calls = []
+                threading.Timer(0.2, release.set).start()
+                start = time.monotonic()
+                value, hit = get_or_build(key, lambda: waiter_calls.append(1))
+                thread.join()
+                # built itself as soon as the lock was released, not after 10s
+                self.assertLess(time.monotonic() - start, 2)
+                self.assertEqual((value, hit, waiter_calls), (None, False, [1]))
+
+
+class ConditionalGetTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(
+            categories=2, products_per_category=5)
+
+    def test_list_and_detail_carry_validators(self):
+        for url in ('/store/products/', f'/store/products/{self.products[0].id}/'):
+            response = self.client.get(url)
+            self.assertTrue(response['ETag'].startswith('"'))
+            self.assertIn('Last-Modified', response)
+
+    def test_if_none_match_returns_304_without_serializing(self):
+        url = f'/store/products/?category_id={self.categories[0].id}'
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_if_modified_since_returns_304(self):
+        url = f'/store/products/{self.products[0].id}/'
+        last_modified = self.client.get(url)['Last-Modified']
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_changes_when_the_filtered_rows_change(self):
+        url = f'/store/products/?category_id={self.categories[0].id}'
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Product.objects.filter(pk=self.products[0].pk).delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_missing_product_is_still_404(self):
+        response = self.client.get('/store/products/999999/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_non_numeric_pk_is_404(self):
+        self.assertEqual(self.client.get('/store/products/abc/').status_code, 404)
+        with override_settings(CATALOG_FAST_SERIALIZATION=True):
+            self.assertEqual(self.client.get('/store/products/abc/').status_code, 404)
+
+
+class KeysetPaginationTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(
+            categories=3, products_per_category=15)
+        # lots of ties so the id tie-breaker matters
+        models.Product.objects.filter(id__in=[p.id for p in cls.products[::2]]) \
+            .update(unit_price=10)
+
+    def walk(self, url):
+        ids = []
+        while url:
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            for query in ctx.captured_queries:
+                self.assertNotIn('OFFSET', query['sql'])
+                self.assertNotIn('COUNT(*)', query['sql'])
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_pages_cover_every_product_once_for_each_ordering(self):
+        for ordering in ('', 'unit_price', '-unit_price', 'last_update', '-last_update'):
+            ids = self.walk(f'/store/products/?page_size=7&ordering={ordering}')
+            self.assertEqual(sorted(ids), sorted(p.id for p in self.products), ordering)
+
+    def test_ordering_is_stable_across_pages(self):
+        ids = self.walk('/store/products/?page_size=4&ordering=unit_price')
+        expected = list(models.Product.objects.order_by('unit_price', 'id')
+                        .values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_previous_link_returns_the_preceding_page(self):
+        first = self.client.get('/store/products/?page_size=5&ordering=-unit_price')
+        self.assertIsNone(first.data['previous'])
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(back.data['results'], first.data['results'])
+        self.assertIsNone(back.data['previous'])
+
+    def test_deep_page_costs_the_same_as_the_first(self):
+        url = '/store/products/?page_size=5'
+        with CaptureQueriesContext(connection) as first:
+            response = self.client.get(url)
+        for _ in range(5):
+            response = self.client.get(response.data['next'])
+        with CaptureQueriesContext(connection) as deep:
+            self.client.get(response.data['next'])
+        self.assertEqual(len(first.captured_queries), len(deep.captured_queries))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/store/products/?cursor=garbage')
+        self.assertEqual(response.status_code, 404)
+
+    def test_tampered_cursor(self):
+        for ordering, values in [('unit_price', ['abc', 1]), ('last_update', ['x', 1]),
+                                 ('price_with_tax', [[1], 1]), ('unit_price', [None, 1])]:
+            with self.subTest(ordering=ordering, values=values):
+                payload = json.dumps({'v': values, 'r': 0}).encode()
+                cursor = base64.urlsafe_b64encode(payload).decode()
+                response = self.client.get(f'/store/products/?ordering={ordering}&cursor={cursor}')
+                self.assertEqual(response.status_code, 404)
+
+    def test_orders_are_paginated_newest_first(self):
+        user = seed_user()
+        orders = seed_orders(user, self.products, orders=25, items_per_order=1)
+        self.client.force_authenticate(user)
+        ids = self.walk('/store/orders/?page_size=10')
+        self.assertEqual(ids, sorted((o.id for o in orders), reverse=True))
+
+
+class ProductSearchTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.phones = models.Category.objects.create(title='Phones')
+        cls.books = models.Category.objects.create(title='Books')
+        make = models.Product.objects.create
+        cls.galaxy = make(title='Galaxy phone', description='Android phone, great camera',
+                          unit_price=300, inventory=5, category=cls.phones)
+        cls.pixel = make(title='Pixel', description='A phone by Google',
+                         unit_price=500, inventory=5, category=cls.phones)
+        cls.guide = make(title='Phone repair guide', description='How to fix things',
+                         unit_price=20, inventory=5, category=cls.books)
+        cls.novel = make(title='Novel', description='A story',
+                         unit_price=15, inventory=5, category=cls.books)
+
+    def search(self, query):
+        response = self.client.get(f'/store/products/?{query}')
+        return [row['id'] for row in response.data['results']]
+
+    def test_title_matches_rank_above_description_matches(self):
+        ids = self.search('search=phone')
+        self.assertEqual(set(ids), {self.galaxy.id, self.pixel.id, self.guide.id})
+        self.assertEqual(ids[-1], self.pixel.id)
+
+    def test_all_terms_must_match_and_last_term_is_a_prefix(self):
+        self.assertEqual(self.search('search=phone cam'), [self.galaxy.id])
+        self.assertEqual(self.search('search=nothing'), [])
+
+    def test_search_works_with_product_filter_and_ordering(self):
+        self.assertEqual(
+            self.search(f'search=phone&category_id={self.books.id}'), [self.guide.id])
+        self.assertEqual(
+            self.search('search=phone&ordering=-unit_price'),
+            [self.pixel.id, self.galaxy.id, self.guide.id])
+
+    def test_ranked_results_paginate(self):
+        first = self.client.get('/store/products/?search=phone&page_size=2')
+        second = self.client.get(first.data['next'])
+        ids = [row['id'] for row in first.data['results'] + second.data['results']]
+        self.assertEqual(ids, self.search('search=phone'))
+
+    def test_index_updates_incrementally_on_save_and_delete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.novel.title = 'Phone novel'
+            self.novel.save()
+        self.assertIn(self.novel.id, self.search('search=phone'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pixel.delete()
+        self.assertNotIn(self.pixel.id, self.search('search=google'))
+
+
+class QueryPlanCheckTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(
+            categories=3, products_per_category=10)
+        seed_orders(seed_user(), cls.products, orders=30)
+        seed_cart(cls.products)
+
+    def test_representative_queries_use_indexes(self):
+        # every table holds more rows than a page (20)
+        out = StringIO()
+        call_command('check_query_plans', threshold=20, stdout=out)
+        self.assertIn('Query plans OK', out.getvalue())
+
+    def test_sequential_scan_above_threshold_fails(self):
+        scans = find_seq_scans(
+            'unindexed', models.Product.objects.filter(inventory=3), threshold=10)
+        self.assertEqual([scan.table for scan in scans], ['store_product'])
+        self.assertEqual(
+            find_seq_scans('small', models.Product.objects.filter(inventory=3),
+                           threshold=1000), [])
+
+
+class InventoryReservationTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(categories=1, products_per_category=3)
+        cls.user = seed_user()
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def checkout(self, *lines):
+        cart = models.Cart.objects.create()
+        for product, quantity in lines:
+            models.CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        return cart, self.client.post('/store/orders/', {'cart_id': str(cart.id)}, format='json')
+
+    def inventory(self, product):
+        return models.Product.objects.values_list('inventory', flat=True).get(pk=product.pk)
+
+    def test_checkout_decrements_inventory(self):
+        first, second = self.products[:2]
+        before = self.inventory(first), self.inventory(second)
+        cart, response = self.checkout((first, 2), (second, 3))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((self.inventory(first), self.inventory(second)),
+                         (before[0] - 2, before[1] - 3))
+
+    def test_checkout_can_take_the_last_unit(self):
+        product = self.products[0]
+        models.Product.objects.filter(pk=product.pk).update(inventory=2)
+        cart, response = self.checkout((product, 2))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.inventory(product), 0)
+
+    def test_short_line_rejects_the_whole_order(self):
+        first, second = self.products[:2]
+        models.Product.objects.filter(pk=second.pk).update(inventory=1)
+        before = self.inventory(first)
+        cart, response = self.checkout((first, 1), (second, 2))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Not enough stock', str(response.data['cart_id']))
+        self.assertEqual(self.inventory(first), before)
+        self.assertEqual(self.inventory(second), 1)
+        self.assertFalse(models.Order.objects.filter(user=self.user).exists())
+        self.assertTrue(models.Cart.objects.filter(pk=cart.pk).exists())
+
+    def test_checkout_only_invalidates_the_bought_products(self):
+        bought, other = self.products[:2]
+        anonymous = APIClient()
+        urls = [f'/store/products/{product.id}/' for product in (bought, other)]
+        etags = [anonymous.get(url)['ETag'] for url in urls]
+        version = get_catalog_version()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.checkout((bought, 2))
+        self.assertEqual(get_catalog_version(), version)
+        response = anonymous.get(urls[0])
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertNotEqual(response['ETag'], etags[0])
+        self.assertEqual(response.data['inventory'], self.inventory(bought))
+        response = anonymous.get(urls[1], HTTP_IF_NONE_MATCH=etags[1])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(anonymous.get(urls[1])['X-Cache'], 'HIT')
+
+
+class CartItemUpsertTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(categories=1, products_per_category=4)
+
+    def setUp(self):
+        super().setUp()
+        self.cart = models.Cart.objects.create()
+        self.url = f'/store/carts/{self.cart.id}/items/'
+
+    def quantities(self):
+        return dict(self.cart.items.values_list('product_id', 'quantity'))
+
+    def test_adding_an_existing_product_increments_quantity(self):
+        product = self.products[0]
+        first = self.client.post(self.url, {'product_id': product.id, 'quantity': 2})
+        second = self.client.post(self.url, {'product_id': product.id, 'quantity': 3})
+        self.assertEqual(first.data['id'], second.data['id'])
+        self.assertEqual(second.data, {'id': first.data['id'],
+                                       'product_id': product.id, 'quantity': 5})
+        self.assertEqual(self.quantities(), {product.id: 5})
+
+    def test_batch_add_merges_lines(self):
+        a, b, c = self.products[:3]
+        self.client.post(self.url, {'product_id': a.id, 'quantity': 1})
+        response = self.client.post(self.url, [
+            {'product_id': a.id, 'quantity': 2},
+            {'product_id': b.id, 'quantity': 1},
+            {'product_id': b.id, 'quantity': 4},
+            {'product_id': c.id, 'quantity': 1},
+        ], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([line['product_id'] for line in response.data], [a.id, b.id, c.id])
+        self.assertEqual(self.quantities(), {a.id: 3, b.id: 5, c.id: 1})
+
+    def test_batch_with_unknown_product_adds_nothing(self):
+        response = self.client.post(self.url, [
+            {'product_id': self.products[0].id, 'quantity': 1},
+            {'product_id': 999999, 'quantity': 1},
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('999999', str(response.data))
+        self.assertEqual(self.quantities(), {})
+
+    def test_invalid_quantity_is_rejected(self):
+        response = self.client.post(self.url, [
+            {'product_id': self.products[0].id, 'quantity': 0}], format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_empty_batch_is_rejected(self):
+        response = self.client.post(self.url, [], format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_quantity_never_exceeds_the_field_maximum(self):
+        a, b = self.products[:2]
+        half = models.MAX_CART_QUANTITY // 2 + 1
+        response = self.client.post(self.url, [
+            {'product_id': a.id, 'quantity': half}, {'product_id': a.id, 'quantity': half}],
+            format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.quantities(), {})
+
+        self.client.post(self.url, {'product_id': a.id, 'quantity': half})
+        response = self.client.post(self.url, [
+            {'product_id': b.id, 'quantity': 1}, {'product_id': a.id, 'quantity': half}],
+            format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(a.id), str(response.data['quantity']))
+        self.assertEqual(self.quantities(), {a.id: half})
+
+
+class SweepCartsTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(categories=1, products_per_category=5)
+
+    def setUp(self):
+        super().setUp()
+        self.old = [seed_cart(self.products, items=2, seed=i) for i in range(7)]
+        models.Cart.objects.filter(pk__in=[c.pk for c in self.old]) \
+            .update(created_at=timezone.now() - timedelta(days=30),
+                    updated_at=timezone.now() - timedelta(days=30))
+        self.fresh = [seed_cart(self.products, items=2) for _ in range(2)]
+        self.state_file = os.path.join(tempfile.mkdtemp(), 'sweep.json')
+
+    def sweep(self, **options):
+        out = StringIO()
+        call_command('sweep_carts', ttl_days=7, batch_size=3, pause=0,
+                     state_file=self.state_file, stdout=out, **options)
+        return out.getvalue()
+
+    def test_deletes_only_carts_past_the_ttl(self):
+        out = self.sweep()
+        self.assertIn('Deleted 7 carts and 14 cart items', out)
+        self.assertRegex(out, r'[\d.]+s deleting \(\d+ rows/s\), [\d.]+s paused')
+        self.assertEqual(set(models.Cart.objects.values_list('pk', flat=True)),
+                         {c.pk for c in self.fresh})
+        self.assertFalse(os.path.exists(self.state_file))
+
+    def test_old_carts_with_recent_item_changes_are_kept(self):
+        added, changed, removed = self.old[:3]
+        self.client.post(f'/store/carts/{added.id}/items/',
+                         {'product_id': self.products[4].id, 'quantity': 1})
+        item = changed.items.first()
+        self.client.patch(f'/store/carts/{changed.id}/items/{item.id}/', {'quantity': 3})
+        item = removed.items.first()
+        self.client.delete(f'/store/carts/{removed.id}/items/{item.id}/')
+
+        self.assertIn('Deleted 4 carts', self.sweep())
+        self.assertEqual(set(models.Cart.objects.values_list('pk', flat=True)),
+                         {c.pk for c in [added, changed, removed, *self.fresh]})
+
+    def test_interrupted_sweep_resumes_from_checkpoint(self):
+        with mock.patch('store.management.commands.sweep_carts.time.sleep',
+                        side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.sweep()
+        self.assertEqual(models.Cart.objects.count(), 6)
+        self.assertTrue(os.path.exists(self.state_file))
+
+        out = self.sweep()
+        self.assertIn('Resuming sweep', out)
+        self.assertIn('Deleted 4 carts', out)
+        self.assertEqual(models.Cart.objects.count(), 2)
+
+
+class BenchCheckoutTests(StoreTestCase):
+
+    def test_single_worker_run_reports_throughput_and_latency(self):
+        out = StringIO()
+        call_command('bench_checkout', workers=1, orders=3, products=10, stdout=out)
+        report = out.getvalue()
+        self.assertIn('1 workers, 3 orders', report)
+        self.assertIn('p99=', report)
+        self.assertIn('failures=0', report)
+        self.assertEqual(models.Order.objects.count(), 3)
+
+    @override_settings(RATELIMITS=[
+        {'name': 'checkout', 'path': r'^/store/orders/?$', 'methods': ['POST'], 'rate': '2/m'}])
+    def test_runs_past_the_checkout_rate_limit(self):
+        out = StringIO()
+        call_command('bench_checkout', workers=1, orders=4, products=10, stdout=out)
+        self.assertIn('failures=0', out.getvalue())
+        self.assertEqual(models.Order.objects.count(), 4)
+
+    def test_queries_of_retried_attempts_are_reported_apart(self):
+        def bench():
+            out = StringIO()
+            call_command('bench_checkout', workers=1, orders=1, products=10, stdout=out)
+            return re.search(r'queries per order: \S+ \(max (\d+)\), (\d+) more',
+                             out.getvalue()).groups()
+
+        clean_max, clean_retried = bench()
+        create = views.OrderViewSet.create
+        attempts = []
+
+        def locked_once(viewset, request, *args, **kwargs):
+            if not attempts:
+                attempts.append(list(models.Product.objects.all()[:1]))
+                raise OperationalError('database is locked')
+            return create(viewset, request, *args, **kwargs)
+
+        with mock.patch.object(views.OrderViewSet, 'create', locked_once):
+            retried_max, retried = bench()
+        self.assertEqual(clean_retried, '0')
+        self.assertEqual(retried_max, clean_max)
+        self.assertEqual(retried, '1')
+
+
+class CategoryProductCountTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(categories=2, products_per_category=3)
+
+    def counts(self):
+        return list(models.Category.objects.filter(pk__in=[c.pk for c in self.categories])
+                    .order_by('pk').values_list('product_count', flat=True))
+
+    def test_create_move_and_delete_keep_the_count(self):
+        first, second = self.categories
+        product = models.Product.objects.create(
+            title='New', unit_price=5, inventory=1, category=first)
+        self.assertEqual(self.counts(), [4, 3])
+
+        product.title = 'Renamed'
+        product.save()
+        self.assertEqual(self.counts(), [4, 3])
+
+        product.category = second
+        product.save()
+        self.assertEqual(self.counts(), [3, 4])
+
+        product.delete()
+        models.Product.objects.filter(pk=self.products[0].pk).delete()
+        self.assertEqual(self.counts(), [2, 3])
+
+    def test_category_list_reads_the_column(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/store/categories/')
+        self.assertEqual(sorted(row['product_count'] for row in response.data), [3, 3])
+
+    def test_reconcile_repairs_drift(self):
+        models.Category.objects.filter(pk=self.categories[0].pk).update(product_count=42)
+        out = StringIO()
+        call_command('reconcile_category_counts', batch_size=1, stdout=out)
+        self.assertIn('Checked', out.getvalue())
+        self.assertIn('fixed 1 product counts', out.getvalue())
+        self.assertEqual(self.counts(), [3, 3])
+
+
+class PriceWithTaxTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.default = models.Category.objects.create(title='Default tax')
+        cls.reduced = models.Category.objects.create(title='Reduced', tax_rate='0.05')
+        make = models.Product.objects.create
+        cls.cheap = make(title='Cheap', unit_price='19.99', inventory=1, category=cls.default)
+        cls.mid = make(title='Mid', unit_price='20.00', inventory=1, category=cls.reduced)
+        cls.dear = make(title='Dear', unit_price='99.90', inventory=1, category=cls.default)
+
+    def prices(self, query=''):
+        response = self.client.get(f'/store/products/?{query}')
+        return [(row['id'], row['price_with_tax']) for row in response.data['results']]
+
+    def test_price_uses_category_or_default_rate(self):
+        self.assertEqual(dict(self.prices()), {
+            self.cheap.id: Decimal('21.99'),
+            self.mid.id: Decimal('21.00'),
+            self.dear.id: Decimal('109.89'),
+        })
+
+    def test_price_is_computed_in_sql(self):
+        product = models.Product.objects.with_price_with_tax().get(pk=self.dear.pk)
+        self.assertEqual(product.__dict__['_price_with_tax'], Decimal('109.89'))
+        # unannotated instances fall back to the same rule in Python
+        self.assertEqual(models.Product.objects.get(pk=self.dear.pk).price_with_tax,
+                         Decimal('109.89'))
+
+    def test_order_and_filter_by_price_with_tax(self):
+        ids = [pk for pk, _ in self.prices('ordering=price_with_tax')]
+        self.assertEqual(ids, [self.mid.id, self.cheap.id, self.dear.id])
+        ids = [pk for pk, _ in self.prices('price_with_tax__gt=21.5&price_with_tax__lt=100')]
+        self.assertEqual(ids, [self.cheap.id])
+
+    def test_pages_ordered_by_price_with_tax(self):
+        first = self.client.get('/store/products/?ordering=-price_with_tax&page_size=1')
+        ids = [first.data['results'][0]['id']]
+        url = first.data['next']
+        while url:
+            response = self.client.get(url)
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(ids, [self.dear.id, self.cheap.id, self.mid.id])
+
+
+class FastSerializationTests(QueryBudgetMixin, StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(categories=2, products_per_category=5)
+        odd = cls.products[0]
+        odd.title = 'Caf\u00e9 \u2603 line\u2028sep'
+        odd.description = None
+        odd.save()
+        models.ProductImage.objects.create(product=cls.products[1], image='')
+
+    def fetch(self, url, fast):
+        cache.clear()
+        with override_settings(CATALOG_FAST_SERIALIZATION=fast):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.content
+
+    def test_product_endpoints_match_serializer_bytes(self):
+        for url in ['/store/products/',
+                    '/store/products/?ordering=price_with_tax&page_size=3',
+                    f'/store/products/?category_id={self.categories[1].id}',
+                    '/store/products/?search=product',
+                    f'/store/products/{self.products[0].id}/',
+                    f'/store/products/{self.products[1].id}/']:
+            with self.subTest(url=url):
+                self.assertEqual(self.fetch(url, True), self.fetch(url, False))
+
+    def test_pages_follow_the_same_cursors(self):
+        slow = self.fetch('/store/products/?page_size=4', False)
+        fast = self.fetch('/store/products/?page_size=4', True)
+        self.assertEqual(fast, slow)
+        next_url = self.client.get('/store/products/?page_size=4').data['next']
+        self.assertEqual(self.fetch(next_url, True), self.fetch(next_url, False))
+
+    def test_json_renderer_follows_the_setting(self):
+        for fast, renderer in [(True, FastJSONRenderer), (False, JSONRenderer)]:
+            with self.subTest(fast=fast), override_settings(CATALOG_FAST_SERIALIZATION=fast):
+                response = self.client.get(f'/store/products/{self.products[2].id}/')
+                self.assertIs(type(response.accepted_renderer), renderer)
+
+    @override_settings(CATALOG_FAST_SERIALIZATION=True)
+    def test_fast_path_query_budget(self):
+        # validators + rows + images, same as the serializer path
+        self.assertQueryBudget(3, 'get', '/store/products/')
+        self.assertQueryBudget(3, 'get', f'/store/products/{self.products[2].id}/')
+        self.assertQueryBudget(2, 'get', '/store/products/0/', status_code=404)
+
+    def test_renderer_escapes_like_json_renderer(self):
+        data = {'text': 'a\u2028b\u2029c \u00e9', 'price': Decimal('1.50'),
+                'when': timezone.now(), 'none': None, 1: [1.5, True]}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+    def test_bench_serializers_reports_speedup(self):
+        out = StringIO()
+        call_command('bench_serializers', products=5, rounds=2, stdout=out)
+        self.assertIn('5 products/page', out.getvalue())
+
+    def test_bench_serializers_fails_when_payloads_differ(self):
+        with mock.patch.object(fastpath, 'product_dicts', return_value=[]):
+            with self.assertRaisesMessage(CommandError, 'payloads differ'):
+                call_command('bench_serializers', products=2, rounds=1, stdout=StringIO())
+
+
+class OrderExportTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        _, products = seed_catalog(categories=1, products_per_category=6)
+        cls.staff = seed_user(is_staff=True)
+        cls.customer = seed_user()
+        cls.orders = seed_orders(cls.customer, products, orders=4, items_per_order=2)
+        # no items: still exported, via the LEFT JOIN
+        cls.empty = models.Order.objects.create(user=cls.customer)
+        models.Order.objects.filter(pk=cls.orders[0].pk).update(
+            placed_at=timezone.now() - timedelta(days=30))
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.staff)
+
+    def export(self, query=''):
+        response = self.client.get(f'/store/orders/export/{query}')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_csv_has_one_row_per_item(self):
+        with self.assertNumQueries(1):
+            response, body = self.export()
+        self.assertTrue(response['Content-Type'].startswith('text/csv'))
+        self.assertIn('attachment; filename="orders-', response['Content-Disposition'])
+        header, *rows = body.splitlines()
+        self.assertTrue(header.startswith('order_id,placed_at,user_id,user_email'))
+        self.assertEqual(len(rows), 4 * 2 + 1)
+        self.assertEqual([int(row.split(',')[0]) for row in rows][-1], self.empty.id)
+        self.assertTrue(rows[-1].endswith(',,,,,'))
+
+    def test_ndjson_nests_items_per_order(self):
+        response, body = self.export('?format=ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([line['id'] for line in lines],
+                         [order.id for order in self.orders] + [self.empty.id])
+        self.assertEqual([len(line['items']) for line in lines], [2, 2, 2, 2, 0])
+        item = models.OrderItem.objects.select_related('product').order_by('id').first()
+        self.assertEqual(lines[0]['items'][0], {
+            'id': item.id, 'product_id': item.product_id, 'product_title': item.product.title,
+            'quantity': item.quantity, 'unit_price': float(item.unit_price)})
+        self.assertEqual(lines[0]['user_email'], self.customer.email)
+
+    def test_since_filters_orders(self):
+        since = (timezone.now() - timedelta(days=1)).date().isoformat()
+        _, body = self.export(f'?format=ndjson&since={since}')
+        ids = [json.loads(line)['id'] for line in body.splitlines()]
+        self.assertNotIn(self.orders[0].id, ids)
+        self.assertEqual(len(ids), 4)
+        response = self.client.get('/store/orders/export/?since=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    def test_staff_only(self):
+        self.client.force_authenticate(self.customer)
+        response = self.client.get('/store/orders/export/?format=ndjson')
+        self.assertEqual(response.status_code, 403)
+
+
+def image_upload(name, size, mode='RGB', fmt='JPEG'):
+    buffer = BytesIO()
+    Image.new(mode, size, color=(200, 30, 30, 128)[:len(mode)]).save(buffer, format=fmt)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+class ImageDerivativeTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = models.Category.objects.create(title='Pictures')
+        cls.product = models.Product.objects.create(
+            title='Framed', unit_price=10, inventory=1, category=cls.category)
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = override_settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def upload(self, *args, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = models.ProductImage.objects.create(
+                product=self.product, image=image_upload(*args, **kwargs))
+        image.refresh_from_db()
+        return image
+
+    def test_upload_generates_webp_and_fallback_per_width(self):
+        image = self.upload('wide.jpg', (1200, 800))
+        variants = image.derivatives['variants']
+        self.assertEqual(image.derivatives['source'], image.image.name)
+        self.assertEqual([(v['width'], v['height'], v['format']) for v in variants], [
+            (160, 107, 'webp'), (160, 107, 'jpeg'), (480, 320, 'webp'), (480, 320, 'jpeg'),
+            (960, 640, 'webp'), (960, 640, 'jpeg')])
+        storage = image.image.storage
+        for variant in variants:
+            with storage.open(variant['name']) as f:
+                self.assertEqual(Image.open(f).size, (variant['width'], variant['height']))
+
+    def test_small_transparent_image_gets_png_fallback_only_below_its_width(self):
+        image = self.upload('logo.png', (300, 300), mode='RGBA', fmt='PNG')
+        self.assertEqual([(v['width'], v['format']) for v in image.derivatives['variants']],
+                         [(160, 'webp'), (160, 'png')])
+
+    def test_product_payload_exposes_srcset(self):
+        self.upload('wide.jpg', (1200, 800))
+        response = self.client.get(f'/store/products/{self.product.id}/')
+        srcset = response.data['images'][0]['srcset']
+        self.assertEqual([(s['width'], s['type']) for s in srcset], [
+            (160, 'image/webp'), (480, 'image/webp'), (960, 'image/webp'),
+            (160, 'image/jpeg'), (480, 'image/jpeg'), (960, 'image/jpeg')])
+        self.assertTrue(srcset[0]['url'].startswith('http://testserver/static/media/'))
+
+        cache.clear()
+        with override_settings(CATALOG_FAST_SERIALIZATION=True):
+            fast = self.client.get(f'/store/products/{self.product.id}/')
+        self.assertEqual(fast.content, response.content)
+
+    def test_cached_product_picks_up_the_srcset(self):
+        url = f'/store/products/{self.product.id}/'
+        with self.captureOnCommitCallbacks() as callbacks:
+            models.ProductImage.objects.create(
+                product=self.product, image=image_upload('wide.jpg', (1200, 800)))
+        # a read between the upload's commit and the resize caches no srcset
+        *committed, resize = callbacks
+        for callback in committed:
+            callback()
+        before = self.client.get(url)
+        self.assertEqual(before.data['images'][0]['srcset'], [])
+        resize()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=before['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.data['images'][0]['srcset']), 6)
+        self.assertGreater(response.data['last_update'], before.data['last_update'])
+
+    def test_replaced_image_is_regenerated(self):
+        image = self.upload('wide.jpg', (1200, 800))
+        image.image = image_upload('narrow.jpg', (500, 500))
+        with self.captureOnCommitCallbacks() as callbacks:
+            image.save()
+        # stale derivatives are never served for the new file
+        self.assertEqual(serializers.ProductImageSerializer(image).data['srcset'], [])
+        for callback in callbacks:
+            callback()
+        image.refresh_from_db()
+        self.assertEqual(image.derivatives['source'], image.image.name)
+        self.assertEqual([v['width'] for v in image.derivatives['variants']], [160, 160, 480, 480])
+
+    def test_command_backfills_missing_derivatives(self):
+        image = self.upload('wide.jpg', (1200, 800))
+        models.ProductImage.objects.filter(pk=image.pk).update(derivatives={})
+        models.ProductImage.objects.create(product=self.product, image='store/images/missing.jpg')
+        out = StringIO()
+        with self.assertLogs('store.images', 'WARNING'):
+            call_command('generate_image_derivatives', stdout=out)
+        self.assertIn('Generated derivatives for 2 images', out.getvalue())
+        image.refresh_from_db()
+        self.assertEqual(len(image.derivatives['variants']), 6)
+
+        # the unreadable file is not retried on every run
+        out = StringIO()
+        call_command('generate_image_derivatives', stdout=out)
+        self.assertIn('Generated derivatives for 0 images', out.getvalue())
+
+    def test_command_bumps_the_catalog_once_per_run(self):
+        uploads = [self.upload('wide.jpg', (width, 800)) for width in (1000, 1100, 1200)]
+        models.ProductImage.objects.filter(pk__in=[i.pk for i in uploads]).update(derivatives={})
+        before = models.Product.objects.get(pk=self.product.pk).last_update
+        with mock.patch('store.images.bump_catalog_version') as per_image, \
+                mock.patch('store.management.commands.generate_image_derivatives.'
+                           'bump_catalog_version') as per_run:
+            call_command('generate_image_derivatives', batch_size=2, stdout=StringIO())
+        per_image.assert_not_called()
+        per_run.assert_called_once_with()
+        self.assertGreater(models.Product.objects.get(pk=self.product.pk).last_update, before)
+
+    @override_settings(IMAGE_DERIVATIVES_ON_UPLOAD=False)
+    def test_uploads_are_left_to_the_worker_when_not_resized_on_upload(self):
+        image = self.upload('wide.jpg', (1200, 800))
+        self.assertEqual(image.derivatives, {})
+        out = StringIO()
+        call_command('generate_image_derivatives', stdout=out)
+        self.assertIn('Generated derivatives for 1 images', out.getvalue())
+        image.refresh_from_db()
+        self.assertEqual(len(image.derivatives['variants']), 6)
+
+
+class ContentAddressedStorageTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.storage = ContentAddressedStorage(location=media.name, base_url='/static/media/')
+
+    def test_names_are_sha256_of_content(self):
+        content = b'not really a jpeg'
+        name = self.storage.save('store/images/Photo.JPG', ContentFile(content))
+        digest = hashlib.sha256(content).hexdigest()
+        self.assertEqual(name, f'store/images/{digest[:2]}/{digest}.jpg')
+        self.assertEqual(self.storage.url(name), f'/static/media/{name}')
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), content)
+
+    def test_identical_uploads_are_stored_once(self):
+        first = self.storage.save('store/images/a.jpg', ContentFile(b'same bytes'))
+        second = self.storage.save('store/images/b.jpg', ContentFile(b'same bytes'))
+        other = self.storage.save('store/images/a.jpg', ContentFile(b'other bytes'))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        files = [f for _, _, names in os.walk(self.storage.location) for f in names]
+        self.assertEqual(len(files), 2)
+
+    def test_image_fields_use_it(self):
+        for model in (models.ProductImage, models.CategoryImage):
+            self.assertIsInstance(model._meta.get_field('image').storage, ContentAddressedStorage)
+
+
+class RateLimitTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalog(categories=1, products_per_category=3)
+        cls.user = seed_user()
+
+    @override_settings(RATELIMITS=[
+        {'name': 'product-search', 'path': r'^/store/products/?$', 'methods': ['GET'],
+         'params': ['search'], 'rate': '3/m'}])
+    def test_search_is_throttled_per_ip_before_any_query(self):
+        for _ in range(3):
+            self.assertEqual(self.client.get('/store/products/?search=product').status_code, 200)
+        with self.assertNumQueries(0):
+            response = self.client.get('/store/products/?search=product')
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(1 <= int(response['Retry-After']) <= 60)
+        # other routes and other clients are not affected
+        self.assertEqual(self.client.get('/store/products/').status_code, 200)
+        other = self.client.get('/store/products/?search=product', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(other.status_code, 200)
+
+    @override_settings(RATELIMITS=[
+        {'name': 'api', 'path': r'^/store/', 'rate': '2/m'}])
+    def test_authenticated_clients_are_counted_by_user(self):
+        token = AccessToken.for_user(self.user)
+        for address in ('10.0.0.1', '10.0.0.2'):
+            response = self.client.get('/store/categories/', REMOTE_ADDR=address,
+                                       HTTP_AUTHORIZATION=f'JWT {token}')
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get('/store/categories/', REMOTE_ADDR='10.0.0.3',
+                                   HTTP_AUTHORIZATION=f'JWT {token}')
+        self.assertEqual(response.status_code, 429)
+        # an invalid token counts against the ip
+        response = self.client.get('/store/categories/', REMOTE_ADDR='10.0.0.3',
+                                   HTTP_AUTHORIZATION='JWT garbage')
+        self.assertEqual(response.status_code, 401)
+
+    def test_sliding_window_weighs_the_previous_window(self):
+        limiter = SlidingWindowLimiter(cache)
+        for i in range(10):
+            self.assertTrue(limiter.hit('k', 10, 60, now=60 * 100 + 30)[0])
+        self.assertFalse(limiter.hit('k', 10, 60, now=60 * 100 + 59)[0])
+        # 5s into the next window 11/12 of the previous 11 still count
+        self.assertEqual(limiter.hit('k', 10, 60, now=60 * 101 + 5), (False, 55))
+        self.assertTrue(limiter.hit('k', 10, 60, now=60 * 101 + 45)[0])
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('100/m'), (100, 60))
+        self.assertEqual(parse_rate('5/10s'), (5, 10))
+        with self.assertRaises(ValueError):
+            parse_rate('5 per minute')
+
+
+class MetricsTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_catalog(categories=1, products_per_category=3)
+        cls.staff = seed_user(is_staff=True)
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        metrics_settings = override_settings(METRICS_DIR=directory.name)
+        metrics_settings.enable()
+        self.addCleanup(metrics_settings.disable)
+        registry.reset()
+
+    def scrape(self):
+        self.client.force_authenticate(self.staff)
+        response = self.client.get('/metrics')
+        self.client.force_authenticate(None)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_records_per_route_latency_sql_serializer_and_size(self):
+        first = self.client.get('/store/products/')
+        self.client.get('/store/products/')
+        self.client.get('/store/nope/')
+        body = self.scrape()
+
+        labels = 'route="products-list",method="GET"'
+        self.assertIn(f'ebuy_http_request_duration_seconds_count{{{labels}}} 2', body)
+        self.assertIn(f'ebuy_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2', body)
+        self.assertIn(f'ebuy_http_requests_total{{{labels},status="200"}} 2', body)
+        self.assertIn('ebuy_http_requests_total{route="unresolved",method="GET",status="404"} 1',
+                      body)
+        # 3 queries for the first, the second is a catalog cache hit after the
+        # conditional GET validators query
+        self.assertIn(f'ebuy_http_sql_queries_total{{{labels}}} 4', body)
+        self.assertIn(f'ebuy_http_response_bytes_total{{{labels}}} {2 * len(first.content)}', body)
+        serializer_seconds = float(re.search(
+            rf'ebuy_http_serializer_seconds_total{{{labels}}} (\S+)', body).group(1))
+        self.assertGreater(serializer_seconds, 0)
+        self.assertRegex(body, r'ebuy_catalog_cache_hits_total [1-9]')
+
+    def test_merges_files_of_all_workers(self):
+        self.client.get('/store/categories/')
+        registry.flush()
+        directory = os.path.join(settings.METRICS_DIR, settings.METRICS_HOST)
+        own = os.path.join(directory, registry.filename())
+        self.assertTrue(registry.filename().startswith(f'{os.getpid()}-'))
+        with open(own) as f:
+            snapshot = json.load(f)
+        # a second worker with the same numbers, still running (our parent)
+        # and one that is gone
+        for name in (f'{os.getppid()}-live.json', '999999999-dead.json'):
+            with open(os.path.join(directory, name), 'w') as f:
+                json.dump(snapshot, f)
+        line = 'ebuy_http_requests_total{route="categories-list",method="GET",status="200"}'
+        self.assertIn(f'{line} 3', self.scrape())
+
+        # the dead worker's counts moved to the archive, and stay counted
+        self.assertEqual(sorted(os.listdir(directory)), sorted(
+            [registry.filename(), f'{os.getppid()}-live.json', 'archive.json', 'archive.lock']))
+        self.assertIn(f'{line} 3', self.scrape())
+
+    @override_settings(METRICS_HOST='app')
+    def test_adds_up_containers_sharing_the_metrics_volume(self):
+        # docker-compose-deploy.yml: the uwsgi `app` container serves /metrics,
+        # the `asgi` container only writes to METRICS_DIR/asgi
+        self.client.get('/store/categories/')
+        registry.flush()
+        with open(os.path.join(settings.METRICS_DIR, 'app', registry.filename())) as f:
+            snapshot = json.load(f)
+        asgi = os.path.join(settings.METRICS_DIR, 'asgi')
+        os.makedirs(asgi)
+        # pids of another container mean nothing here: not folded, still counted
+        for name in ('1-worker.json', '999999999-worker.json', 'archive.json'):
+            with open(os.path.join(asgi, name), 'w') as f:
+                json.dump(snapshot, f)
+        line = 'ebuy_http_requests_total{route="categories-list",method="GET",status="200"}'
+        self.assertIn(f'{line} 4', self.scrape())
+        self.assertEqual(sorted(os.listdir(asgi)),
+                         ['1-worker.json', '999999999-worker.json', 'archive.json'])
+
+        # the asgi container folds its own dead workers when a worker starts
+        with override_settings(METRICS_HOST='asgi'):
+            Registry().flush()
+        self.assertNotIn('999999999-worker.json', os.listdir(asgi))
+        self.assertIn(f'{line} 4', self.scrape())
+
+    def test_serializer_time_is_recorded_without_patching_drf(self):
+        self.assertEqual(BaseSerializer.data.fget.__module__, 'rest_framework.serializers')
+        self.client.force_authenticate(seed_user())
+        self.client.get('/store/categories/')
+        body = self.scrape()
+        seconds = float(re.search(
+            r'ebuy_http_serializer_seconds_total{route="categories-list",method="GET"} (\S+)',
+            body).group(1))
+        self.assertGreater(seconds, 0)
+
+    def test_staff_only(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.client.force_authenticate(seed_user())
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+
+@override_settings(QUERY_INSPECTOR_ENABLED=True, QUERY_INSPECTOR_THRESHOLD=3,
+                   QUERY_INSPECTOR_SLOW_MS=10 ** 6)
+class QueryInspectorTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        _, products = seed_catalog(categories=1, products_per_category=6)
+        cls.user = seed_user()
+        seed_orders(cls.user, products, orders=5, items_per_order=2)
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def test_clean_endpoint_has_no_findings(self):
+        response = self.client.get('/store/orders/')
+        self.assertEqual(response['X-Query-Inspector'], 'queries=4 n+1=0 duplicates=0 slow=0')
+        self.assertFalse(response.has_header('X-Query-NPlusOne'))
+
+    def test_flags_n_plus_one_with_serializer_field_and_frame(self):
+        # drop the prefetch: items are loaded once per order
+        without_prefetch = lambda view: models.Order.objects.filter(user=self.user).order_by('-id')
+        with mock.patch('store.views.OrderViewSet.get_queryset', without_prefetch), \
+                self.assertLogs('app.query_inspector', 'WARNING') as logs:
+            response = self.client.get('/store/orders/')
+        self.assertIn('n+1=', response['X-Query-Inspector'])
+        self.assertIn('OrderSerializer.items x5', response['X-Query-NPlusOne'])
+
+        events = [json.loads(line.split(':', 2)[2]) for line in logs.output]
+        items = next(e for e in events if e['serializer_field'] == 'OrderSerializer.items')
+        self.assertEqual(items['event'], 'n_plus_one')
+        self.assertEqual(items['count'], 5)
+        self.assertIn('"store_orderitem"."order_id" = ?', items['template'])
+        self.assertEqual(items['path'], '/store/orders/')
+
+    def test_logs_slow_and_duplicate_statements(self):
+        def twice(view):
+            models.Order.objects.filter(user=self.user).exists()
+            models.Order.objects.filter(user=self.user).exists()
+            return models.Order.objects.none()
+
+        with override_settings(QUERY_INSPECTOR_SLOW_MS=0), \
+                mock.patch('store.views.OrderViewSet.get_queryset', twice), \
+                self.assertLogs('app.query_inspector', 'WARNING') as logs:
+            response = self.client.get('/store/orders/')
+        self.assertIn('duplicates=1 slow=2', response['X-Query-Inspector'])
+        events = [json.loads(line.split(':', 2)[2]) for line in logs.output]
+        duplicate = next(e for e in events if e['event'] == 'duplicate')
+        self.assertEqual(duplicate['count'], 2)
+        self.assertTrue(duplicate['frame'].startswith('store/tests.py:'))
+        # no params in the log, only their hash
+        self.assertEqual(set(duplicate), {'event', 'method', 'path', 'template', 'params_hash',
+                                          'count', 'frame'})
+        self.assertNotIn(str(self.user.id), duplicate['template'])
+
+    def test_normalize(self):
+        self.assertEqual(
+            normalize("SELECT * FROM t WHERE a = 'x''y' AND b IN (1, 2, 3) AND c = %s  LIMIT 21"),
+            'SELECT * FROM t WHERE a = ? AND b IN (...) AND c = ? LIMIT ?')
+
+
+class AsyncViewTests(StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories, cls.products = seed_catalog(categories=2, products_per_category=4)
+        cls.cart = seed_cart(cls.products, items=3)
+        cls.item = cls.cart.items.first()
+        cls.user = seed_user()
+
+    def fetch_async(self, method, url, data=None, **headers):
+        """Request through the ASGI urlconf, the way app/asgi.py serves it"""
+        # AsyncClient takes header names, not META keys
+        headers = {name[5:].replace('_', '-').lower(): value for name, value in headers.items()}
+        if method != 'get':
+            data, headers['content_type'] = json.dumps(data or {}), 'application/json'
+
+        async def fetch():
+            return await getattr(AsyncClient(), method)(url, data, **headers)
+
+        with override_settings(ROOT_URLCONF='app.asgi_urls'):
+            return async_to_sync(fetch)()
+
+    def clear_responses(self):
+        # drop cached responses but keep the catalog version the ETags embed
+        version = get_catalog_version()
+        cache.clear()
+        cache.set(CATALOG_VERSION_KEY, version, timeout=None)
+
+    @contextmanager
+    def served_async(self):
+        # the DRF actions only run when an async view falls back
+        with ExitStack() as stack:
+            for viewset, action in [(views.ProductViewSet, 'list'),
+                                    (views.ProductViewSet, 'retrieve'),
+                                    (views.CategoryViewSet, 'list'),
+                                    (views.CartViewSet, 'retrieve'),
+                                    (views.CartItemViewSet, 'list'),
+                                    (views.CartItemViewSet, 'retrieve')]:
+                stack.enter_context(mock.patch.object(
+                    viewset, action, side_effect=AssertionError(f'{viewset.__name__}.{action} ran')))
+            yield
+
+    def test_reads_match_the_drf_views(self):
+        cart = f'/store/carts/{self.cart.id}'
+        urls = ['/store/products/',
+                '/store/products/?ordering=price_with_tax&page_size=3',
+                f'/store/products/?category_id={self.categories[1].id}',
+                '/store/products/?search=product',
+                f'/store/products/{self.products[0].id}/',
+                '/store/categories/',
+                f'{cart}/', f'{cart}/items/', f'{cart}/items/{self.item.id}/']
+        for url in urls:
+            with self.subTest(url=url):
+                self.clear_responses()
+                expected = self.client.get(url)
+                self.clear_responses()
+                with self.served_async():
+                    response = self.fetch_async('get', url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.content, expected.content)
+                for header in ('Content-Type', 'Vary', 'Allow', 'ETag', 'X-Cache'):
+                    self.assertEqual(response.get(header), expected.get(header), header)
+
+    def test_authenticated_reads_skip_the_cache(self):
+        token = f'JWT {AccessToken.for_user(self.user)}'
+        with self.served_async():
+            response = self.fetch_async('get', '/store/products/', HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('X-Cache'))
+
+    def test_shares_cache_and_validators_with_the_drf_views(self):
+        url = f'/store/products/{self.products[1].id}/'
+        first = self.client.get(url)
+        self.assertEqual(first['X-Cache'], 'MISS')
+        with self.served_async():
+            response = self.fetch_async('get', url)
+            self.assertEqual(response['X-Cache'], 'HIT')
+            self.assertEqual(response['ETag'], first['ETag'])
+            not_modified = self.fetch_async('get', url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertIn('Accept', not_modified['Vary'])
+
+    def test_errors_writes_and_browsable_api_fall_back_to_drf(self):
+        missing = self.fetch_async('get', '/store/products/0/')
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(missing.content, self.client.get('/store/products/0/').content)
+        self.assertEqual(self.fetch_async('get', '/store/carts/not-a-uuid/').status_code, 404)
+        self.assertEqual(self.fetch_async('get', '/store/products/?cursor=x').status_code, 404)
+        self.assertEqual(self.fetch_async(
+            'get', '/store/products/', HTTP_AUTHORIZATION='JWT nope').status_code, 401)
+
+        browsable = self.fetch_async('get', '/store/categories/', HTTP_ACCEPT='text/html')
+        self.assertEqual(browsable.status_code, 200)
+        self.assertTrue(browsable['Content-Type'].startswith('text/html'))
+
+        created = self.fetch_async('post', '/store/carts/')
+        self.assertEqual(created.status_code, 201)
+        self.assertTrue(models.Cart.objects.filter(pk=created.json()['id']).exists())
+
+    @override_settings(DEBUG=True)
+    def test_middleware_chain_stays_async(self):
+        # Django logs every sync/async adaption of a handler when DEBUG is on
+        with self.assertLogs('django.request', 'DEBUG') as logs:
+            logging.getLogger('django.request').debug('loading middleware')
+            BaseHandler().load_middleware(is_async=True)
+        self.assertEqual([line for line in logs.output if 'adapted' in line], [])
+
+    @override_settings(QUERY_INSPECTOR_ENABLED=True)
+    def test_metrics_and_query_inspector_see_async_queries(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        registry.reset()
+        with override_settings(METRICS_DIR=directory.name), self.served_async():
+            response = self.fetch_async('get', f'/store/products/{self.products[2].id}/')
+        # validators + row + images, run in sync_to_async threads
+        self.assertEqual(response['X-Query-Inspector'], 'queries=3 n+1=0 duplicates=0 slow=0')
+        self.assertEqual(registry.routes['products-detail|GET']['sql_queries'], 3)
+
+    def test_bench_servers_needs_named_targets(self):
+        with self.assertRaisesMessage(CommandError, 'name=http://host:port'):
+            call_command('bench_servers', target=['http://127.0.0.1:9000'])
+
+    def test_bench_servers_stops_on_rate_limited_responses(self):
+
+        class Limited(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(429)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Limited)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with self.assertRaisesMessage(CommandError, 'RATELIMIT_ENABLED=0'):
+            call_command('bench_servers', target=[f'limited=http://127.0.0.1:{server.server_port}'],
+                         path=['/store/categories/'], requests=4, concurrency=2, stdout=StringIO())
+
+
+@skipUnless(settings.DATABASE_REPLICAS, 'set DB_REPLICAS to test replica routing')
+@override_settings(DATABASE_REPLICAS=settings.DATABASE_REPLICAS[:1], REPLICA_PIN_SECONDS=10)
+class ReplicaRoutingTests(StoreTestCase):
+    """
+    Against a second local database, e.g. DB_REPLICAS=replica.sqlite3. It is
+    not kept in sync with `default` here, so every read shows where it went.
+    """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.replica = settings.DATABASE_REPLICAS[0]
+        _, products = seed_catalog(categories=2, products_per_category=2)
+        cls.cart = seed_cart(products, items=1)
+        cls.user = seed_user()
+        cls.staff = seed_user(is_staff=True)
+        seed_orders(cls.user, products, orders=2, items_per_order=1)
+        models.Category.objects.using(cls.replica).create(title='Replica only')
+
+    def category_titles(self, client=None, **headers):
+        response = (client or self.client).get('/store/categories/', **headers)
+        self.assertEqual(response.status_code, 200)
+        return [category['title'] for category in response.json()]
+
+    def test_catalog_reads_go_to_the_replica(self):
+        # anonymous cache misses are built on the replica too
+        self.assertEqual(self.category_titles(), ['Replica only'])
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.category_titles(), ['Replica only'])
+        # everything else stays on the primary
+        response = self.client.get('/store/orders/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 2)
+
+    def test_async_views_read_from_the_replica(self):
+        async def fetch(url):
+            return await AsyncClient().get(url)
+
+        with override_settings(ROOT_URLCONF='app.asgi_urls'):
+            categories = async_to_sync(fetch)('/store/categories/')
+            product = async_to_sync(fetch)(f'/store/products/{self.cart.items.get().product_id}/')
+        self.assertEqual([category['title'] for category in categories.json()], ['Replica only'])
+        # the replica has no products
+        self.assertEqual(product.status_code, 404)
+
+    def test_misses_right_after_a_catalog_write_are_built_on_the_primary(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Category.objects.create(title='New')
+        self.assertEqual(len(self.category_titles()), 3)
+        # past the lag window
+        cache.delete(CATALOG_BUMPED_KEY)
+        response = self.client.get('/store/categories/?page=1')
+        self.assertEqual([category['title'] for category in response.json()], ['Replica only'])
+
+    def test_writes_go_to_the_primary(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(models.Category), None)
+        with read_from(self.replica):
+            self.assertEqual(router.db_for_read(models.Category), self.replica)
+            category = models.Category.objects.create(title='Written')
+        self.assertEqual(category._state.db, 'default')
+        self.assertFalse(models.Category.objects.using(self.replica).filter(title='Written').exists())
+
+    def test_write_pins_the_client_by_cookie(self):
+        self.client.force_authenticate(self.user)
+        failed = self.client.post(f'/store/carts/{self.cart.id}/items/', {}, format='json')
+        self.assertEqual(failed.status_code, 400)
+        self.assertEqual(self.category_titles(), ['Replica only'])
+
+        created = self.client.post('/store/carts/')
+        self.assertEqual(created.status_code, 201)
+        self.assertIn(settings.REPLICA_PIN_COOKIE, created.cookies)
+        self.assertEqual(len(self.category_titles()), 2)
+        with mock.patch('app.db.replicas.time.time', return_value=time.time() + 11):
+            self.assertEqual(self.category_titles(), ['Replica only'])
+
+    def test_write_pins_a_jwt_user_without_cookies(self):
+        token = f'JWT {AccessToken.for_user(self.user)}'
+        other = f'JWT {AccessToken.for_user(self.staff)}'
+        self.assertEqual(self.client.post('/store/carts/', HTTP_AUTHORIZATION=token).status_code, 201)
+        self.assertEqual(len(self.category_titles(APIClient(), HTTP_AUTHORIZATION=token)), 2)
+        self.assertEqual(self.category_titles(APIClient(), HTTP_AUTHORIZATION=other), ['Replica only'])
+
+    def test_staff_export_reads_from_the_replica(self):
+        self.client.force_authenticate(self.staff)
+        response = self.client.get('/store/orders/export/?format=ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'')
+        # a pinned staff member reads the orders just written
+        self.client.cookies[settings.REPLICA_PIN_COOKIE] = str(int(time.time()) + 10)
+        response = self.client.get('/store/orders/export/?format=ndjson')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 2)
@@ -1,54 +1,71 @@
-from django.db.models import Count
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, DestroyModelMixin
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter
 from django_filters.rest_framework import DjangoFilterBackend
+from django.db.models import Prefetch
+
+from app.db.replicas import ReplicaReadMixin
+from app.metrics import SerializerTimingMixin
 
 
 from . import models
 from . import serializers
 from .permissions import IsAdminOrReadOnly
 from .filters import ProductFilter
+from .cache import CatalogCacheMixin
+from .conditional import ConditionalGetMixin
+from .export import export_response, parse_since
+from .fastpath import FastProductMixin
+from .pagination import OrderPagination, ProductPagination
+from .renderers import CSVRenderer, NDJSONRenderer
+from .search import ProductSearchFilter
 
 # Create your views here.
 
 
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(SerializerTimingMixin, ReplicaReadMixin, ConditionalGetMixin,
+                     CatalogCacheMixin, FastProductMixin, ModelViewSet):
 
-    queryset = models.Product.objects.prefetch_related('images').all()
+    # select_related for the category StringRelatedField, prefetch for nested images
+    # (ordered by id, same as the fast path)
+    queryset = models.Product.objects.with_price_with_tax().select_related(
+        'category').prefetch_related(
+            Prefetch('images', queryset=models.ProductImage.objects.order_by('id'))).all()
     serializer_class = serializers.ProductSerializer
     permission_classes = [IsAdminOrReadOnly]
 
     # Using django filter library for filtering product based on the collection
     # define filterbackend and filteing logic in a class
     # e.g: url--> http://127.0.0.1:8000/store/products/?collection_id=4 , filtering query is-->products/?collection_id=4
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, OrderingFilter]
     filterset_class = ProductFilter
-    search_fields = ['title', 'description']
-    # sorting based on unit_price and last_update
-    ordering_fields = ['unit_price', 'last_update']
-    # pagination_class = DefaultPagination
+    # ?search= matches the indexed title/description document, ranked by relevance
+    # sorting based on unit_price, price_with_tax and last_update
+    ordering_fields = ['unit_price', 'price_with_tax', 'last_update']
+    # keyset pagination, works with ?ordering= and never issues OFFSET/COUNT
+    pagination_class = ProductPagination
 
     def get_serializer_context(self):
         return {'request': self.request}
 
     def destroy(self, request, *args, **kwargs):
-        if models.Product.objects.filter(product_id=kwargs['pk']).count() > 0:
+        if models.OrderItem.objects.filter(product_id=kwargs['pk']).exists():
             return Response({'error': "Can't delete , product associated with an order"},
                             status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
         return super().destroy(request, *args, **kwargs)
 
 
-class CategoryViewSet(ModelViewSet):
+class CategoryViewSet(SerializerTimingMixin, ReplicaReadMixin, CatalogCacheMixin,
+                      ModelViewSet):
 
     serializer_class = serializers.CategorySerializer
-    queryset = models.Category.objects.annotate(
-        product_count=Count('products')).all().order_by('title')
+    # product_count is a maintained column, no aggregate over products
+    queryset = models.Category.objects.prefetch_related('images').order_by('title')
     permission_classes = [IsAdminOrReadOnly]
 
     # Override
@@ -62,18 +79,20 @@ class CategoryViewSet(ModelViewSet):
     #     return super().destroy(request, *args, **kwargs)
 
 
-class CartViewSet(CreateModelMixin,  # create cart with id, pass post request with empty ,
+class CartViewSet(SerializerTimingMixin,
+                  CreateModelMixin,  # create cart with id, pass post request with empty ,
                   RetrieveModelMixin,  # ../carts/id/ retrieving a specific cart
                   DestroyModelMixin,  # delete a 'cart/id/'
                   GenericViewSet
                   ):
 
     # prefetch_related used for fetch child table items, in foreignkey realation we use select_related
-    queryset = models.Cart.objects.prefetch_related('items__product').all()
+    queryset = models.Cart.objects.prefetch_related(
+        'items__product__images').all()
     serializer_class = serializers.CartSerializer
 
 
-class CartItemViewSet(ModelViewSet):
+class CartItemViewSet(SerializerTimingMixin, ModelViewSet):
     # must be lowercase in the list
     http_method_names = ['get', 'post', 'patch', 'delete']
 
@@ -87,22 +106,41 @@ class CartItemViewSet(ModelViewSet):
     def get_queryset(self):
         return models.CartItem.objects \
             .filter(cart_id=self.kwargs['cart_pk']) \
-            .select_related('product')
+            .select_related('product') \
+            .prefetch_related('product__images')
 
     # cart_pk value from url; add to context dict ; so we can access this value in serializer for creating custom save methode(override save methode)
     def get_serializer_context(self):
         return {'cart_id': self.kwargs['cart_pk']}
 
+    # POST accepts a single line or a list of {product_id, quantity} lines
+    def get_serializer(self, *args, **kwargs):
+        if isinstance(kwargs.get('data'), list):
+            kwargs['many'] = True
+        return super().get_serializer(*args, **kwargs)
+
+    # adds touch the cart in CartItemManager.add_lines()
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        models.Cart.objects.touch(self.kwargs['cart_pk'])
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        models.Cart.objects.touch(self.kwargs['cart_pk'])
 
-class OrderViewSet(ModelViewSet):
+
+class OrderViewSet(SerializerTimingMixin, ReplicaReadMixin, ModelViewSet):
     http_method_names = ['get', 'post', 'patch',
                          'delete', 'head', 'options']
+    # staff reports read from a replica, customers see their orders on the primary
+    replica_actions = ('export',)
 
     # def get_permissions(self):
     #     if self.request.method in ['PATCH', 'DELETE']:
     #         return [IsAdminUser()]
     #     return [IsAuthenticated()]
     permission_classes = [IsAuthenticated]
+    pagination_class = OrderPagination
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
@@ -114,14 +152,18 @@ class OrderViewSet(ModelViewSet):
     def get_queryset(self):
         user = self.request.user
         # admin or staff are able to see all orders
+        queryset = models.Order.objects.all()
+        # nested items are only serialized on reads; PATCH/DELETE don't need them
+        if self.request.method == 'GET':
+            queryset = queryset.prefetch_related('items__product__images')
         if user.is_staff:
-            return models.Order.objects.prefetch_related('items').all().order_by('-id')
+            return queryset.all().order_by('-id')
 
         # customer_id = Customer.objects \
         #     .only('id').get(user_id=user.id)
         user_id = self.request.user.id
 
-        return models.Order.objects.filter(user_id=user_id).order_by('-id')
+        return queryset.filter(user_id=user_id).order_by('-id')
 
     def create(self, request, *args, **kwargs):
         serializer = serializers.CreateOrderSerializer(
@@ -130,12 +172,22 @@ class OrderViewSet(ModelViewSet):
         )
         serializer.is_valid(raise_exception=True)
         order = serializer.save()
+        order = models.Order.objects.prefetch_related(
+            'items__product__images').get(pk=order.pk)
         # deserialize the saved order using order serializer ; CreateOrderSerializer only for creating and returning with cart_id
         serializer = serializers.OrderSerializer(order)
         return Response(serializer.data)
 
+    # staff reporting: ../orders/export/?format=csv|ndjson&since=2023-01-01
+    # streamed straight from a db cursor, see export.py
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser],
+            renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request):
+        since = parse_since(request.query_params.get('since'))
+        return export_response(request.accepted_renderer.format, since)
+
 
-class FeedbackViewSet(ModelViewSet):
+class FeedbackViewSet(SerializerTimingMixin, ModelViewSet):
     http_method_names=['post']
     serializer_class = serializers.FeedbackSerializer
     queryset = models.Feedback.objects.all()
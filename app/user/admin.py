@@ -13,3 +13,11 @@ class UserAdmin(admin.ModelAdmin):
     search_fields = ['full_name', 'email']
     list_editable: Sequence[str] = [
         'full_name', 'address', 'is_active', 'is_staff']
+
+
+@admin.register(models.OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'to', 'status', 'attempts', 'next_attempt_at', 'sent_at']
+    list_filter = ['status']
+    search_fields = ['subject']
+    readonly_fields: Sequence[str] = ['attempts', 'last_error', 'created_at', 'sent_at']
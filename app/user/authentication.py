@@ -0,0 +1,131 @@
+"""
+JWT authentication with a per-process user cache.
+
+simplejwt's JWTAuthentication loads the user with one SELECT on every
+request. CachedJWTAuthentication keeps recently seen users in a small
+LRU/TTL cache local to the worker. Each entry remembers the user's version,
+a counter in the shared Django cache that user.signals bumps whenever the
+User row is saved or deleted, so every worker drops its copy on the next
+request (is_active / is_staff changes apply immediately). Checking the
+version is a cache read, not a query.
+
+Writes that skip signals (QuerySet.update()) are only picked up when the
+entry expires after AUTH_USER_CACHE_TTL seconds.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+
+
+def user_version_key(user_id):
+    return f'user:auth:version:{user_id}'
+
+
+def get_user_version(user_id):
+    key = user_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        # seeded from the clock, so an evicted version never restarts at a
+        # number a worker already cached a user under
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_user_version(user_id):
+    try:
+        cache.incr(user_version_key(user_id))
+    except ValueError:
+        get_user_version(user_id)
+
+
+class UserCache:
+    """Thread-safe LRU of {user_id: (user, version, expires_at)} with hit/miss counters"""
+
+    def __init__(self, maxsize=None, ttl=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize or settings.AUTH_USER_CACHE_SIZE
+
+    @property
+    def ttl(self):
+        return self._ttl or settings.AUTH_USER_CACHE_TTL
+
+    def get(self, user_id, version):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] == version and entry[2] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                # callers may modify request.user, never hand out the cached one
+                return copy.copy(entry[0])
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def set(self, user_id, user, version):
+        with self._lock:
+            self._entries[user_id] = (copy.copy(user), version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def as_dict(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self._entries),
+            }
+
+
+user_cache = UserCache()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that resolves the token's user through user_cache"""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            # let simplejwt raise its usual InvalidToken
+            return super().get_user(validated_token)
+
+        # read the version before the row, so a save racing with the SELECT
+        # leaves an entry that is already stale
+        version = get_user_version(user_id)
+        user = user_cache.get(user_id, version)
+        if user is None:
+            user = super().get_user(validated_token)
+            user_cache.set(user_id, user, version)
+        elif not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
@@ -0,0 +1,17 @@
+"""
+
+django command to delete revoked refresh tokens that have expired
+
+"""
+
+from django.core.management.base import BaseCommand
+
+from user.revocation import prune
+
+
+class Command(BaseCommand):
+    """Workers prune on their own while rebuilding the Bloom filter; this is for cron"""
+
+    def handle(self, *args, **options):
+        deleted = prune(throttle=False)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired revoked tokens'))
@@ -0,0 +1,58 @@
+"""
+
+django command to send queued emails from the outbox
+
+"""
+
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from user import outbox
+
+
+class Command(BaseCommand):
+    """
+    Drain user.OutboxEmail with --workers threads, each reusing one SMTP
+    connection for its batches. Runs once by default; --loop keeps polling
+    every --poll seconds (run it as its own container/process).
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--loop', action='store_true')
+        parser.add_argument('--poll', type=float, default=5)
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = self.drain(options['workers'], options['batch_size'])
+            if sent or failed or not options['loop']:
+                self.stdout.write(f'sent={sent} failed={failed}')
+            if not options['loop']:
+                break
+            time.sleep(options['poll'])
+
+    def drain(self, workers, batch_size):
+        if workers == 1:
+            return outbox.drain(batch_size)
+
+        results = []
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                result = outbox.drain(batch_size)
+                with lock:
+                    results.append(result)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(r[0] for r in results), sum(r[1] for r in results)
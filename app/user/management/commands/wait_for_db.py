@@ -4,26 +4,40 @@ djnago command to wait for the db to be available
 
 """
 
+import random
 import time
 from psycopg2 import OperationalError as Psycopg2OpError
 from django.db.utils import OperationalError
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 
 class Command(BaseCommand):
     """Django command to wait for databe"""
 
+    def add_arguments(self, parser):
+        parser.add_argument('--initial-delay', type=float, default=0.1)
+        parser.add_argument('--max-delay', type=float, default=5)
+        parser.add_argument('--timeout', type=float, default=120,
+                            help='Give up after this many seconds')
+
     def handle(self, *args, **options):
         """Entry point for command"""
 
         self.stdout.write('wating for database')
-        db_up = False
-        while db_up is False:
+        deadline = time.monotonic() + options['timeout']
+        delay = options['initial_delay']
+        while True:
             try:
                 self.check(databases=['default'])
-                db_up = True
+                break
             except (Psycopg2OpError, OperationalError):
-                self.stdout.write('Database unavailable, waiting 1 second...')
-                time.sleep(1)
+                if time.monotonic() >= deadline:
+                    raise CommandError('Database unavailable, giving up')
+                # exponential backoff with jitter, so restarted containers
+                # don't all reconnect in lockstep
+                sleep = delay * random.uniform(0.5, 1)
+                self.stdout.write(f'Database unavailable, waiting {sleep:.2f} seconds...')
+                time.sleep(sleep)
+                delay = min(delay * 2, options['max_delay'])
 
         self.stdout.write(self.style.SUCCESS('Database ready!'))
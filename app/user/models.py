@@ -60,3 +60,59 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     def __str__(self) -> str:
         return self.email
+
+
+class OutboxEmail(models.Model):
+    """
+    An email waiting to be sent by the send_outbox command.
+
+    Written by user.outbox.OutboxEmailBackend in the caller's transaction,
+    so an email only exists if the signup/reset that produced it committed.
+    """
+    STATUS_PENDING = 'P'
+    STATUS_SENT = 'S'
+    STATUS_FAILED = 'F'
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    subject = models.TextField()
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list)
+    bcc = models.JSONField(default=list)
+    reply_to = models.JSONField(default=list)
+    headers = models.JSONField(default=dict)
+    # [[content, mimetype], ...], e.g. the html part of djoser emails
+    alternatives = models.JSONField(default=list)
+
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # earliest time a worker may (re)try, also used as the claim lease
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the worker's claim query: WHERE status = 'P' AND next_attempt_at <= now
+            models.Index(fields=['status', 'next_attempt_at'], name='user_outbox_due_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.subject} -> {", ".join(self.to)}'
+
+
+class RevokedToken(models.Model):
+    """A refresh token that may no longer be used, see user.revocation"""
+    jti = models.CharField(max_length=255, unique=True)
+    # when the token itself expires; the row is pruned after that
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self) -> str:
+        return self.jti
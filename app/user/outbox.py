@@ -0,0 +1,138 @@
+"""
+Transactional email outbox.
+
+OutboxEmailBackend (settings.EMAIL_BACKEND) stores every message as an
+OutboxEmail row instead of talking SMTP inside the request. The
+send_outbox command drains the table with settings.OUTBOX_EMAIL_BACKEND
+(the real SMTP backend): rows are claimed in batches by pushing
+next_attempt_at forward by a lease, sent over one reused connection per
+worker, and failures are retried with exponential backoff until
+OUTBOX_MAX_ATTEMPTS.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxEmailBackend(BaseEmailBackend):
+    """Email backend that queues messages in the outbox table"""
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        OutboxEmail.objects.bulk_create([to_outbox(message) for message in email_messages])
+        return len(email_messages)
+
+
+def to_outbox(message):
+    if message.attachments:
+        # nothing in the app attaches files; don't silently drop them
+        raise ValueError('OutboxEmailBackend does not support attachments')
+    return OutboxEmail(
+        subject=message.subject,
+        body=message.body,
+        from_email=message.from_email or '',
+        to=list(message.to),
+        cc=list(message.cc),
+        bcc=list(message.bcc),
+        reply_to=list(message.reply_to),
+        headers=dict(message.extra_headers),
+        alternatives=[list(alternative) for alternative in getattr(message, 'alternatives', [])],
+    )
+
+
+def to_message(email, connection=None):
+    message = EmailMultiAlternatives(
+        subject=email.subject, body=email.body,
+        from_email=email.from_email or None,
+        to=email.to, cc=email.cc, bcc=email.bcc, reply_to=email.reply_to,
+        headers=email.headers, connection=connection)
+    for content, mimetype in email.alternatives:
+        message.attach_alternative(content, mimetype)
+    return message
+
+
+def backoff(attempts):
+    """Delay before retry number `attempts`: base * 2^(attempts-1), capped at an hour"""
+    return timedelta(seconds=min(3600, settings.OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1)))
+
+
+def claim_batch(batch_size):
+    """
+    Lease up to batch_size due emails to the caller.
+
+    Concurrent workers skip rows another transaction has locked and then
+    can't see the leased ones, so every email goes to one worker. A worker
+    that dies just lets its lease run out.
+    """
+    now = timezone.now()
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    with transaction.atomic():
+        emails = list(OutboxEmail.objects
+                      .filter(status=OutboxEmail.STATUS_PENDING, next_attempt_at__lte=now)
+                      .order_by('next_attempt_at', 'id')
+                      .select_for_update(skip_locked=skip_locked)[:batch_size])
+        OutboxEmail.objects.filter(pk__in=[email.pk for email in emails]) \
+            .update(next_attempt_at=now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS))
+    return emails
+
+
+def send_batch(emails, email_connection):
+    """Send `emails` over one open connection, returns (sent, failed)"""
+    sent = failed = 0
+    for email in emails:
+        try:
+            # no-op while the connection is up; send_messages() won't close
+            # a connection it didn't open itself
+            email_connection.open()
+            email_connection.send_messages([to_message(email, email_connection)])
+        except Exception as e:
+            failed += 1
+            record_failure(email, e)
+            # the connection may be broken, the next message reopens it
+            email_connection.close()
+        else:
+            sent += 1
+            OutboxEmail.objects.filter(pk=email.pk).update(
+                status=OutboxEmail.STATUS_SENT, sent_at=timezone.now(),
+                attempts=email.attempts + 1, last_error='')
+    return sent, failed
+
+
+def record_failure(email, error):
+    attempts = email.attempts + 1
+    if attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        status, next_attempt_at = OutboxEmail.STATUS_FAILED, timezone.now()
+        logger.error('giving up on outbox email %s after %s attempts: %s', email.pk, attempts, error)
+    else:
+        status, next_attempt_at = OutboxEmail.STATUS_PENDING, timezone.now() + backoff(attempts)
+        logger.warning('outbox email %s failed (attempt %s): %s', email.pk, attempts, error)
+    OutboxEmail.objects.filter(pk=email.pk).update(
+        status=status, attempts=attempts, next_attempt_at=next_attempt_at,
+        last_error=f'{type(error).__name__}: {error}')
+
+
+def drain(batch_size=50):
+    """Send due emails until none are left, returns (sent, failed)"""
+    sent = failed = 0
+    email_connection = get_connection(settings.OUTBOX_EMAIL_BACKEND)
+    try:
+        while True:
+            emails = claim_batch(batch_size)
+            if not emails:
+                break
+            batch_sent, batch_failed = send_batch(emails, email_connection)
+            sent += batch_sent
+            failed += batch_failed
+    finally:
+        email_connection.close()
+    return sent, failed
@@ -0,0 +1,115 @@
+"""
+Refresh-token revocation store.
+
+Revoked refresh tokens (every token rotated out by /auth/jwt/refresh/) are
+rows of user.RevokedToken, unique on jti and kept until the token would
+have expired anyway. In front of the table every worker keeps a Bloom
+filter of the revoked jtis, so checking a token that was never revoked -
+almost every refresh - is a few in-memory bit tests and no query. A
+"maybe" from the filter is confirmed with an indexed lookup.
+
+The filter is rebuilt from the table every REVOKED_TOKEN_BLOOM_REFRESH
+seconds, which also prunes expired rows. Between rebuilds a worker doesn't
+know about tokens revoked by other workers, but rotation still can't be
+replayed: revoke() inserts the jti and a second insert of the same token
+fails on the unique index.
+"""
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import RevokedToken
+
+PRUNE_LOCK_KEY = 'user:revoked-tokens:prune'
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter sized for `capacity` items at `error_rate`"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # double hashing: position i = h1 + i * h2
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+
+class RevocationStore:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._built_at = 0.0
+        self.lookups = 0
+        self.db_checks = 0
+
+    def _filter(self):
+        """The current Bloom filter, rebuilt (and expired rows pruned) when due"""
+        with self._lock:
+            if self._bloom is not None and \
+                    time.monotonic() - self._built_at < settings.REVOKED_TOKEN_BLOOM_REFRESH:
+                return self._bloom
+            prune()
+            bloom = BloomFilter(settings.REVOKED_TOKEN_BLOOM_CAPACITY)
+            for jti in RevokedToken.objects.filter(expires_at__gt=timezone.now()) \
+                    .values_list('jti', flat=True).iterator(chunk_size=10000):
+                bloom.add(jti)
+            self._bloom, self._built_at = bloom, time.monotonic()
+            return bloom
+
+    def is_revoked(self, jti):
+        self.lookups += 1
+        if jti not in self._filter():
+            return False
+        self.db_checks += 1
+        return RevokedToken.objects.filter(jti=jti).exists()
+
+    def revoke(self, jti, exp):
+        """Revoke token `jti` expiring at unix time `exp`; False if it already was"""
+        expires_at = datetime.fromtimestamp(exp, tz=dt_timezone.utc)
+        try:
+            with transaction.atomic():
+                RevokedToken.objects.create(jti=jti, expires_at=expires_at)
+        except IntegrityError:
+            return False
+        self._filter().add(jti)
+        return True
+
+    def reset(self):
+        with self._lock:
+            self._bloom = None
+            self.lookups = self.db_checks = 0
+
+
+def prune(throttle=True):
+    """
+    Delete revocations of tokens that have expired. Throttled to one worker
+    per REVOKED_TOKEN_BLOOM_REFRESH period unless throttle=False.
+    """
+    if throttle and not cache.add(PRUNE_LOCK_KEY, 1, timeout=settings.REVOKED_TOKEN_BLOOM_REFRESH):
+        return 0
+    deleted, _ = RevokedToken.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
+
+
+revocations = RevocationStore()
@@ -1,5 +1,11 @@
 from djoser.serializers import UserCreateSerializer
 from django.contrib.auth import get_user_model
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer as BaseTokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from .revocation import revocations
 
 User = get_user_model()
 
@@ -15,3 +21,31 @@ class UserSerializer(UserCreateSerializer):
     class Meta(UserCreateSerializer.Meta):
         model = User
         fields = ('id', 'email', 'full_name',  'password','address','phone',)
+
+
+class TokenRefreshSerializer(BaseTokenRefreshSerializer):
+    """
+    simplejwt's refresh, with BLACKLIST_AFTER_ROTATION backed by
+    user.revocation instead of the token_blacklist app
+    """
+
+    def validate(self, attrs):
+        refresh = RefreshToken(attrs['refresh'])
+        jti = refresh[api_settings.JTI_CLAIM]
+        if revocations.is_revoked(jti):
+            raise TokenError(_('Token is blacklisted'))
+
+        data = {'access': str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                # fails if another request rotated this token in the meantime
+                if not revocations.revoke(jti, refresh['exp']):
+                    raise TokenError(_('Token is blacklisted'))
+
+            refresh.set_jti()
+            refresh.set_exp()
+
+            data['refresh'] = str(refresh)
+
+        return data
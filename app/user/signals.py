@@ -0,0 +1,18 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .authentication import bump_user_version, user_cache
+
+User = get_user_model()
+
+
+# Drop the local copy right away, other workers notice the new version once
+# the write is committed (an earlier bump could be re-cached from the old row)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_id = instance.pk
+    user_cache.discard(user_id)
+    transaction.on_commit(lambda: bump_user_version(user_id))
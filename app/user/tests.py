@@ -1,3 +1,322 @@
-from django.test import TestCase
+import socketserver
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
 
-# Create your tests here.
+from unittest import mock
+
+from django.core import mail
+from django.core.management import CommandError, call_command
+from django.db.utils import OperationalError
+from psycopg2 import OperationalError as Psycopg2OpError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from store.seeding import seed_user
+from store.tests import QueryBudgetMixin, StoreTestCase
+from user import outbox
+from user.authentication import UserCache, user_cache
+from user.models import OutboxEmail, RevokedToken
+from user.revocation import BloomFilter, revocations
+
+
+class UserEndpointBudgetTests(QueryBudgetMixin, StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_user()
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def test_user_list(self):
+        response = self.assertQueryBudget(1, 'get', '/user/')
+        self.assertEqual(response.data[0]['email'], self.user.email)
+
+    def test_user_detail(self):
+        self.assertQueryBudget(1, 'get', f'/user/{self.user.id}/')
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib; refuses recipients starting with 'bad'"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 fake smtp')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().strip()
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                return
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 fake')
+            elif command == 'RCPT':
+                if line.split(':', 1)[1].strip(' <>').startswith('bad'):
+                    self.reply('550 no such user')
+                else:
+                    recipients.append(line)
+                    self.reply('250 ok')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                data = b''
+                while not data.endswith(b'\r\n.\r\n'):
+                    data += self.rfile.readline()
+                with server.lock:
+                    server.messages.append(data.decode())
+                recipients = []
+                self.reply('250 queued')
+            else:  # MAIL, RSET, NOOP
+                recipients = []
+                self.reply('250 ok')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+
+
+@override_settings(EMAIL_BACKEND='user.outbox.OutboxEmailBackend',
+                   OUTBOX_EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                   EMAIL_HOST='127.0.0.1', EMAIL_USE_TLS=False,
+                   EMAIL_HOST_USER=None, EMAIL_HOST_PASSWORD=None,
+                   DEFAULT_FROM_EMAIL='shop@ebuy.test',
+                   OUTBOX_MAX_ATTEMPTS=3, OUTBOX_BACKOFF_SECONDS=30)
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.smtp = FakeSMTPServer()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+        self.addCleanup(self.smtp.server_close)
+        self.addCleanup(self.smtp.shutdown)
+        smtp_settings = override_settings(EMAIL_PORT=self.smtp.server_address[1])
+        smtp_settings.enable()
+        self.addCleanup(smtp_settings.disable)
+
+    def send_outbox(self, **options):
+        out = StringIO()
+        call_command('send_outbox', workers=1, stdout=out, **options)
+        return out.getvalue()
+
+    def test_send_mail_only_queues(self):
+        with self.assertNumQueries(1):
+            mail.send_mail('Hi', 'Body', None, ['a@ebuy.test', 'b@ebuy.test'])
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.to, ['a@ebuy.test', 'b@ebuy.test'])
+        self.assertEqual(email.status, OutboxEmail.STATUS_PENDING)
+        self.assertEqual(self.smtp.connections, 0)
+
+    def test_signup_activation_email_goes_through_outbox(self):
+        response = APIClient().post('/auth/users/', {
+            'email': 'new@ebuy.test', 'full_name': 'New User',
+            'password': 'a-Long-pass-123', 're_password': 'a-Long-pass-123'})
+        self.assertEqual(response.status_code, 201)
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.to, ['new@ebuy.test'])
+        self.assertEqual(email.alternatives[0][1], 'text/html')
+
+        self.assertIn('sent=1 failed=0', self.send_outbox())
+        self.assertIn('To: new@ebuy.test', self.smtp.messages[0])
+        self.assertIn('text/html', self.smtp.messages[0])
+
+    def test_worker_batches_over_one_connection(self):
+        for i in range(7):
+            mail.send_mail(f'Order {i}', 'Body', None, [f'user{i}@ebuy.test'])
+        # savepoint, select, update, release per batch + 1 update per email,
+        # then the empty claim
+        with self.assertNumQueries(2 * 4 + 7 + 3):
+            self.assertIn('sent=7 failed=0', self.send_outbox(batch_size=5))
+        self.assertEqual(len(self.smtp.messages), 7)
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertFalse(OutboxEmail.objects.exclude(status=OutboxEmail.STATUS_SENT).exists())
+
+    def test_failures_back_off_then_give_up(self):
+        mail.send_mail('Hi', 'Body', None, ['bad@ebuy.test'])
+        mail.send_mail('Hi', 'Body', None, ['good@ebuy.test'])
+        with self.assertLogs('user.outbox', 'WARNING'):
+            self.assertIn('sent=1 failed=1', self.send_outbox())
+        failed = OutboxEmail.objects.get(to=['bad@ebuy.test'])
+        self.assertEqual((failed.status, failed.attempts), (OutboxEmail.STATUS_PENDING, 1))
+        self.assertIn('SMTPRecipientsRefused', failed.last_error)
+        self.assertGreater(failed.next_attempt_at, timezone.now() + timedelta(seconds=25))
+        # not due yet
+        self.assertIn('sent=0 failed=0', self.send_outbox())
+
+        for attempt in (2, 3):
+            OutboxEmail.objects.filter(pk=failed.pk).update(next_attempt_at=timezone.now())
+            with self.assertLogs('user.outbox', 'WARNING'):
+                self.send_outbox()
+        failed.refresh_from_db()
+        self.assertEqual((failed.status, failed.attempts), (OutboxEmail.STATUS_FAILED, 3))
+        self.assertEqual(outbox.backoff(1), timedelta(seconds=30))
+        self.assertEqual(outbox.backoff(2), timedelta(seconds=60))
+
+    def test_claimed_batch_is_leased(self):
+        mail.send_mail('Hi', 'Body', None, ['a@ebuy.test'])
+        self.assertEqual(len(outbox.claim_batch(10)), 1)
+        # a second worker doesn't get the same email until the lease expires
+        self.assertEqual(outbox.claim_batch(10), [])
+
+
+class CachedJWTAuthenticationTests(QueryBudgetMixin, StoreTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_user()
+
+    def setUp(self):
+        super().setUp()
+        user_cache.clear()
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {AccessToken.for_user(self.user)}')
+
+    def test_repeat_requests_skip_the_user_query(self):
+        self.assertQueryBudget(2, 'get', '/user/')
+        self.assertQueryBudget(1, 'get', '/user/')
+        self.assertQueryBudget(1, 'get', f'/user/{self.user.id}/')
+        self.assertEqual(user_cache.as_dict(),
+                         {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3, 'size': 1})
+
+    def test_deactivating_user_applies_immediately(self):
+        self.client.get('/user/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.client.get('/user/').status_code, 401)
+
+    def test_other_workers_see_the_new_version(self):
+        self.client.get('/user/')
+        # save in "another worker": only the shared version changes
+        with mock.patch.object(user_cache, 'discard'), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.user.is_staff = True
+            self.user.save()
+        response = self.client.get('/store/orders/export/?format=ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(user_cache.misses, 2)
+
+    def test_cached_user_is_a_copy(self):
+        self.client.get('/user/')
+        cached = user_cache.get(self.user.id, mock.ANY)
+        cached.full_name = 'changed'
+        self.assertNotEqual(user_cache.get(self.user.id, mock.ANY).full_name, 'changed')
+
+
+class UserCacheTests(TestCase):
+
+    def test_lru_eviction_and_ttl(self):
+        users = UserCache(maxsize=2, ttl=10)
+        with mock.patch('user.authentication.time.monotonic', return_value=100):
+            for user_id in (1, 2):
+                users.set(user_id, seed_user(), version=1)
+            self.assertIsNotNone(users.get(1, 1))
+            users.set(3, seed_user(), version=1)
+            # 2 was least recently used
+            self.assertIsNone(users.get(2, 1))
+            self.assertIsNotNone(users.get(1, 1))
+            self.assertIsNone(users.get(3, 2))
+        with mock.patch('user.authentication.time.monotonic', return_value=111):
+            self.assertIsNone(users.get(1, 1))
+        self.assertEqual(users.as_dict()['size'], 0)
+
+
+class RefreshTokenRevocationTests(TestCase):
+
+    def setUp(self):
+        revocations.reset()
+        self.addCleanup(revocations.reset)
+        self.user = seed_user()
+        self.client = APIClient()
+
+    def refresh(self, token):
+        return self.client.post('/auth/jwt/refresh/', {'refresh': str(token)})
+
+    def test_rotated_token_cannot_be_reused(self):
+        token = RefreshToken.for_user(self.user)
+        response = self.refresh(token)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.data)
+        self.assertTrue(RevokedToken.objects.filter(jti=token['jti']).exists())
+
+        replay = self.refresh(token)
+        self.assertEqual(replay.status_code, 401)
+        self.assertEqual(replay.data['code'], 'token_not_valid')
+        # the new refresh token works, once
+        rotated = response.data['refresh']
+        self.assertEqual(self.refresh(rotated).status_code, 200)
+        self.assertEqual(self.refresh(rotated).status_code, 401)
+
+    def test_unrevoked_tokens_need_no_lookup(self):
+        revocations.revoke('some-other-jti', int(time.time()) + 60)
+        token = RefreshToken.for_user(self.user)
+        # filter built on first use; then only the insert of the rotated token
+        revocations.is_revoked('warm-up')
+        with self.assertNumQueries(3):  # savepoint, insert, release
+            self.assertEqual(self.refresh(token).status_code, 200)
+        self.assertEqual(revocations.db_checks, 0)
+
+    def test_revocation_from_another_worker_is_caught_by_the_index(self):
+        token = RefreshToken.for_user(self.user)
+        revocations.is_revoked('warm-up')
+        # another worker rotated it; this worker's filter doesn't know yet
+        RevokedToken.objects.create(jti=token['jti'], expires_at=timezone.now() + timedelta(days=1))
+        self.assertEqual(self.refresh(token).status_code, 401)
+
+    @override_settings(REVOKED_TOKEN_BLOOM_REFRESH=0)
+    def test_expired_revocations_are_pruned(self):
+        RevokedToken.objects.create(jti='old', expires_at=timezone.now() - timedelta(seconds=1))
+        RevokedToken.objects.create(jti='live', expires_at=timezone.now() + timedelta(days=1))
+        self.assertTrue(revocations.is_revoked('live'))
+        self.assertEqual(list(RevokedToken.objects.values_list('jti', flat=True)), ['live'])
+
+        RevokedToken.objects.create(jti='old', expires_at=timezone.now() - timedelta(seconds=1))
+        out = StringIO()
+        call_command('prune_revoked_tokens', stdout=out)
+        self.assertIn('Deleted 1 expired', out.getvalue())
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f'jti-{i}')
+        self.assertTrue(all(f'jti-{i}' in bloom for i in range(1000)))
+        false_positives = sum(f'other-{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+        self.assertEqual(len(bloom.bits), 1199)
+
+
+@mock.patch('user.management.commands.wait_for_db.Command.check')
+class WaitForDbTests(TestCase):
+
+    def test_ready_immediately(self, patched_check):
+        patched_check.return_value = True
+        call_command('wait_for_db', stdout=StringIO())
+        patched_check.assert_called_once_with(databases=['default'])
+
+    @mock.patch('user.management.commands.wait_for_db.random.uniform', return_value=1)
+    @mock.patch('time.sleep')
+    def test_backs_off_exponentially(self, patched_sleep, patched_uniform, patched_check):
+        patched_check.side_effect = [Psycopg2OpError] * 2 + [OperationalError] * 4 + [True]
+        call_command('wait_for_db', initial_delay=0.1, max_delay=1, stdout=StringIO())
+        self.assertEqual(patched_check.call_count, 7)
+        self.assertEqual([c.args[0] for c in patched_sleep.call_args_list],
+                         [0.1, 0.2, 0.4, 0.8, 1, 1])
+
+    @mock.patch('time.sleep')
+    def test_gives_up_after_timeout(self, patched_sleep, patched_check):
+        patched_check.side_effect = OperationalError
+        with self.assertRaises(CommandError):
+            call_command('wait_for_db', timeout=0, stdout=StringIO())
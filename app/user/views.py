@@ -4,13 +4,17 @@ from django.contrib.auth import get_user_model
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework_simplejwt.views import TokenRefreshView as BaseTokenRefreshView
+
+from app.metrics import SerializerTimingMixin
+
 from . import serializers
 # Create your views here.
 # from .models import User
 User = get_user_model()
 
 
-class UserViewSet(ModelViewSet):
+class UserViewSet(SerializerTimingMixin, ModelViewSet):
 
     http_method_names = ['get', 'put',]
     serializer_class = serializers.UserSerializer
@@ -32,3 +36,8 @@ class UserViewSet(ModelViewSet):
     #         serializer.is_valid(raise_exception=True)
     #         serializer.save()
     #         return Response(serializer.data)
+
+
+class TokenRefreshView(BaseTokenRefreshView):
+    # revokes the rotated-out refresh token, see user.revocation
+    serializer_class = serializers.TokenRefreshSerializer
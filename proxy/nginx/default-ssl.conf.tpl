@@ -24,10 +24,28 @@ server {
 
     add_header Strict-Transport-Security "max-age=31536000; includeSubDomains" always;
 
+    # content-addressed media (store/storage.py): the name is the sha256 of
+    # the bytes, so a URL never changes content and can be cached for good
+    location ~ "^/static/(media/.+/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]+)$" {
+        alias /vol/static/$1;
+        add_header Cache-Control "public, max-age=31536000, immutable";
+        # add_header here replaces the server level one
+        add_header Strict-Transport-Security "max-age=31536000; includeSubDomains" always;
+    }
+
     location /static {
         alias /vol/static;
     }
 
+    # async catalog and cart views under uvicorn (store/async_views.py)
+    location ~ ^/store/(products|categories|carts)(/|$) {
+        proxy_pass           http://${ASGI_HOST}:${ASGI_PORT};
+        proxy_set_header     Host $host;
+        proxy_set_header     X-Forwarded-For $remote_addr;
+        proxy_set_header     X-Forwarded-Proto $scheme;
+        client_max_body_size 10M;
+    }
+
     location / {
         uwsgi_pass           ${APP_HOST}:${APP_PORT};
         include              /etc/nginx/uwsgi_params;
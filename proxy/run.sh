@@ -12,6 +12,8 @@ fi
 # Avoid replacing these with envsubst
 export host=\$host
 export request_uri=\$request_uri
+export remote_addr=\$remote_addr
+export scheme=\$scheme
 
 echo "Checking for fullchain.pem"
 
@@ -0,0 +1,13 @@
+#!/bin/sh
+
+set -e
+
+python manage.py wait_for_db
+
+# async catalog and cart views (store/async_views.py). Each request runs its
+# queries on a new thread, so a persistent connection per thread would be a
+# new connection per request: share a pool instead (DB_POOL=1).
+export CONN_MAX_AGE=0
+
+uvicorn app.asgi:application --host 0.0.0.0 --port 9001 --workers ${ASGI_WORKERS:-4} \
+    --proxy-headers --forwarded-allow-ips '*'